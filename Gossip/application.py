@@ -2,19 +2,24 @@
 @author: Patrick Rockenschaub
 '''
 
+import optparse
 import simplejson
 import traceback
 import time
 
 from gossip.crackertable import Babblemouth, Conversation
-from gossip.stationhouse import Supervisor, HTTPService
-from gossip.utils import CouchDBManager, ssldebug
+from gossip.metrics import StatsServer, registry
+from gossip.quorum import OutcomeBatcher, QuorumEvaluator, ReplicaAssigner, decodeoutcomes
+from gossip.sharding import ShardedSupervisor
+from gossip.stationhouse import Supervisor, AdaptiveInterval, HostLimiter, HTTPService, TCPService, \
+                                TLSService, SMTPService, SSHService, IMAPService
+from gossip.utils import CouchDBManager, ResultsWriter, ssldebug
 from M2Crypto import X509
 
 babbler = None
 checker = None
 
-def startgossip():
+def startgossip( replicas = 2 ):
     def metahandler( conv, msg ):
     #--------------------------------------------------------------------------
         """
@@ -24,7 +29,8 @@ def startgossip():
         data using simplejson and load them one by one by calling 'loadbabbler' method.
         
         After the babblers have been loaded they are stored in the database and a request
-        for a update of the service list is sended.
+        for a update of the service list is sended, as well as a request for the current
+        results of our services the partner checks.
         
         :param conv: conversation instance from which the message has been received
         :param msg: actual message data as string
@@ -42,6 +48,7 @@ def startgossip():
         ssldebug("Synchronizing done with %s" % conv.id)
         
         conv.senddata("SREQ", conv.getmessagesequence(), "Service request")
+        conv.senddata("RREQ", conv.getmessagesequence(), "Result request")
     #--------------------------------------------------------------------------
     
     def servupdhandler( conv, msg ):
@@ -78,6 +85,70 @@ def startgossip():
             conv.senddata("SUPD", conv.getmessagesequence(), services)
     #--------------------------------------------------------------------------   
     
+    def resulthandler( conv, msg ):
+    #--------------------------------------------------------------------------
+        """
+        Handle incoming results of our own services checked by another babbler.
+        
+        The outcomes are passed to the quorum evaluator. If any verdict changed,
+        all verdicts are stored in the 'verdicts' document of the results database.
+        
+        :param conv: conversation instance from which the message has been received
+        :param msg: batch of outcomes (see 'quorum.encodeoutcomes')
+        """
+        
+        evaluator.record(conv.id, decodeoutcomes(msg))
+        saveverdicts()
+    #--------------------------------------------------------------------------
+    
+    def membershiphandler( babbler, members ):
+    #--------------------------------------------------------------------------
+        """
+        Assign the services to the current members and forget the results 
+        reported by babblers which aren't members anymore respectively aren't
+        assigned to the service anymore. As members only drop out after 
+        'Babblemouth.MEMBER_TIMEOUT' seconds without a conversation, the results
+        are kept through short disconnects and completed by the snapshot 
+        requested when the conversation restarts.
+        
+        The assignment may have changed, so the current results are requested 
+        from every babbler we're talking to.
+        
+        :param babbler: babblemouth whose members changed
+        :param members: identifiers of the current members
+        """
+        
+        if assigner is not None:
+            assigner.setmembers(members)
+        
+        evaluator.retain(members)
+        saveverdicts()
+        
+        try:
+            babbler.babblelock.acquire()
+            for conv in babbler.babblers.values():
+                if conv.status == Conversation.GOING_ON:
+                    conv.senddata("RREQ", conv.getmessagesequence(), "Result request")
+        finally:
+            babbler.babblelock.release()
+    #--------------------------------------------------------------------------
+    
+    def saveverdicts():
+    #--------------------------------------------------------------------------
+        """
+        Store the verdicts on our own services if any of them changed.
+        """
+        
+        changes = evaluator.getchangedverdicts()
+        if not changes:
+            return
+        
+        for index in changes:
+            ssldebug("Service %s is %s" % (index, changes[index]))
+        
+        verdictdb.write("verdicts", evaluator.tojson())
+    #--------------------------------------------------------------------------
+    
     def loadconfiguration():
     #------------------------------------------------------------------------- 
         """
@@ -188,18 +259,74 @@ def startgossip():
     
     config = loadconfiguration()
     babbler = Babblemouth(config)
-    
     loadbabblersfromdb(babbler)
+    
+    quorum = int(config.get("quorum", 2))
+    
+    # every service is checked by 'replicas' babblers only, 0 lets all check it
+    if replicas > 0:
+        if replicas < quorum:
+            raise ValueError("%d replica(s) can't reach a quorum of %d" % (replicas, quorum))
+        
+        assigner = ReplicaAssigner(babbler.myid, replicas)
+        assigner.setmembers(babbler.getmembers())
+    else:
+        assigner = None
+    
+    evaluator = QuorumEvaluator(quorum, assigner)
+    verdictdb = CouchDBManager("localhost", "5984", "gossip_watchresults")
+    
     babbler.addhandler("META", metahandler)
     babbler.addhandler("SUPD", servupdhandler)
     babbler.addhandler("SREQ", servreqhandler)
+    babbler.addhandler("RSLT", resulthandler)
+    babbler.addmembershiphandler(membershiphandler)
     
     servdb = CouchDBManager("localhost", "5984", "gossip_watchlist")
     servdb.watchdbthreading(processserviceupdate, ["self"])
     
     babbler.start()
     
-def startpolicing():
+    return babbler, assigner
+    
+def createchecker( shards = 0 ):
+    handler = {"HTTP":HTTPService, "TCP":TCPService, "TLS":TLSService, 
+               "SMTP":SMTPService, "SSH":SSHService, "IMAP":IMAPService}
+    limiter = HostLimiter(maxinflight = 2, rate = 1.0, burst = 5)
+    adaptive = AdaptiveInterval(stableafter = 5, factor = 2.0)
+    if shards > 0:
+        return ShardedSupervisor(handler, shards, workers = 25, queuesize = 250, limiter = limiter, 
+                                 adaptive = adaptive)
+    
+    return Supervisor(handler, workers = 25, queuesize = 250, limiter = limiter, adaptive = adaptive)
+
+def startpolicing( checker, babbler = None, assigner = None ):
+    def membershiphandler( babbler, members ):
+    #--------------------------------------------------------------------------
+        """
+        Rebalance the services checked by this peer when the members of the 
+        babbler change (see 'Babblemouth.getmembers'). Called by the babbler's 
+        membership thread.
+        
+        Every service list is processed again, so newly assigned services are 
+        queued and services assigned to other babblers are removed. The service
+        list is only locked per document, so checks aren't held up meanwhile.
+        
+        :param babbler: babblemouth whose members changed
+        :param members: identifiers of the current members
+        """
+        
+        ssldebug("Rebalancing services among %d babbler(s)..." % len(members))
+        
+        for document in watchDB.getdocumentlist():
+            if document != "self":
+                try:
+                    checker.lock()
+                    processserviceupdate(document)
+                finally:
+                    checker.release()
+    #--------------------------------------------------------------------------
+    
     def processserviceupdate( document ):
     #--------------------------------------------------------------------------
         """
@@ -207,7 +334,8 @@ def startpolicing():
         
         Will be called by couchDB change notifier if a babbler's service list is altered
         by receiving a service update. New services are simply queued in the supervisor 
-        instance and no longer existing services are removed.
+        instance and no longer existing services are removed. With replica assignment
+        only the services assigned to this peer are queued.
         
         :param document: document which has been altered (passed by CouchDBHandler.watchdbthreading).
         """
@@ -217,7 +345,17 @@ def startpolicing():
             for index in services:
                 service = services[index]
                 uid = "%s/%s" % (document, index)
-                checker.queueservice(uid, service["proto"], service["ipv4"], service["port"], service["timeout"], 200, 180 )
+                if assigner is not None and not assigner.isassigned(uid, document):
+                    continue
+                
+                try:
+                    checker.queueservice(uid, service["proto"], service["ipv4"], service["port"], service["timeout"], 
+                                         service.get("pattern", 200), service.get("interval", 180), 
+                                         service.get("mininterval"), service.get("maxinterval"),
+                                         service.get("method", "GET"))
+                except ValueError:
+                    # e.g. an unsupported method, skip just this service
+                    traceback.print_exc()
         except KeyboardInterrupt:
             raise
         except:
@@ -226,39 +364,119 @@ def startpolicing():
             checker.removeobsoleteservices(document)
     #--------------------------------------------------------------------------    
     
-    handler = {"HTTP":HTTPService}
-    checker = Supervisor(handler)
+    def publishresults():
+    #--------------------------------------------------------------------------
+        """
+        Write the results of all watched services which changed since the last 
+        call to couchDB.
+        
+        Will be called by the supervisor every time it starts waiting for the
+        next service to become due.
+        
+        The changes are also sent to the babblers who announced the services,
+        batched per babbler. Batches for babblers currently not available are
+        sent later on.
+        """
+        
+        changes = checker.getchangedresults()
+        resultwriter.publish(changes)
+        
+        if babbler is not None:
+            batcher.add(changes)
+            batcher.flush(sendoutcomes)
+        
+        stats = checker.getprobestats()
+        ssldebug("%d service(s) currently watched, %d check(s) pending, %d timed out, %d failed DNS lookup(s)..." % 
+                 (checker.getservicecount(), stats["queued"], stats["timedout"], stats["dnsfailures"]))
+    #--------------------------------------------------------------------------
+    
+    def sendoutcomes( identifier, outcomes ):
+    #--------------------------------------------------------------------------
+        """
+        Send a batch of results to the babbler who announced the services.
+        
+        :param identifier: canonical name identifying the babbler
+        :param outcomes: encoded batch (see 'quorum.encodeoutcomes')
+        :return: 'True' if the batch has been queued for sending
+        """
+        
+        conv = babbler.getbabbler(identifier)
+        if conv is None or conv.status != Conversation.GOING_ON:
+            return False
+        
+        conv.senddata("RSLT", conv.getmessagesequence(), outcomes)
+        return True
+    #--------------------------------------------------------------------------
+    
+    def resultrequesthandler( conv, msg ):
+    #--------------------------------------------------------------------------
+        """
+        Handle a request for the current results of the services announced by
+        the requesting babbler, sent whenever a conversation starts.
+        
+        All its services checked by us are batched, whether they changed or 
+        not, and sent with the next results.
+        
+        :param conv: conversation instance from which the message has been received
+        :param msg: actual message data as string
+        """
+        
+        batcher.add(checker.getgroupresults(conv.id + "/"))
+    #--------------------------------------------------------------------------
+    
+    batcher = OutcomeBatcher()
+    
+    registry.gauge("gossip_services_watched", "Services currently watched", function = checker.getservicecount)
+    registry.gauge("gossip_checks_pending", "Checks waiting for a worker", 
+                   function = lambda: checker.getprobestats()["queued"])
+    if isinstance(checker, ShardedSupervisor):
+        registry.addcollector(checker.getmetrics)
     
     try:
         resultDB = CouchDBManager("localhost", "5984", "gossip_watchresults")
+        serviceresultDB = CouchDBManager("localhost", "5984", "gossip_serviceresults")
+        resultwriter = ResultsWriter(serviceresultDB, resultDB)
         watchDB = CouchDBManager("localhost", "5984", "gossip_watchlist")
         watchDB.watchdbthreading(processserviceupdate, lock=checker.servicelock)
+        
+        if babbler is not None:
+            babbler.addhandler("RREQ", resultrequesthandler)
+        
+        if assigner is not None:
+            # registered after the handler of 'startgossip', which updates the assigner
+            babbler.addmembershiphandler(membershiphandler)
+            # catch up with member changes handled before the registration
+            membershiphandler(babbler, assigner.members)
     
-        while True:
-            
-            if not checker.isqueueempty():
-                wait = int(checker.getnextschedule() - time.time())
-            else:
-                wait = 30
-        
-            if wait <= 0:
-                checker.checkservice()
-            else:
-                resultDB.write("results", checker.getresults())
-                resultDB.compact()
-                time.sleep(wait)
-                ssldebug("%d service(s) currently watched..." % checker.getservicecount())
+        checker.policeloop(publishresults)
     finally:
         watchDB.shutdown = True
+        checker.shutdown()
 
-def start():
+def start( shards = 0, replicas = 2, metricsport = 0 ):
     try:
-        startgossip()
+        # the shards are forked first, as children of a process already running
+        # threads would inherit locks held by them
+        checker = createchecker(shards)
+        
+        if metricsport > 0:
+            StatsServer(registry, "127.0.0.1", metricsport).start()
+        
+        babbler, assigner = startgossip(replicas)
         time.sleep(2)
-        startpolicing()
+        startpolicing(checker, babbler, assigner)
     except:
         traceback.print_exc()
 
 if __name__ == '__main__':
-    start()
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--shards", dest = "shards", type = "int", default = 0,
+                      help = "number of processes checking services, 0 to check them in the main process [default: %default]")
+    parser.add_option("-r", "--replicas", dest = "replicas", type = "int", default = 2,
+                      help = "number of babblers checking each service, 0 to check all services [default: %default]")
+    parser.add_option("-m", "--metrics", dest = "metrics", type = "int", default = 0,
+                      help = "local port serving the runtime metrics over HTTP, 0 to disable [default: %default]")
+    
+    options, _ = parser.parse_args()
+    start(options.shards, options.replicas, options.metrics)
 
@@ -0,0 +1,495 @@
+'''
+Benchmarks of the scheduling code of the 'Supervisor'.
+
+The 'queues' suite is a micro-benchmark of the scheduler backends: it fills
+the indexed binary heap ('ServiceQueue') and the hierarchical timing wheel 
+('TimingWheel') with the same synthetic services, spread over one check
+interval, and simulates the policing loop for a number of ticks: every service
+due is removed and requeued one interval later. No service is actually checked,
+only the queue operations are measured. Optionally the resident memory taken
+by a number of queued 'HTTPService' objects is measured as well, reported as
+bytes per service.
+
+The 'supervisor' suite drives a complete 'Supervisor' with stub services
+whose checks succeed immediately. For every number of services it measures
+the operations per second of 'queueservice' (new and already queued services),
+'checkservice', 'removeobsoleteservices' and 'getresults', the scheduling lag
+(time between the planned and the actual start of a check) while policing for
+a while, how long the service list is locked at a time and the memory per 
+service. Every number of services is measured in a fresh process.
+
+The results can be written to a JSON file and compared with the file of an
+earlier run, so regressions between versions show up.
+
+Run 'python benchmark.py --help' for the available options.
+'''
+
+import gc
+import optparse
+import os
+import platform
+import random
+import resource
+import simplejson
+import threading
+import time
+
+from gossip.metrics import LatencyHistogram
+from gossip.stationhouse import HTTPService, Service, ServiceQueue, Supervisor, TimingWheel
+
+class StubService( Service ):
+#==============================================================================
+    """
+    Service whose check succeeds immediately. Remembers when each service was
+    checked first (after 'fired' has been cleared) to measure the scheduling lag.
+    """
+
+    __slots__ = ()
+
+    fired = {}
+
+    def _police( self ):
+    #--------------------------------------------------------------------------
+        """
+        Record the start of the check and succeed.
+        """
+
+        StubService.fired.setdefault(self.uid, time.time())
+        self.laststatus = True
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+class TimedSupervisor( Supervisor ):
+#==============================================================================
+    """
+    Supervisor measuring how long its service list is locked at a time. 
+    Nested locks of the same thread count as one.
+    """
+
+    def __init__( self, *args, **kwargs ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the supervisor and an empty histogram of lock hold times.
+        """
+
+        Supervisor.__init__(self, *args, **kwargs)
+
+        self.holds = LatencyHistogram(minimum = 0.000001, maximum = 60.0)
+        self.holder = threading.local()
+    #--------------------------------------------------------------------------
+
+    def lock( self ):
+    #--------------------------------------------------------------------------
+        """
+        Lock the service list and remember when the outermost lock was taken.
+        """
+
+        Supervisor.lock(self)
+
+        depth = getattr(self.holder, "depth", 0)
+        if depth == 0:
+            self.holder.since = time.time()
+        self.holder.depth = depth + 1
+    #--------------------------------------------------------------------------
+
+    def release( self ):
+    #--------------------------------------------------------------------------
+        """
+        Record the hold time when the outermost lock is released.
+        """
+
+        self.holder.depth -= 1
+        if self.holder.depth == 0:
+            # still locked, so recording needs no further synchronization
+            self.holds.record(time.time() - self.holder.since)
+
+        Supervisor.release(self)
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+def drainheap( queue, now ):
+#--------------------------------------------------------------------------
+    """
+    Remove all services due by 'now' from a 'ServiceQueue'.
+
+    :return: list of removed services
+    """
+
+    due = []
+    while len(queue) and queue.peek() <= now:
+        service = queue.pop()
+        due.append(service)
+
+    return due
+#--------------------------------------------------------------------------
+
+def drainwheel( wheel, now ):
+#--------------------------------------------------------------------------
+    """
+    Remove all services due by 'now' from a 'TimingWheel'.
+
+    :return: list of removed services
+    """
+
+    return wheel.popdue(now)
+#--------------------------------------------------------------------------
+
+def benchsupervisor( count, interval, duration ):
+#--------------------------------------------------------------------------
+    """
+    Run the 'supervisor' suite for one number of services.
+
+    :param count: number of synthetic services
+    :param interval: check interval of every service in seconds
+    :param duration: seconds of policing to measure the scheduling lag
+    :return: dictionary of metric name to value
+    """
+
+    results = {"services": count}
+    groups = 50
+
+    supervisor = TimedSupervisor({"STUB": StubService}, workers = 25, queuesize = 250)
+
+    # queueing new and already queued services
+    gc.collect()
+    before = getrss()
+
+    results["queueservice_per_s"] = count / queuestubs(supervisor, count, interval, groups)
+
+    gc.collect()
+    results["memory_bytes_per_service"] = float(getrss() - before) / count
+
+    results["requeueservice_per_s"] = count / queuestubs(supervisor, count, interval, groups)
+
+    # check everything overdue after queueing, then police for a while
+    supervisor.checkdueservices()
+    waitidle(supervisor)
+
+    began = time.time()
+    end = began + duration
+
+    planned = {}
+    for uid in supervisor.services.uids():
+        schedule = supervisor.services.getschedule(uid)
+        if began <= schedule < end:
+            planned[uid] = schedule
+
+    StubService.fired.clear()
+
+    while time.time() < end:
+        supervisor.checkdueservices()
+        time.sleep(max(0, min(supervisor.getnextschedule(), end) - time.time()))
+    waitidle(supervisor)
+
+    lag = LatencyHistogram(minimum = 0.0001, maximum = 600.0)
+    missed = 0
+    for uid, schedule in planned.iteritems():
+        fired = StubService.fired.get(uid)
+        if fired is None:
+            missed += 1
+        else:
+            lag.record(fired - schedule)
+
+    results["lag_checks"] = lag.count
+    results["lag_missed"] = missed
+    results["lag_p50_s"] = lag.getpercentile(50)
+    results["lag_p99_s"] = lag.getpercentile(99)
+    results["lag_max_s"] = lag.highest
+
+    # checking the next services one by one
+    calls = min(count, 10000)
+    began = time.time()
+    for _ in xrange(0, calls):
+        supervisor.checkservice()
+    results["checkservice_per_s"] = calls / max(time.time() - began, 1e-9)
+    waitidle(supervisor)
+
+    # building the results
+    began = time.time()
+    document = supervisor.getresults()
+    results["getresults_s"] = time.time() - began
+    results["getresults_bytes"] = len(document)
+
+    # every tenth service isn't announced anymore
+    for i in xrange(0, count):
+        if i % 10:
+            uid = "peer%d/service%d" % (i % groups, i)
+            supervisor.queueservice(uid, "STUB", "10.0.%d.%d" % (i / 250 % 250, i % 250), 1 + i / 62500, 
+                                    30, 200, interval)
+
+    began = time.time()
+    for group in xrange(0, groups):
+        supervisor.removeobsoleteservices("peer%d/" % group)
+    results["removeobsoleteservices_per_s"] = groups / max(time.time() - began, 1e-9)
+    results["removed"] = count - supervisor.getservicecount()
+
+    results["lockhold_count"] = supervisor.holds.count
+    results["lockhold_p50_s"] = supervisor.holds.getpercentile(50)
+    results["lockhold_p99_s"] = supervisor.holds.getpercentile(99)
+    results["lockhold_max_s"] = supervisor.holds.highest
+
+    supervisor.shutdown()
+
+    return results
+#--------------------------------------------------------------------------
+
+def compareresults( previous, current ):
+#--------------------------------------------------------------------------
+    """
+    Print the change of every metric of the 'supervisor' suite against the
+    results of an earlier run.
+
+    :param previous: results of the earlier run as written by '--output'
+    :param current: results of this run
+    """
+
+    print
+    print "compared to %s (%s)" % (previous.get("label") or "earlier run", previous.get("date"))
+    print "%10s %-30s %14s %14s %8s" % ("services", "metric", "before", "now", "change")
+
+    before = dict([(result["services"], result) for result in previous["results"]])
+    for result in current["results"]:
+        old = before.get(result["services"])
+        if old is None:
+            continue
+
+        for name in sorted(result.keys()):
+            if name == "services" or old.get(name) is None or result[name] is None:
+                continue
+
+            change = ""
+            if old[name]:
+                change = "%+7.1f%%" % ((result[name] - old[name]) * 100.0 / old[name])
+
+            print "%10d %-30s %14.6g %14.6g %8s" % (result["services"], name, old[name], result[name], change)
+#--------------------------------------------------------------------------
+
+def getrss():
+#--------------------------------------------------------------------------
+    """
+    :return: resident memory of the process in bytes, the peak if the current
+                value isn't available (outside of Linux)
+    """
+
+    try:
+        statm = open("/proc/self/statm").read().split()
+        return int(statm[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+#--------------------------------------------------------------------------
+
+def measurememory( name, queue, count, interval, start ):
+#--------------------------------------------------------------------------
+    """
+    Queue synthetic HTTP services and measure the memory they take.
+
+    Host and protocol names are built for every service anew, just like they
+    are when parsed from a service list.
+
+    :param name: name of the backend printed in the results
+    :param queue: empty scheduler instance
+    :param count: number of synthetic services
+    :param interval: check interval of every service in seconds
+    :param start: simulated unix time stamp of the first tick
+    """
+
+    random.seed(count)
+    gc.collect()
+    before = getrss()
+
+    for i in xrange(0, count):
+        uid = "peer%d/service%d" % (i % 50, i)
+        service = HTTPService()
+        service.setbasicvalues(uid, "http".upper(), "10.0.%d.%d" % (i / 250 % 250, i % 250), 80,
+                               30, 200, interval)
+        queue.push(uid, service, start + random.random() * interval)
+
+    gc.collect()
+    used = getrss() - before
+
+    print "%-6s %10d %14.1f %14.0f" % (name, count, used / 1048576.0, float(used) / count)
+#--------------------------------------------------------------------------
+
+def queuestubs( supervisor, count, interval, groups ):
+#--------------------------------------------------------------------------
+    """
+    Queue synthetic stub services, spread over 'groups' announcing peers. 
+    Every service gets a target of its own, so no checks are coalesced.
+
+    :return: seconds taken
+    """
+
+    began = time.time()
+    for i in xrange(0, count):
+        uid = "peer%d/service%d" % (i % groups, i)
+        supervisor.queueservice(uid, "STUB", "10.0.%d.%d" % (i / 250 % 250, i % 250), 1 + i / 62500, 
+                                30, 200, interval)
+
+    return max(time.time() - began, 1e-9)
+#--------------------------------------------------------------------------
+
+def run( name, queue, drain, count, interval, ticks, start ):
+#--------------------------------------------------------------------------
+    """
+    Benchmark a single scheduler backend.
+
+    :param name: name of the backend printed in the results
+    :param queue: empty scheduler instance
+    :param drain: function removing all due services from the scheduler
+    :param count: number of synthetic services
+    :param interval: check interval of every service in seconds
+    :param ticks: number of simulated seconds
+    :param start: simulated unix time stamp of the first tick
+    """
+
+    random.seed(count)
+
+    began = time.time()
+    for i in xrange(0, count):
+        uid = "peer%d/service%d" % (i % 50, i)
+        queue.push(uid, uid, start + random.random() * interval)
+    inserttime = time.time() - began
+
+    checks = 0
+    began = time.time()
+    for tick in xrange(1, ticks + 1):
+        now = start + tick
+        for service in drain(queue, now):
+            queue.push(service, service, now + interval)
+            checks += 1
+    looptime = time.time() - began
+
+    print "%-6s %10d %14.0f %14.0f %14d" % (name, count, count / inserttime,
+                                            checks / max(looptime, 1e-9), checks)
+#--------------------------------------------------------------------------
+
+def runsupervisor( count, interval, duration ):
+#--------------------------------------------------------------------------
+    """
+    Run the 'supervisor' suite for one number of services in a fresh process
+    and print a summary.
+
+    :return: dictionary of metric name to value (see 'benchsupervisor')
+    """
+
+    reader, writer = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        try:
+            os.write(writer, simplejson.dumps(benchsupervisor(count, interval, duration)))
+        finally:
+            os._exit(0)
+
+    os.close(writer)
+
+    data = ""
+    chunk = os.read(reader, 65536)
+    while chunk:
+        data += chunk
+        chunk = os.read(reader, 65536)
+    os.close(reader)
+    os.waitpid(pid, 0)
+
+    results = simplejson.loads(data)
+
+    print "%10d %10.0f %10.0f %10.0f %10.1f %10.1f %10.4f %10.4f %10.6f %10.4f %10.0f" % \
+            (count, results["queueservice_per_s"], results["requeueservice_per_s"], 
+             results["checkservice_per_s"], results["removeobsoleteservices_per_s"], 
+             1 / max(results["getresults_s"], 1e-9), results["lag_p50_s"] or 0, results["lag_p99_s"] or 0,
+             results["lockhold_p50_s"] or 0, results["lockhold_max_s"] or 0, 
+             results["memory_bytes_per_service"])
+
+    return results
+#--------------------------------------------------------------------------
+
+def waitidle( supervisor ):
+#--------------------------------------------------------------------------
+    """
+    Wait until the probe executor of the supervisor has no checks left.
+    """
+
+    while True:
+        stats = supervisor.getprobestats()
+        if stats["active"] == 0 and stats["queued"] == 0:
+            return
+        time.sleep(0.01)
+#--------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-S", "--suite", dest = "suite", type = "choice", choices = ["queues", "supervisor"],
+                      default = "queues", help = "'queues' or 'supervisor' [default: %default]")
+    parser.add_option("-n", "--services", dest = "services", default = None,
+                      help = "comma separated list of service counts [default: 1000,10000,100000 for "
+                             "'queues', 1000,10000,100000,1000000 for 'supervisor']")
+    parser.add_option("-i", "--interval", dest = "interval", type = "int", default = 180,
+                      help = "check interval in seconds [default: %default]")
+    parser.add_option("-t", "--ticks", dest = "ticks", type = "int", default = 360,
+                      help = "number of simulated seconds [default: %default]")
+    parser.add_option("-m", "--memory", dest = "memory", type = "int", default = 0,
+                      help = "measure the memory of given number of queued services (e.g. 1000000)")
+    parser.add_option("-d", "--duration", dest = "duration", type = "float", default = 10.0,
+                      help = "seconds of policing to measure the scheduling lag ('supervisor') [default: %default]")
+    parser.add_option("-o", "--output", dest = "output", default = None,
+                      help = "write the results of the 'supervisor' suite as JSON to given file")
+    parser.add_option("-c", "--compare", dest = "compare", default = None,
+                      help = "compare the results of the 'supervisor' suite with given JSON file of an earlier run")
+    parser.add_option("-l", "--label", dest = "label", default = "",
+                      help = "name of the version measured, stored with the results")
+
+    options, _ = parser.parse_args()
+    start = time.time()
+
+    if options.suite == "supervisor":
+        if options.services is None:
+            options.services = "1000,10000,100000,1000000"
+
+        print "%10s %10s %10s %10s %10s %10s %10s %10s %10s %10s %10s" % \
+                ("services", "queue/s", "requeue/s", "check/s", "remove/s", "results/s", 
+                 "lag p50", "lag p99", "lock p50", "lock max", "B/service")
+
+        report = {"label": options.label,
+                  "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "python": platform.python_version(),
+                  "platform": platform.platform(),
+                  "interval": options.interval,
+                  "duration": options.duration,
+                  "results": [runsupervisor(int(c), options.interval, options.duration) 
+                              for c in options.services.split(",")]}
+
+        if options.output:
+            output = open(options.output, "w")
+            try:
+                simplejson.dump(report, output, indent = 2, sort_keys = True)
+            finally:
+                output.close()
+
+        if options.compare:
+            compareresults(simplejson.load(open(options.compare)), report)
+    else:
+        if options.services is None:
+            options.services = "1000,10000,100000"
+
+        print "%-6s %10s %14s %14s %14s" % ("queue", "services", "inserts/s", "requeues/s", "requeues")
+
+        for count in [int(c) for c in options.services.split(",")]:
+            run("heap", ServiceQueue(), drainheap, count, options.interval, options.ticks, start)
+            run("wheel", TimingWheel(1.0, start), drainwheel, count, options.interval, options.ticks, start)
+
+        if options.memory > 0:
+            print
+            print "%-6s %10s %14s %14s" % ("queue", "services", "MB", "bytes/service")
+
+            # measure each backend in a fresh process, freed memory isn't returned
+            # to the operating system reliably
+            for name in ("heap", "wheel"):
+                pid = os.fork()
+                if pid == 0:
+                    if name == "heap":
+                        measurememory(name, ServiceQueue(), options.memory, options.interval, start)
+                    else:
+                        measurememory(name, TimingWheel(1.0, start), options.memory, options.interval, start)
+                    os._exit(0)
+                os.waitpid(pid, 0)
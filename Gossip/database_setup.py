@@ -11,18 +11,37 @@ certificate (public key) and certificate authority file are identified
 via file path.
 
 All configuration data is stored in the 'gossip_crackertable' database
-in a document with '_id' = self.
+in a document with '_id' = self. Optionally 'quorum' sets how many other
+peers must report an own service as faulty before it is declared down (2 by
+default, at most the number of babblers checking the service); the 
+verdicts are stored in the 'gossip_watchresults' database in a
+document with '_id' = verdicts.
 
 The service data set a sample service for testing purpose. All announced
 services are embodied by an 'services' object while a single service
 is an object too, consisting of the protocol used by the service, a 
 IP adress or DNS name and port number as well as a timeout in seconds. 
 A timeout describes the time span after which a service is considered as
-faulty.
+faulty. A HTTP service is alright if it answers with status 200, unless a
+'pattern' is given: either another status code or a regular expression to
+look for in the response body. HTTP services are requested with GET unless
+'method' is set to HEAD, which skips the body but isn't answered properly by
+every server (a body pattern is always checked with GET). Optionally the 
+check interval ('interval', 
+180 seconds by default) and its bounds can be set: the interval of a stable
+service grows up to 'maxinterval', after a status change the service is 
+checked again after 'mininterval' to confirm the change. Services without
+bounds are checked at their fixed interval.
 
 All service data is stored in the 'gossip_watchlist' database in a document 
 with '_id' = self.
 
+The results of the checked services are stored one document per service in
+the 'gossip_serviceresults' database, named by the URL-quoted uid of the
+service ('<peer>/<service>'). All results at once are kept in the document
+with '_id' = results of the 'gossip_watchresults' database, rewritten at most
+every 5 minutes.
+
 @author: Patrick Rockenschaub
 '''
 
@@ -15,6 +15,7 @@ import socket
 import struct
 
 from M2Crypto import SSL, X509, RSA
+from metrics import InstrumentedLock, registry
 from utils import ssldebug
 
 
@@ -31,9 +32,17 @@ class Babblemouth( threading.Thread ):
     
     Must be provided with a valid X509 certificate containing a unique common 
     name. 
+    
+    Changes of the members (see 'getmembers') are handled by a thread of their
+    own: they are collected for 'MEMBERSHIP_DELAY' seconds, so a burst of 
+    conversations starting or ending only calls the membership handlers once,
+    and the conversations never wait for the handlers.
     """
     
     CERTIFICATE_FOLDER = "certificates/known"
+    MEMBERSHIP_DELAY = 5        # seconds changes settle before the handlers are called
+    MEMBERSHIP_INTERVAL = 60    # seconds between checks without any notification
+    MEMBER_TIMEOUT = 600        # seconds a babbler not talked to remains a member
     
     def addbabbler( self, identifier, properties, certificate=None ):
     #--------------------------------------------------------------------------
@@ -94,6 +103,7 @@ class Babblemouth( threading.Thread ):
                     return
                 
                 self.babblers[ identifier ] = Conversation(self, contact, certificate)
+                self.notifymembership()
             else:
                 conversation = self.getbabbler(identifier)
                 conversation.setx509(certificate)
@@ -124,6 +134,21 @@ class Babblemouth( threading.Thread ):
 
     #--------------------------------------------------------------------------
     
+    def addmembershiphandler( self, handler ):
+    #--------------------------------------------------------------------------
+        """ 
+        Register a handler called whenever the members change (see 
+        'getmembers'). Must accept parameter 'babbler' ('Babblemouth') and 
+        'members' (list of identifiers).
+        
+        :param handler: handler method capable of taking 'Babblemouth' instance
+                        and list of identifiers
+        """
+        
+        self.membershiphandlers.append(handler)
+    
+    #--------------------------------------------------------------------------
+    
     def addrouter( self, router ):
         #--------------------------------------------------------------------------
         """ 
@@ -181,6 +206,40 @@ class Babblemouth( threading.Thread ):
         return None
 
     #-------------------------------------------------------------------------    
+    
+    def getmembers( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the identifiers of all live babblers of the babbler table and my
+        own identifier.
+        
+        As the table is shared by all babblers, they all end up with the same 
+        members, unlike the conversations going on, which differ from babbler
+        to babbler. A babbler is live if a conversation is going on with it or
+        it was talked to (respectively added to the table) within the last 
+        'MEMBER_TIMEOUT' seconds. So short disconnects don't change the members,
+        while babblers nobody can reach anymore drop out everywhere at about 
+        the same time.
+        
+        :return: sorted list of identifiers
+        """
+        
+        now = time.time()
+        
+        try:
+            self.babblelock.acquire()
+            members = [identifier for identifier, conv in self.babblers.items() 
+                       if conv.status == Conversation.GOING_ON or 
+                          now - conv.lastseen < Babblemouth.MEMBER_TIMEOUT]
+        finally:
+            self.babblelock.release()
+        
+        members.append(self.myid)
+        members.sort()
+        
+        return members
+    #--------------------------------------------------------------------------
+    
     def __init__( self, config ):
     #--------------------------------------------------------------------------
         """ 
@@ -211,11 +270,15 @@ class Babblemouth( threading.Thread ):
         self.__privatekey = RSA.load_key(self.__config["certificates"]["key"])     
         
         self.babblers = {} 
-        self.babblelock = threading.RLock()
+        self.babblelock = InstrumentedLock("gossip_babblelock", threading.RLock())
     
         self.handlers = {}
         self.router = None
         self.addrouter(self.routeviatable)
+        
+        self.membershiphandlers = []
+        self.__members = None
+        self.__membershipchanged = threading.Event()
 
         self.shutdown = False  # use to stop the main loop
 
@@ -352,6 +415,18 @@ class Babblemouth( threading.Thread ):
         
         assert self.__config["maxconv"] == 0 or self.numberofbabblers() <= self.__config["maxconv"]
         return self.__config["maxconv"] > 0 and self.numberofbabblers() == self.__config["maxconv"]
+    
+    #--------------------------------------------------------------------------
+    
+    def notifymembership( self ):
+    #--------------------------------------------------------------------------
+        """
+        Announce that the members may have changed. Invoked by conversations 
+        when they start or end. Returns at once, the membership thread calls
+        the handlers later on (see '__watchmembership').
+        """
+        
+        self.__membershipchanged.set()
 
     #--------------------------------------------------------------------------
     
@@ -409,6 +484,10 @@ class Babblemouth( threading.Thread ):
             t = threading.Thread( target = self.listen,
                                   args = [self.__config["host"][server], self.__config["port"][server]] )
             t.start()
+        
+        t = threading.Thread( target = self.__watchmembership )
+        t.setDaemon(True)
+        t.start()
             
         while not self.shutdown:
             self.__restartconversations()
@@ -451,6 +530,34 @@ class Babblemouth( threading.Thread ):
       
     #--------------------------------------------------------------------------
     
+    def __updatemembership( self ):
+    #--------------------------------------------------------------------------
+        """
+        Call the registered membership handlers if the members changed since
+        the last call.
+        """
+        
+        members = self.getmembers()
+        
+        try:
+            self.babblelock.acquire()
+            if members == self.__members:
+                return
+            self.__members = members
+        finally:
+            self.babblelock.release()
+        
+        for handler in self.membershiphandlers:
+            try:
+                handler(self, members)
+            except KeyboardInterrupt:
+                raise
+            except:
+                if self.__config["debug"]:
+                    traceback.print_exc()
+
+    #--------------------------------------------------------------------------
+    
     def __verbose( self, msg ):
     #--------------------------------------------------------------------------
         """
@@ -466,6 +573,25 @@ class Babblemouth( threading.Thread ):
 
     #--------------------------------------------------------------------------
     
+    def __watchmembership( self ):
+    #--------------------------------------------------------------------------
+        """
+        Body of the membership thread. Once notified, wait for further changes
+        to settle before updating the members, and check them regularly even
+        without notification. Terminates when 'self.shutdown' is set to 'True'.
+        """
+        
+        while not self.shutdown:
+            self.__membershipchanged.wait(Babblemouth.MEMBERSHIP_INTERVAL)
+            
+            if self.__membershipchanged.isSet():
+                time.sleep(Babblemouth.MEMBERSHIP_DELAY)
+                self.__membershipchanged.clear()
+            
+            self.__updatemembership()
+
+    #--------------------------------------------------------------------------
+    
 #==============================================================================
 
 
@@ -544,6 +670,22 @@ class Conversation( object ):
         self.id = str(self.x509.get_subject().get_entries_by_nid(13)[0].get_data())     # 13 is the nid for 'commonName'
     #--------------------------------------------------------------------------   
     
+    def __countmessage( self, direction, msgtype, size ):
+    #--------------------------------------------------------------------------
+        """
+        Count a message and its bytes in the metrics registry.
+        
+        :param direction: 'sent' or 'received'
+        :param msgtype: 4 character message type abbreviation
+        :param size: length of the message including the header
+        """
+        
+        registry.counter("gossip_messages_total", "Messages by direction and type", 
+                         direction = direction, type = msgtype).inc()
+        registry.counter("gossip_message_bytes_total", "Bytes of the messages including the header by direction and type", 
+                         direction = direction, type = msgtype).inc(size)
+    #--------------------------------------------------------------------------
+    
     def end( self ):
     #--------------------------------------------------------------------------
         """
@@ -593,6 +735,7 @@ class Conversation( object ):
         self.status = Conversation.ENDED
         self.__sendqueue = []
         self.id = None
+        self.lastseen = time.time()     # last time the conversation was going on
         
         self.babblemouth = babblemouth
         self.x509 = x509
@@ -666,6 +809,12 @@ class Conversation( object ):
     
         if len(msg) != msglen:
             return (None, None, None)
+        
+        # unknown types are counted together, they are sent by the partner
+        if msgtype.upper() in Conversation.__msghandler:
+            self.__countmessage("received", msgtype.upper(), 12 + msglen)
+        else:
+            self.__countmessage("received", "other", 12 + msglen)
     
         return ( msgtype, msgseq, msg )
 
@@ -681,6 +830,8 @@ class Conversation( object ):
         try:
             self.settimeout(30)
             self.status = Conversation.GOING_ON
+            registry.gauge("gossip_conversations_open", "Conversations going on").inc()
+            self.babblemouth.notifymembership()
         
             self.senddata("META", self.getmessagesequence(), self.babblemouth.babblerstojson())
             self.__senddata()
@@ -698,7 +849,11 @@ class Conversation( object ):
                 self.setsocket(None)
             
             ssldebug("%s:%d is in no mood to talking" % (self.contact.hosts[self.hostindex], self.contact.ports[self.hostindex]))
+            if self.status != Conversation.ENDED:
+                registry.gauge("gossip_conversations_open", "Conversations going on").dec()
+                self.lastseen = time.time()
             self.status = Conversation.ENDED
+            self.babblemouth.notifymembership()
     #--------------------------------------------------------------------------
 
     def senddata( self, msgtype, msgseq, msgdata ):
@@ -731,6 +886,7 @@ class Conversation( object ):
         while len(self.__sendqueue) > 0:
             msg = self.__sendqueue.pop(0)
             self.s.write( msg )
+            self.__countmessage("sent", msg[:4], len(msg))
         return True
         
     #--------------------------------------------------------------------------
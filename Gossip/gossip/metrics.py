@@ -0,0 +1,979 @@
+'''
+Latency histograms of the service checks and a registry of runtime metrics.
+
+The module level 'registry' collects the counters, gauges and histograms of
+all components of a process (see 'MetricsRegistry'), a 'StatsServer' exposes
+them over HTTP.
+'''
+
+import array
+import BaseHTTPServer
+import math
+import simplejson
+import threading
+import time
+import traceback
+
+class LatencyHistogram( object ):
+#==============================================================================
+    """
+    Histogram of durations with logarithmic buckets.
+    
+    >>> histogram = LatencyHistogram()
+    
+    Every power of two between 'minimum' and 'maximum' is divided into
+    'precision' buckets, so a percentile is accurate to a relative error of
+    about 2^(1/precision) - 1 (19% with the default of 4) no matter how many
+    durations have been recorded. The counters are kept in a preallocated
+    'array', the memory of a histogram is fixed (~300 bytes with the defaults).
+    Durations below 'minimum' and above 'maximum' are counted in the first
+    respectively last bucket.
+    
+    Histograms with the same layout can be merged, e.g. the histograms of all
+    services of a host into a histogram of the host.
+    
+    Not thread safe.
+    """
+    
+    def __init__( self, minimum = 0.001, maximum = 120.0, precision = 4 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty histogram.
+        
+        :param minimum: smallest duration distinguished in seconds
+        :param maximum: largest duration distinguished in seconds
+        :param precision: number of buckets per power of two
+        """
+        
+        if minimum <= 0 or maximum <= minimum or precision < 1:
+            raise ValueError("Invalid histogram layout")
+        
+        self.minimum = minimum
+        self.maximum = maximum
+        self.precision = precision
+        
+        self.buckets = array.array("I", [0]) * (int(math.ceil(math.log(maximum / minimum, 2) * precision)) + 2)
+        self.count = 0
+        self.total = 0.0
+        self.lowest = None
+        self.highest = None
+    #--------------------------------------------------------------------------
+    
+    def __getbucket( self, value ):
+    #--------------------------------------------------------------------------
+        """
+        :return: index of the bucket counting the given duration
+        """
+        
+        if value < self.minimum:
+            return 0
+        
+        index = int(math.log(value / self.minimum, 2) * self.precision) + 1
+        return min(index, len(self.buckets) - 1)
+    #--------------------------------------------------------------------------
+    
+    def __getvalue( self, index ):
+    #--------------------------------------------------------------------------
+        """
+        :return: duration representing the bucket with the given index, the
+                    geometric center of its bounds
+        """
+        
+        if index == 0:
+            return self.minimum
+        
+        return self.minimum * 2 ** ((index - 0.5) / self.precision)
+    #--------------------------------------------------------------------------
+    
+    def getmean( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: arithmetic mean of all durations, 'None' if the histogram is empty
+        """
+        
+        if self.count == 0:
+            return None
+        
+        return self.total / self.count
+    #--------------------------------------------------------------------------
+    
+    def getpercentile( self, percentile ):
+    #--------------------------------------------------------------------------
+        """
+        Return the duration below which the given percentage of all recorded
+        durations lies.
+        
+        :param percentile: percentage between 0 and 100 (e.g. 99 for p99)
+        :return: duration in seconds, 'None' if the histogram is empty
+        """
+        
+        if self.count == 0:
+            return None
+        
+        rank = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        
+        seen = 0
+        for index in xrange(0, len(self.buckets)):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        
+        return min(max(self.__getvalue(index), self.lowest), self.highest)
+    #--------------------------------------------------------------------------
+    
+    def getsummary( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: tuple of the number of durations and their p50, p95 and p99
+        """
+        
+        return (self.count, self.getpercentile(50), self.getpercentile(95), self.getpercentile(99))
+    #--------------------------------------------------------------------------
+    
+    def merge( self, other ):
+    #--------------------------------------------------------------------------
+        """
+        Add all durations recorded by another histogram to this one.
+        
+        :param other: 'LatencyHistogram' with the same layout
+        :raise ValueError: if the layouts differ
+        """
+        
+        if (self.minimum, self.maximum, self.precision) != (other.minimum, other.maximum, other.precision):
+            raise ValueError("Cannot merge histograms with different layouts")
+        
+        if other.count == 0:
+            return
+        
+        for index in xrange(0, len(self.buckets)):
+            self.buckets[index] += other.buckets[index]
+        
+        self.count += other.count
+        self.total += other.total
+        
+        if self.lowest is None or other.lowest < self.lowest:
+            self.lowest = other.lowest
+        if self.highest is None or other.highest > self.highest:
+            self.highest = other.highest
+    #--------------------------------------------------------------------------
+    
+    def record( self, value ):
+    #--------------------------------------------------------------------------
+        """
+        Add a duration.
+        
+        :param value: duration in seconds
+        """
+        
+        if value < 0.0:
+            value = 0.0
+        
+        self.buckets[self.__getbucket(value)] += 1
+        self.count += 1
+        self.total += value
+        
+        if self.count == 1:
+            self.lowest = self.highest = value
+        elif value < self.lowest:
+            self.lowest = value
+        elif value > self.highest:
+            self.highest = value
+    #--------------------------------------------------------------------------
+    
+    def tojson( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: JSON array of the number of durations and their p50, p95 and
+                    p99 in seconds
+        """
+        
+        return "[%s]" % ", ".join([tojsonnumber(v) for v in self.getsummary()])
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ProbeLatency( object ):
+#==============================================================================
+    """
+    Latencies of the checks of a service or of all services of a host.
+    
+    >>> latency = ProbeLatency()
+    
+    Keeps a 'LatencyHistogram' each for the time until the connection was
+    established ('connect'), until the first byte of the response arrived
+    ('firstbyte') and until the check was finished ('total').
+    """
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize empty histograms.
+        """
+        
+        self.connect = LatencyHistogram()
+        self.firstbyte = LatencyHistogram()
+        self.total = LatencyHistogram()
+    #--------------------------------------------------------------------------
+    
+    def merge( self, other ):
+    #--------------------------------------------------------------------------
+        """
+        Add all latencies recorded by another 'ProbeLatency' to this one.
+        """
+        
+        self.connect.merge(other.connect)
+        self.firstbyte.merge(other.firstbyte)
+        self.total.merge(other.total)
+    #--------------------------------------------------------------------------
+    
+    def record( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Add the latencies of the last check of a service. Latencies which
+        haven't been measured (e.g. the first byte if the connection failed)
+        are skipped.
+        
+        :param service: handler object which has been checked
+        """
+        
+        if service.lastconnect is not None:
+            self.connect.record(service.lastconnect)
+        if service.lastfirstbyte is not None:
+            self.firstbyte.record(service.lastfirstbyte)
+        if service.lastlatency is not None:
+            self.total.record(service.lastlatency)
+    #--------------------------------------------------------------------------
+    
+    def tojson( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: JSON object mapping 'connect', 'firstbyte' and 'total' to the
+                    summary of the according histogram (see 'LatencyHistogram.tojson')
+        """
+        
+        return '{"connect": %s, "firstbyte": %s, "total": %s}' % \
+                    (self.connect.tojson(), self.firstbyte.tojson(), self.total.tojson())
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class Counter( object ):
+#==============================================================================
+    """
+    Number of events since the start of the process, e.g. finished checks.
+    
+    >>> counter = registry.counter("gossip_probes_total", "Finished checks")
+    >>> counter.inc()
+    
+    Thread safe.
+    """
+    
+    KIND = "counter"
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the counter with 0.
+        """
+        
+        self.value = 0
+        self.__lock = threading.Lock()
+    #--------------------------------------------------------------------------
+    
+    def get( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: current value
+        """
+        
+        return self.value
+    #--------------------------------------------------------------------------
+    
+    def inc( self, amount = 1 ):
+    #--------------------------------------------------------------------------
+        """
+        Increase the counter.
+        
+        :param amount: non-negative number to add
+        """
+        
+        with self.__lock:
+            self.value += amount
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class Gauge( Counter ):
+#==============================================================================
+    """
+    Value which can go up and down, e.g. the number of open conversations.
+    
+    >>> gauge = registry.gauge("gossip_conversations_open", "Open conversations")
+    >>> gauge.inc(); gauge.dec()
+    
+    Instead of being set, the value can be read from a function whenever the
+    metrics are collected. Thread safe.
+    """
+    
+    KIND = "gauge"
+    
+    def __init__( self, function = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the gauge with 0.
+        
+        :param function: optional function without parameters returning the
+                            current value
+        """
+        
+        Counter.__init__(self)
+        self.function = function
+    #--------------------------------------------------------------------------
+    
+    def dec( self, amount = 1 ):
+    #--------------------------------------------------------------------------
+        """
+        Decrease the gauge.
+        
+        :param amount: number to subtract
+        """
+        
+        self.inc(-amount)
+    #--------------------------------------------------------------------------
+    
+    def get( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: current value, as returned by the function if there's one
+        """
+        
+        if self.function is not None:
+            return self.function()
+        
+        return self.value
+    #--------------------------------------------------------------------------
+    
+    def set( self, value ):
+    #--------------------------------------------------------------------------
+        """
+        :param value: new value of the gauge
+        """
+        
+        self.value = value
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class Histogram( object ):
+#==============================================================================
+    """
+    Thread safe 'LatencyHistogram' of durations, e.g. the scheduling lag.
+    
+    >>> histogram = registry.histogram("gossip_scheduler_lag_seconds", "Lag")
+    >>> histogram.record(0.002)
+    """
+    
+    KIND = "histogram"
+    
+    def __init__( self, minimum = 0.001, maximum = 120.0 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty histogram.
+        
+        :param minimum: smallest duration distinguished in seconds
+        :param maximum: largest duration distinguished in seconds
+        """
+        
+        self.histogram = LatencyHistogram(minimum, maximum)
+        self.__lock = threading.Lock()
+    #--------------------------------------------------------------------------
+    
+    def get( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: copy of the recorded durations as 'LatencyHistogram'
+        """
+        
+        copy = LatencyHistogram(self.histogram.minimum, self.histogram.maximum, self.histogram.precision)
+        with self.__lock:
+            copy.merge(self.histogram)
+        
+        return copy
+    #--------------------------------------------------------------------------
+    
+    def record( self, value ):
+    #--------------------------------------------------------------------------
+        """
+        Add a duration.
+        
+        :param value: duration in seconds
+        """
+        
+        with self.__lock:
+            self.histogram.record(value)
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class InstrumentedLock( object ):
+#==============================================================================
+    """
+    Lock recording how long threads wait for it and how long they hold it.
+    
+    >>> lock = InstrumentedLock("gossip_servicelock", threading.RLock())
+    
+    Wraps a 'threading.Lock' or 'threading.RLock' and records the durations
+    in the histograms '<name>_wait_seconds' and '<name>_hold_seconds' of the
+    registry. Nested acquisitions of a 'RLock' count once, from the first
+    acquisition to the last release. Can be used with 'threading.Condition'
+    like the wrapped lock; while waiting for a condition the lock isn't held.
+    
+    The bookkeeping is only touched by the thread holding the lock, and the
+    durations are recorded after releasing it, so the instrumentation hardly 
+    prolongs the time the lock is held.
+    """
+    
+    def __init__( self, name, lock = None, metrics = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the wrapper.
+        
+        :param name: prefix of the histograms' names
+        :param lock: lock to wrap, defaults to a new 'threading.Lock'
+        :param metrics: 'MetricsRegistry', defaults to the module's 'registry'
+        """
+        
+        if lock is None:
+            lock = threading.Lock()
+        if metrics is None:
+            metrics = registry
+        
+        self.lock = lock
+        self.wait = metrics.histogram("%s_wait_seconds" % name, "Time waited for the lock",
+                                      minimum = 0.00001, maximum = 60.0)
+        self.hold = metrics.histogram("%s_hold_seconds" % name, "Time the lock has been held",
+                                      minimum = 0.00001, maximum = 60.0)
+        
+        self.__depth = 0
+        self.__acquired = 0.0
+        self.__waited = 0.0
+        
+        # 'threading.Condition' uses these to release a RLock completely
+        if hasattr(lock, "_is_owned"):
+            self._is_owned = lock._is_owned
+            self._release_save = self.__releasesave
+            self._acquire_restore = self.__acquirerestore
+    #--------------------------------------------------------------------------
+    
+    def __acquirerestore( self, state ):
+    #--------------------------------------------------------------------------
+        """
+        Reacquire the lock after waiting for a condition.
+        """
+        
+        inner, depth = state
+        
+        began = time.time()
+        self.lock._acquire_restore(inner)
+        
+        self.__acquired = time.time()
+        self.__waited = self.__acquired - began
+        self.__depth = depth
+    #--------------------------------------------------------------------------
+    
+    def __enter__( self ):
+    #--------------------------------------------------------------------------
+        self.acquire()
+        return self
+    #--------------------------------------------------------------------------
+    
+    def __exit__( self, *args ):
+    #--------------------------------------------------------------------------
+        self.release()
+    #--------------------------------------------------------------------------
+    
+    def __releasesave( self ):
+    #--------------------------------------------------------------------------
+        """
+        Release the lock completely before waiting for a condition.
+        """
+        
+        depth = self.__depth
+        waited = self.__waited
+        held = time.time() - self.__acquired
+        self.__depth = 0
+        
+        inner = self.lock._release_save()
+        
+        self.wait.record(waited)
+        self.hold.record(held)
+        
+        return (inner, depth)
+    #--------------------------------------------------------------------------
+    
+    def acquire( self, blocking = 1 ):
+    #--------------------------------------------------------------------------
+        """
+        Acquire the lock like 'threading.Lock.acquire'.
+        
+        :param blocking: 'False' to return at once if the lock is held
+        :return: 'True' if the lock has been acquired
+        """
+        
+        began = time.time()
+        if not self.lock.acquire(blocking):
+            return False
+        
+        if self.__depth == 0:
+            self.__acquired = time.time()
+            self.__waited = self.__acquired - began
+        
+        self.__depth += 1
+        return True
+    #--------------------------------------------------------------------------
+    
+    def release( self ):
+    #--------------------------------------------------------------------------
+        """
+        Release the lock like 'threading.Lock.release'.
+        """
+        
+        self.__depth -= 1
+        if self.__depth > 0:
+            self.lock.release()
+            return
+        
+        waited = self.__waited
+        held = time.time() - self.__acquired
+        self.lock.release()
+        
+        self.wait.record(waited)
+        self.hold.record(held)
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class MetricsRegistry( object ):
+#==============================================================================
+    """
+    Named counters, gauges and histograms of a process.
+    
+    >>> probes = registry.counter("gossip_probes_total", "Finished checks", outcome = "up")
+    
+    A metric is identified by its name and its labels; asking for the same
+    name and labels again returns the same object, so the components look up
+    their metrics once and update them without touching the registry. Names
+    and labels follow the conventions of Prometheus, which can scrape them
+    from a 'StatsServer'.
+    
+    Collectors add metrics of other processes, e.g. the shards of a 
+    'ShardedSupervisor'. Their samples are merged with the own ones: counters
+    and gauges with the same name and labels are summed up, histograms merged.
+    """
+    
+    QUANTILES = (0.5, 0.95, 0.99)       # quantiles of the histograms in the text format
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty registry.
+        """
+        
+        self.metrics = {}
+        self.descriptions = {}
+        self.collectors = []
+        self.__lock = threading.Lock()
+    #--------------------------------------------------------------------------
+    
+    def __getmetric( self, kind, name, description, labels, *args ):
+    #--------------------------------------------------------------------------
+        """
+        Return the metric with the given name and labels, created with the
+        given arguments if it doesn't exist yet.
+        
+        :raise ValueError: if the metric exists with another kind
+        """
+        
+        key = (name, tuple(sorted(labels.iteritems())))
+        
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.__lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = kind(*args)
+                    self.descriptions.setdefault(name, description)
+        
+        if metric.KIND != kind.KIND:
+            raise ValueError("Metric '%s' is a %s" % (name, metric.KIND))
+        
+        return metric
+    #--------------------------------------------------------------------------
+    
+    def addcollector( self, collector ):
+    #--------------------------------------------------------------------------
+        """
+        Register a function adding samples to every collection.
+        
+        :param collector: function without parameters returning samples like
+                            'snapshot'
+        """
+        
+        self.collectors.append(collector)
+    #--------------------------------------------------------------------------
+    
+    def clear( self ):
+    #--------------------------------------------------------------------------
+        """
+        Forget all metrics and collectors, e.g. in a forked process reporting
+        only its own metrics.
+        """
+        
+        with self.__lock:
+            self.metrics = {}
+            self.descriptions = {}
+            self.collectors = []
+    #--------------------------------------------------------------------------
+    
+    def collect( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the own samples merged with those of the collectors. Failing 
+        collectors are skipped.
+        
+        :return: dictionary of a tuple of name and labels to a list of kind,
+                    description and value
+        """
+        
+        samples = self.snapshot()
+        for collector in list(self.collectors):
+            try:
+                samples.extend(collector())
+            except KeyboardInterrupt:
+                raise
+            except:
+                traceback.print_exc()
+        
+        merged = {}
+        for name, labels, kind, description, value in samples:
+            sample = merged.get((name, labels))
+            if sample is None:
+                merged[(name, labels)] = [kind, description, value]
+            elif kind == Histogram.KIND:
+                sample[2].merge(value)
+            else:
+                sample[2] += value
+        
+        return merged
+    #--------------------------------------------------------------------------
+    
+    def counter( self, name, description = "", **labels ):
+    #--------------------------------------------------------------------------
+        """
+        :param name: name of the metric, e.g. 'gossip_probes_total'
+        :param description: one line describing the metric
+        :param labels: values distinguishing metrics of the same name
+        :return: 'Counter' with the given name and labels
+        """
+        
+        return self.__getmetric(Counter, name, description, labels)
+    #--------------------------------------------------------------------------
+    
+    def gauge( self, name, description = "", function = None, **labels ):
+    #--------------------------------------------------------------------------
+        """
+        :param name: name of the metric, e.g. 'gossip_conversations_open'
+        :param description: one line describing the metric
+        :param function: optional function returning the value of a new gauge
+        :param labels: values distinguishing metrics of the same name
+        :return: 'Gauge' with the given name and labels
+        """
+        
+        return self.__getmetric(Gauge, name, description, labels, function)
+    #--------------------------------------------------------------------------
+    
+    def histogram( self, name, description = "", minimum = 0.001, maximum = 120.0, **labels ):
+    #--------------------------------------------------------------------------
+        """
+        :param name: name of the metric, e.g. 'gossip_scheduler_lag_seconds'
+        :param description: one line describing the metric
+        :param minimum: smallest duration distinguished by a new histogram
+        :param maximum: largest duration distinguished by a new histogram
+        :param labels: values distinguishing metrics of the same name
+        :return: 'Histogram' with the given name and labels
+        """
+        
+        return self.__getmetric(Histogram, name, description, labels, minimum, maximum)
+    #--------------------------------------------------------------------------
+    
+    def snapshot( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the current values of the own metrics. Samples can be pickled,
+        so they can be passed on to another process.
+        
+        :return: list of tuples of name, labels as sorted tuple of pairs, kind,
+                    description and value ('LatencyHistogram' for histograms)
+        """
+        
+        with self.__lock:
+            metrics = self.metrics.items()
+        
+        samples = []
+        for (name, labels), metric in metrics:
+            try:
+                value = metric.get()
+            except KeyboardInterrupt:
+                raise
+            except:
+                traceback.print_exc()
+                continue
+            
+            samples.append((name, labels, metric.KIND, self.descriptions.get(name, ""), value))
+        
+        return samples
+    #--------------------------------------------------------------------------
+    
+    def tojson( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: JSON object mapping every name to an array of objects holding
+                    the labels and the value of a metric; the value of a 
+                    histogram is an object of 'count', 'sum', 'p50', 'p95', 
+                    'p99' and 'max'
+        """
+        
+        metrics = {}
+        for (name, labels), (kind, _, value) in self.collect().iteritems():
+            if kind == Histogram.KIND:
+                value = {"count": value.count, "sum": value.total, "p50": value.getpercentile(50),
+                         "p95": value.getpercentile(95), "p99": value.getpercentile(99), "max": value.highest}
+            
+            metrics.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        
+        return simplejson.dumps(metrics, sort_keys = True)
+    #--------------------------------------------------------------------------
+    
+    def totext( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: all metrics in the text format of Prometheus, histograms as
+                    summaries of the quantiles 'MetricsRegistry.QUANTILES'
+        """
+        
+        lines = []
+        described = set()
+        
+        for (name, labels), (kind, description, value) in sorted(self.collect().iteritems()):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP %s %s" % (name, description.replace("\\", "\\\\").replace("\n", "\\n")))
+                lines.append("# TYPE %s %s" % (name, "summary" if kind == Histogram.KIND else kind))
+            
+            if kind != Histogram.KIND:
+                lines.append("%s%s %s" % (name, formatlabels(labels), formatnumber(value)))
+                continue
+            
+            if value.count > 0:
+                for quantile in MetricsRegistry.QUANTILES:
+                    lines.append("%s%s %s" % (name, formatlabels(labels + (("quantile", str(quantile)),)),
+                                              formatnumber(value.getpercentile(quantile * 100))))
+            
+            lines.append("%s_sum%s %s" % (name, formatlabels(labels), formatnumber(value.total)))
+            lines.append("%s_count%s %s" % (name, formatlabels(labels), formatnumber(value.count)))
+        
+        return "\n".join(lines) + "\n"
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class StatsServer( object ):
+#==============================================================================
+    """
+    HTTP endpoint serving the metrics of a registry for scraping.
+    
+    >>> server = StatsServer(registry, "127.0.0.1", 9100)
+    >>> server.start()
+    
+    'GET /metrics' returns the text format of Prometheus (see 
+    'MetricsRegistry.totext'), 'GET /metrics.json' the JSON format (see 
+    'MetricsRegistry.tojson'). Requests are served one after another by a 
+    daemon thread. The endpoint isn't authenticated, so it should only be 
+    bound to the loopback interface.
+    """
+    
+    def __init__( self, metrics, host = "127.0.0.1", port = 9100 ):
+    #--------------------------------------------------------------------------
+        """
+        Bind the server socket.
+        
+        :param metrics: 'MetricsRegistry' to serve
+        :param host: address to listen on
+        :param port: port to listen on, 0 for any free port
+        """
+        
+        self.server = BaseHTTPServer.HTTPServer((host, port), StatsRequestHandler)
+        self.server.metrics = metrics
+        self.thread = None
+    #--------------------------------------------------------------------------
+    
+    def getport( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: port the server listens on
+        """
+        
+        return self.server.server_address[1]
+    #--------------------------------------------------------------------------
+    
+    def start( self ):
+    #--------------------------------------------------------------------------
+        """
+        Start serving requests in a daemon thread.
+        """
+        
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    #--------------------------------------------------------------------------
+    
+    def stop( self ):
+    #--------------------------------------------------------------------------
+        """
+        Stop serving requests and close the server socket.
+        """
+        
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        
+        self.server.server_close()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class StatsRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+#==============================================================================
+    """
+    Request handler of the 'StatsServer'.
+    """
+    
+    def do_GET( self ):
+    #--------------------------------------------------------------------------
+        """
+        Answer a request for the metrics.
+        """
+        
+        path = self.path.split("?", 1)[0]
+        
+        if path in ("/", "/metrics"):
+            body = self.server.metrics.totext()
+            contenttype = "text/plain; version=0.0.4"
+        elif path == "/metrics.json":
+            body = self.server.metrics.tojson()
+            contenttype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", contenttype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    #--------------------------------------------------------------------------
+    
+    def log_message( self, format, *args ):
+    #--------------------------------------------------------------------------
+        """
+        Don't log every scrape.
+        """
+        
+        pass
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+def formatlabels( labels ):
+#--------------------------------------------------------------------------
+    """
+    :param labels: tuple of pairs of label name and value
+    :return: labels in the text format of Prometheus, e.g. '{type="META"}'
+    """
+    
+    if not labels:
+        return ""
+    
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append('%s="%s"' % (key, value))
+    
+    return "{%s}" % ",".join(pairs)
+#--------------------------------------------------------------------------
+
+def formatnumber( value ):
+#--------------------------------------------------------------------------
+    """
+    :return: given number in the text format of Prometheus
+    """
+    
+    if value is None:
+        return "NaN"
+    if isinstance(value, float):
+        return repr(value)
+    
+    return str(value)
+#--------------------------------------------------------------------------
+
+def tojsonnumber( value ):
+#--------------------------------------------------------------------------
+    """
+    :return: given number as JSON, 'null' for 'None'
+    """
+    
+    if value is None:
+        return "null"
+    if isinstance(value, float):
+        return "%.6f" % value
+    
+    return str(value)
+#--------------------------------------------------------------------------
+
+registry = MetricsRegistry()      # metrics of the whole process
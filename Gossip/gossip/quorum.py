@@ -0,0 +1,508 @@
+'''
+Exchange of check results between the babblers and verdicts agreed on by
+several vantage points.
+
+The results of the services a babbler checks are sent to the babblers who
+announced them (message type 'RSLT'). Each message holds a batch of outcomes,
+encoded as a compact JSON array of arrays:
+
+    [["service index", status, timestamp], ...]
+
+where status is 1 (up), 0 (down), -1 (not checked yet) or null (the sender
+stopped checking the service) and timestamp the time of the check in seconds.
+Outcomes not following this format are dropped. The announcing babbler combines the outcomes
+of all vantage points in a 'QuorumEvaluator'.
+
+As only changes are sent, a babbler asks for the current outcomes of all its
+services whenever a conversation starts (message type 'RREQ'), so outcomes 
+which didn't change while disconnected aren't missing.
+
+Which babblers check a service is decided by a 'ReplicaAssigner', so every
+service is checked from several vantage points, but not by every babbler.
+'''
+
+import hashlib
+import simplejson
+import threading
+
+class OutcomeBatcher( object ):
+#==============================================================================
+    """
+    Collects the changed results of a supervisor per announcing babbler until
+    they can be sent.
+    
+    >>> batcher = OutcomeBatcher()
+    
+    Only changed results are passed in (see 'Supervisor.getchangedresults'),
+    and only the latest outcome of every service is kept, so the traffic
+    depends on the number of state changes. Batches for babblers which can't
+    be reached are kept until the next 'flush'.
+    
+    Thread safe, snapshots requested by a babbler are added by its 
+    conversation thread.
+    """
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty batcher.
+        """
+        
+        self.pending = {}
+        self.__lock = threading.Lock()
+    #--------------------------------------------------------------------------
+    
+    def add( self, changes ):
+    #--------------------------------------------------------------------------
+        """
+        Add changed results. Uids must be of the form 'owner/index', owner
+        being the identifier of the announcing babbler.
+        
+        :param changes: dictionary of uid to a tuple of uid, last schedule,
+                        status and timeout, 'None' for removed services
+        """
+        
+        try:
+            self.__lock.acquire()
+            
+            for uid, result in changes.iteritems():
+                owner, _, index = uid.partition("/")
+                if not index:
+                    continue
+                
+                if result is None:
+                    outcome = (None, 0)
+                else:
+                    outcome = (result[2], int(result[1]))
+                
+                batch = self.pending.get(owner)
+                if batch is None:
+                    batch = self.pending[owner] = {}
+                batch[index] = outcome
+        finally:
+            self.__lock.release()
+    #--------------------------------------------------------------------------
+    
+    def flush( self, send ):
+    #--------------------------------------------------------------------------
+        """
+        Send a batch to every babbler with pending outcomes.
+        
+        :param send: function taking the identifier of the babbler and the
+                        encoded batch, returning 'True' if it has been sent
+        :return: number of batches sent
+        """
+        
+        try:
+            self.__lock.acquire()
+            batches = self.pending
+            self.pending = {}
+        finally:
+            self.__lock.release()
+        
+        sent = 0
+        for owner, batch in batches.iteritems():
+            if send(owner, encodeoutcomes(batch)):
+                sent += 1
+                continue
+            
+            # keep the batch, outcomes added meanwhile are newer
+            try:
+                self.__lock.acquire()
+                batch.update(self.pending.get(owner, {}))
+                self.pending[owner] = batch
+            finally:
+                self.__lock.release()
+        
+        return sent
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class QuorumEvaluator( object ):
+#==============================================================================
+    """
+    Verdict on the services of the own babbler combining the outcomes
+    reported by several vantage points.
+    
+    >>> evaluator = QuorumEvaluator(2)
+    
+    A service is only declared down if at least 'quorum' vantage points report
+    it down. Fewer reports of a fault make it suspect, while it is up as long
+    as no vantage point reports a fault. Every vantage point counts with its
+    latest outcome only.
+    
+    Given the 'ReplicaAssigner' of the own babbler, only the babblers assigned
+    to a service may report it, so a babbler can't outvote the others by 
+    reporting services it doesn't check. If fewer babblers are assigned than
+    the quorum (e.g. in a network of two babblers), all of them have to agree.
+    
+    Thread safe, outcomes arrive from the conversation threads.
+    """
+    
+    UP = "up"
+    DOWN = "down"
+    SUSPECT = "suspect"
+    UNKNOWN = "unknown"
+    
+    def __init__( self, quorum = 2, assigner = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the evaluator without any outcomes.
+        
+        :param quorum: number of vantage points needed to declare a service down
+        :param assigner: optional 'ReplicaAssigner' of the own babbler, 'None'
+                            accepts the outcomes of every babbler
+        """
+        
+        if quorum < 1:
+            raise ValueError("Quorum must be at least 1")
+        
+        self.quorum = quorum
+        self.assigner = assigner
+        self.reports = {}
+        self.verdicts = {}
+        
+        self.__changed = set()
+        self.__lock = threading.Lock()
+    #--------------------------------------------------------------------------
+    
+    def __evaluate( self, index ):
+    #--------------------------------------------------------------------------
+        """
+        Update the verdict of a service. Must be called while holding the lock.
+        """
+        
+        reports = self.reports.get(index, {})
+        down = len([status for status, _ in reports.itervalues() if not status])
+        
+        if not reports:
+            verdict = QuorumEvaluator.UNKNOWN
+        elif down >= self.__getquorum(index):
+            verdict = QuorumEvaluator.DOWN
+        elif down > 0:
+            verdict = QuorumEvaluator.SUSPECT
+        else:
+            verdict = QuorumEvaluator.UP
+        
+        if not reports:
+            self.reports.pop(index, None)
+        
+        previous = self.verdicts.get(index, QuorumEvaluator.UNKNOWN)
+        if verdict == QuorumEvaluator.UNKNOWN:
+            self.verdicts.pop(index, None)
+        else:
+            self.verdicts[index] = verdict
+        
+        if verdict != previous:
+            self.__changed.add(index)
+    #--------------------------------------------------------------------------
+    
+    def __getquorum( self, index ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of vantage points needed to declare the service down, 
+                    at most the number of babblers assigned to it
+        """
+        
+        if self.assigner is None:
+            return self.quorum
+        
+        owner = self.assigner.myid
+        replicas = self.assigner.getreplicas("%s/%s" % (owner, index), owner)
+        
+        return max(min(self.quorum, len(replicas)), 1)
+    #--------------------------------------------------------------------------
+    
+    def getchangedverdicts( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the verdicts which changed since the last call.
+        
+        :return: dictionary of service index to verdict
+        """
+        
+        try:
+            self.__lock.acquire()
+            
+            changes = {}
+            for index in self.__changed:
+                changes[index] = self.verdicts.get(index, QuorumEvaluator.UNKNOWN)
+            
+            self.__changed = set()
+            return changes
+        finally:
+            self.__lock.release()
+    #--------------------------------------------------------------------------
+    
+    def getverdict( self, index ):
+    #--------------------------------------------------------------------------
+        """
+        :param index: index of the service in the own service list
+        :return: 'QuorumEvaluator.UP', 'DOWN', 'SUSPECT' or 'UNKNOWN'
+        """
+        
+        try:
+            self.__lock.acquire()
+            
+            return self.verdicts.get(index, QuorumEvaluator.UNKNOWN)
+        finally:
+            self.__lock.release()
+    #--------------------------------------------------------------------------
+    
+    def __isassigned( self, reporter, index ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'True' if the reporter is assigned to check the service
+        """
+        
+        if self.assigner is None:
+            return True
+        
+        owner = self.assigner.myid
+        return reporter in self.assigner.getreplicas("%s/%s" % (owner, index), owner)
+    #--------------------------------------------------------------------------
+    
+    def record( self, reporter, outcomes ):
+    #--------------------------------------------------------------------------
+        """
+        Add the outcomes reported by a vantage point. Outcomes with status
+        -1 or null withdraw the reporter's previous outcome of the service.
+        Outcomes of services the reporter isn't assigned to are ignored.
+        
+        :param reporter: identifier of the reporting babbler
+        :param outcomes: list of tuples of service index, status and timestamp
+                            (see 'decodeoutcomes')
+        """
+        
+        try:
+            self.__lock.acquire()
+            
+            for index, status, timestamp in outcomes:
+                if not self.__isassigned(reporter, index):
+                    continue
+                
+                reports = self.reports.get(index)
+                if reports is None:
+                    reports = self.reports[index] = {}
+                
+                if status is None or status < 0:
+                    reports.pop(reporter, None)
+                else:
+                    previous = reports.get(reporter)
+                    if previous is not None and previous[1] > timestamp:
+                        continue        # outdated, arrived after a newer one
+                    reports[reporter] = (bool(status), timestamp)
+                
+                self.__evaluate(index)
+        finally:
+            self.__lock.release()
+    #--------------------------------------------------------------------------
+    
+    def retain( self, reporters ):
+    #--------------------------------------------------------------------------
+        """
+        Forget the outcomes of all vantage points except the given ones, e.g.
+        when babblers left the network, as well as the outcomes of services 
+        a vantage point isn't assigned to anymore.
+        
+        :param reporters: list of identifiers of the babblers to keep
+        """
+        
+        reporters = set(reporters)
+        
+        try:
+            self.__lock.acquire()
+            
+            for index in self.reports.keys():
+                reports = self.reports[index]
+                for reporter in reports.keys():
+                    if reporter not in reporters or not self.__isassigned(reporter, index):
+                        del reports[reporter]
+                
+                self.__evaluate(index)
+        finally:
+            self.__lock.release()
+    #--------------------------------------------------------------------------
+    
+    def tojson( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: JSON object '{"verdicts": {...}}' mapping the index of every
+                    service to an array of its verdict, the number of vantage
+                    points reporting it up and the number reporting it down
+        """
+        
+        try:
+            self.__lock.acquire()
+            
+            verdicts = {}
+            for index, verdict in self.verdicts.iteritems():
+                statuses = [status for status, _ in self.reports[index].itervalues()]
+                verdicts[index] = [verdict, statuses.count(True), statuses.count(False)]
+            
+            return simplejson.dumps({"verdicts": verdicts})
+        finally:
+            self.__lock.release()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+class ReplicaAssigner( object ):
+#==============================================================================
+    """
+    Assignment of services to the peers checking them.
+    
+    >>> assigner = ReplicaAssigner("peer1.example.com", 2)
+    
+    Uses rendezvous hashing: every member scores each service by the hash of
+    its id and the service's key, the 'replicas' members with the highest 
+    scores check the service. All peers compute the same assignment from the
+    same member list without any coordination, and a member joining or 
+    leaving only moves the services it gains or loses. So every service is 
+    still checked from several network locations, but not by every peer.
+    
+    The owner of a service (the peer announcing it) never checks it itself.
+    """
+    
+    def __init__( self, myid, replicas = 2 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the assigner with the own peer as the only member.
+        
+        :param myid: identifier of the own peer
+        :param replicas: number of peers checking each service
+        """
+        
+        if replicas < 1:
+            raise ValueError("At least one replica is required")
+        
+        self.myid = myid
+        self.replicas = replicas
+        self.members = [myid]
+    #--------------------------------------------------------------------------
+    
+    def getreplicas( self, key, owner = None ):
+    #--------------------------------------------------------------------------
+        """
+        :param key: string identifying the service on every peer
+        :param owner: identifier of the peer announcing the service
+        :return: list of the members checking the service, highest score first
+        """
+        
+        members = self.members
+        
+        scores = [(getscore(member, key), member) for member in members if member != owner]
+        scores.sort(reverse = True)
+        
+        return [member for _, member in scores[:self.replicas]]
+    #--------------------------------------------------------------------------
+    
+    def isassigned( self, key, owner = None ):
+    #--------------------------------------------------------------------------
+        """
+        :param key: string identifying the service on every peer
+        :param owner: identifier of the peer announcing the service
+        :return: 'True' if the own peer has to check the service
+        """
+        
+        return self.myid in self.getreplicas(key, owner)
+    #--------------------------------------------------------------------------
+    
+    def setmembers( self, members ):
+    #--------------------------------------------------------------------------
+        """
+        Replace the members services are assigned to. The own peer is always
+        a member.
+        
+        :param members: list of peer identifiers
+        :return: 'True' if the members changed
+        """
+        
+        members = sorted(set(members) | set([self.myid]))
+        if members == self.members:
+            return False
+        
+        self.members = members
+        return True
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+def decodeoutcomes( data ):
+#--------------------------------------------------------------------------
+    """
+    Decode a batch of outcomes received with a 'RSLT' message. Outcomes whose
+    index isn't a string, whose status isn't 1, 0, -1 or null or whose 
+    timestamp isn't a number are dropped.
+    
+    :param data: encoded batch (see 'encodeoutcomes')
+    :return: list of tuples of service index, status and timestamp
+    :raise ValueError: if the batch isn't a JSON array
+    """
+    
+    batch = simplejson.loads(data)
+    if not isinstance(batch, list):
+        raise ValueError("Malformed batch of outcomes")
+    
+    outcomes = []
+    for outcome in batch:
+        if not isinstance(outcome, list) or len(outcome) != 3:
+            continue
+        
+        index, status, timestamp = outcome
+        if not isinstance(index, basestring):
+            continue
+        if status is not None and (isinstance(status, bool) or not isinstance(status, (int, long)) or 
+                                   status not in (1, 0, -1)):
+            continue
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, long, float)):
+            continue
+        
+        outcomes.append((index, status, timestamp))
+    
+    return outcomes
+#--------------------------------------------------------------------------
+
+def encodeoutcomes( outcomes ):
+#--------------------------------------------------------------------------
+    """
+    Encode a batch of outcomes to be sent with a 'RSLT' message.
+    
+    :param outcomes: dictionary of service index to a tuple of status and
+                        timestamp, status 'None' if the service isn't checked
+                        anymore
+    :return: JSON array of arrays of index, status and timestamp
+    """
+    
+    return simplejson.dumps([[index, status, timestamp] for index, (status, timestamp) in outcomes.iteritems()],
+                            separators = (",", ":"))
+#--------------------------------------------------------------------------
+
+def getscore( member, key ):
+#--------------------------------------------------------------------------
+    """
+    Score of a member for a service used by the rendezvous hashing of the
+    'ReplicaAssigner'.
+    
+    :param member: identifier of the peer
+    :param key: string identifying the service on every peer
+    :return: 32 bit hash of both, the same on every peer
+    """
+    
+    value = "%s/%s" % (member, key)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+#--------------------------------------------------------------------------
@@ -0,0 +1,550 @@
+'''
+Distribution of the service checks over several worker processes.
+'''
+
+import bisect
+import hashlib
+import multiprocessing
+import signal
+import threading
+import traceback
+
+from metrics import ProbeLatency, registry
+from stationhouse import Supervisor, formatlatencies, formatresults
+
+class HashRing( object ):
+#==============================================================================
+    """
+    Consistent hash ring assigning keys to a fixed set of nodes.
+    
+    >>> ring = HashRing([0, 1, 2, 3])
+    
+    Every node is placed on the ring at 'vnodes' points, a key belongs to the
+    node of the first point following the key's hash. The assignment is the
+    same in every process and after every restart, and adding or removing a
+    node only moves the keys of that node.
+    """
+    
+    def __init__( self, nodes, vnodes = 100 ):
+    #--------------------------------------------------------------------------
+        """
+        Place the nodes on the ring.
+        
+        :param nodes: list of node names (anything convertible to a string)
+        :param vnodes: number of points per node, more points spread the keys
+                        more evenly
+        """
+        
+        if not nodes:
+            raise ValueError("At least one node is required")
+        
+        points = []
+        for node in nodes:
+            for index in range(0, vnodes):
+                points.append((gethash("%s#%d" % (node, index)), node))
+        points.sort()
+        
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+    #--------------------------------------------------------------------------
+    
+    def getnode( self, key ):
+    #--------------------------------------------------------------------------
+        """
+        :param key: string, e.g. the uid of a service
+        :return: node the key belongs to
+        """
+        
+        index = bisect.bisect(self.hashes, gethash(key)) % len(self.hashes)
+        return self.nodes[index]
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ShardedSupervisor( object ):
+#==============================================================================
+    """
+    Supervisor distributing its services over several worker processes.
+    
+    >>> sup = ShardedSupervisor(handler, shards = 4)
+    
+    A single 'Supervisor' runs in one process and so on one core. Here every
+    shard is a process of its own with a 'Supervisor' scheduling and checking
+    a partition of the services. The uids are assigned to the shards by a
+    'HashRing', so a service always ends up at the same shard.
+    
+    This object is the coordinator and offers the interface of a 'Supervisor'
+    used by the application: 'queueservice' is routed to the service's shard,
+    'removeobsoleteservices' is passed on to all shards and the results and
+    metrics of all shards are merged. Requests are sent over a pipe per shard;
+    services are queued without waiting for the shard, queries wait for the
+    answers of all shards.
+    
+    The shards are forked when the coordinator is created, so handlers and
+    options are passed on without pickling. Objects like the 'HostLimiter' are
+    copied, their limits apply per shard. Coalescing only combines services
+    of the same shard.
+    
+    As a forked child only keeps the forking thread, locks held by any other
+    thread (e.g. of the 'Resolver', a 'ConnectionPool' or the metrics 
+    registry) would never be released there and its sockets would be shared.
+    The coordinator has to be created before the process starts any thread.
+    """
+    
+    def __init__( self, handler, shards = None, vnodes = 100, **options ):
+    #--------------------------------------------------------------------------
+        """
+        Start the shard processes. Must be called before any other thread is
+        started (see above).
+        
+        :param handler: map of protocol name to according handler object
+        :param shards: number of worker processes, defaults to the number of
+                        cores
+        :param vnodes: number of points per shard on the hash ring
+        :param options: further keyword arguments of every shard's 'Supervisor'
+        """
+        
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        
+        if shards < 1:
+            raise ValueError("At least one shard is required")
+        
+        self.servicelock = threading.RLock()
+        self.servicecondition = threading.Condition(self.servicelock)
+        self.running = False
+        
+        self.ring = HashRing(range(0, shards), vnodes)
+        self.connections = []
+        self.processes = []
+        
+        for _ in range(0, shards):
+            connection, remote = multiprocessing.Pipe()
+            
+            process = multiprocessing.Process(target = runshard, args = (remote, handler, options))
+            process.daemon = True
+            process.start()
+            remote.close()
+            
+            self.connections.append(connection)
+            self.processes.append(process)
+    #--------------------------------------------------------------------------
+    
+    def __broadcast( self, command, *args ):
+    #--------------------------------------------------------------------------
+        """
+        Pass a request on to all shards and wait for their answers. The shards
+        handle the request concurrently.
+        
+        :return: list of the answers ordered by shard
+        :raise RuntimeError: if the request failed at a shard
+        """
+        
+        try:
+            self.lock()
+            
+            for connection in self.connections:
+                connection.send((command, args, True))
+            
+            # read all answers before raising, so none is left in a pipe
+            answers = [connection.recv() for connection in self.connections]
+        finally:
+            self.release()
+        
+        for shard, (succeeded, value) in enumerate(answers):
+            if not succeeded:
+                raise RuntimeError("Request failed at shard %d:\n%s" % (shard, value))
+        
+        return [value for _, value in answers]
+    #--------------------------------------------------------------------------
+    
+    def __call( self, uid, command, *args ):
+    #--------------------------------------------------------------------------
+        """
+        Pass a request on to the shard of a service and wait for the answer.
+        
+        :return: answer of the shard
+        :raise RuntimeError: if the request failed at the shard
+        """
+        
+        shard = self.getshard(uid)
+        
+        try:
+            self.lock()
+            
+            self.connections[shard].send((command, args, True))
+            return self.__receive(shard)
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def __receive( self, shard ):
+    #--------------------------------------------------------------------------
+        """
+        Wait for the answer of a shard.
+        
+        :return: value returned by the shard
+        :raise RuntimeError: if the request failed at the shard
+        """
+        
+        succeeded, value = self.connections[shard].recv()
+        if not succeeded:
+            raise RuntimeError("Request failed at shard %d:\n%s" % (shard, value))
+        
+        return value
+    #--------------------------------------------------------------------------
+    
+    def getavailability( self, uid, since = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.getavailability'.
+        """
+        
+        return self.__call(uid, "getavailability", uid, since)
+    #--------------------------------------------------------------------------
+    
+    def getchangedresults( self ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.getchangedresults', merged over all shards.
+        """
+        
+        changes = {}
+        for changed in self.__broadcast("getchangedresults"):
+            changes.update(changed)
+        
+        return changes
+    #--------------------------------------------------------------------------
+    
+    def getflapcount( self, uid, since = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.getflapcount'.
+        """
+        
+        return self.__call(uid, "getflapcount", uid, since)
+    #--------------------------------------------------------------------------
+    
+    def getgroupresults( self, groupidentifier ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.getgroupresults', merged over all shards.
+        """
+        
+        results = {}
+        for shardresults in self.__broadcast("getgroupresults", groupidentifier):
+            results.update(shardresults)
+        
+        return results
+    #--------------------------------------------------------------------------
+    
+    def gethistory( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.gethistory'.
+        """
+        
+        return self.__call(uid, "gethistory", uid)
+    #--------------------------------------------------------------------------
+    
+    def getlatencies( self, uid = None, host = None ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.getlatencies'. The latencies of a host are merged over
+        all shards.
+        """
+        
+        if uid is not None:
+            return self.__call(uid, "getlatencies", uid)
+        
+        merged = None
+        for latency in self.__broadcast("getlatencies", None, host):
+            if latency is None:
+                continue
+            if merged is None:
+                merged = ProbeLatency()
+            merged.merge(latency)
+        
+        return merged
+    #--------------------------------------------------------------------------
+    
+    def getmetrics( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the samples of the metrics registries of all shards, e.g. to be
+        added to the own registry as a collector (see 'MetricsRegistry.addcollector').
+        
+        :return: list of samples (see 'MetricsRegistry.snapshot')
+        """
+        
+        samples = []
+        for shardsamples in self.__broadcast("getmetrics"):
+            samples.extend(shardsamples)
+        
+        return samples
+    #--------------------------------------------------------------------------
+    
+    def getprobestats( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the metrics of all shards summed up (see 'Supervisor.getprobestats'),
+        additionally 'shards' is the number of shards.
+        
+        :return: dictionary of metric name to value
+        """
+        
+        stats = {"shards": len(self.connections)}
+        for shardstats in self.__broadcast("getprobestats"):
+            for name, value in shardstats.iteritems():
+                stats[name] = stats.get(name, 0) + value
+        
+        return stats
+    #--------------------------------------------------------------------------
+    
+    def getresults( self ):
+    #--------------------------------------------------------------------------
+        """
+        See 'Supervisor.getresults', merged over all shards. The latencies of
+        hosts checked by several shards are merged.
+        
+        :return: JSON string
+        """
+        
+        results = []
+        services = []
+        hosts = {}
+        
+        for shardresults, shardservices, shardhosts in self.__broadcast("getresultparts"):
+            if shardresults:
+                results.append(shardresults)
+            if shardservices:
+                services.append(shardservices)
+            
+            for host, latency in shardhosts.iteritems():
+                if host in hosts:
+                    hosts[host].merge(latency)
+                else:
+                    hosts[host] = latency
+        
+        return '{"results":[ %s ], "latencies": {"services": {%s}, "hosts": {%s}}}' % \
+                    (",".join(results), ", ".join(services), formatlatencies(hosts))
+    #--------------------------------------------------------------------------
+    
+    def getservicecount( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of services queued at all shards
+        """
+        
+        return sum(self.__broadcast("getservicecount"))
+    #--------------------------------------------------------------------------
+    
+    def getshard( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a service
+        :return: index of the shard checking the service
+        """
+        
+        return self.ring.getnode(uid)
+    #--------------------------------------------------------------------------
+    
+    def lock( self ):
+    #--------------------------------------------------------------------------
+        """
+        Lock the pipes to the shards for everyone except the own thread (RLock).
+        """
+        
+        self.servicelock.acquire()
+    #--------------------------------------------------------------------------
+    
+    def policeloop( self, onidle = None, maxwait = 1.0 ):
+    #--------------------------------------------------------------------------
+        """
+        Wait until 'shutdown' is called. The shards check their services on
+        their own.
+        
+        :param onidle: optional function without parameters called every
+                        'maxwait' seconds (e.g. to publish results)
+        :param maxwait: seconds between the calls of 'onidle'
+        """
+        
+        self.running = True
+        
+        while self.running:
+            if onidle is not None:
+                onidle()
+            
+            try:
+                self.lock()
+                
+                if self.running:
+                    self.servicecondition.wait(maxwait)
+            finally:
+                self.release()
+    #--------------------------------------------------------------------------
+    
+    def queueservice( self, uid, protocol, host, port, timeout, pattern, interval,
+                      mininterval = None, maxinterval = None, method = None ):
+    #--------------------------------------------------------------------------
+        """
+        Pass the service on to its shard, see 'Supervisor.queueservice'. Doesn't
+        wait for the shard.
+        """
+        
+        shard = self.getshard(uid)
+        
+        try:
+            self.lock()
+            
+            self.connections[shard].send(("queueservice", (uid, protocol, host, port, timeout, pattern,
+                                                           interval, mininterval, maxinterval, method), False))
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def release( self ):
+    #--------------------------------------------------------------------------
+        """
+        Release a currently hold lock of the pipes.
+        """
+        
+        self.servicelock.release()
+    #--------------------------------------------------------------------------
+    
+    def removeobsoleteservices( self, groupidentifier ):
+    #--------------------------------------------------------------------------
+        """
+        Pass the request on to all shards, see 'Supervisor.removeobsoleteservices'.
+        Doesn't wait for the shards.
+        """
+        
+        try:
+            self.lock()
+            
+            for connection in self.connections:
+                connection.send(("removeobsoleteservices", (groupidentifier,), False))
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def shutdown( self, timeout = 10.0 ):
+    #--------------------------------------------------------------------------
+        """
+        Stop 'policeloop' and the shards. Shards not terminating in time are
+        killed.
+        
+        :param timeout: maximum seconds to wait for each shard
+        """
+        
+        try:
+            self.lock()
+            
+            self.running = False
+            self.servicecondition.notifyAll()
+            
+            for connection in self.connections:
+                try:
+                    connection.send(("stop", (), False))
+                except (IOError, OSError):
+                    pass
+        finally:
+            self.release()
+        
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+def gethash( value ):
+#--------------------------------------------------------------------------
+    """
+    :param value: string, unicode is hashed as UTF-8
+    :return: 32 bit hash of the value, the same in every process
+    """
+    
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+#--------------------------------------------------------------------------
+
+def runshard( connection, handler, options ):
+#--------------------------------------------------------------------------
+    """
+    Main function of a shard process. Run a 'Supervisor' and answer the
+    requests of the coordinator until it sends 'stop' or closes the pipe.
+    
+    Requests are tuples of the name of a 'Supervisor' method, its arguments
+    and whether an answer is expected. Answers are tuples of 'True' and the
+    returned value or 'False' and the traceback of the error. The request
+    'getresultparts' returns the formatted results and service latencies and
+    the host latencies of the shard, 'getmetrics' the samples of the shard's
+    metrics registry.
+    
+    :param connection: shard's end of the pipe to the coordinator
+    :param handler: map of protocol name to according handler object
+    :param options: keyword arguments of the 'Supervisor'
+    """
+    
+    # interrupts are handled by the coordinator, which stops the shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    # the registry has been copied from the coordinator, report only the shard's own metrics
+    registry.clear()
+    
+    supervisor = Supervisor(handler, **options)
+    
+    police = threading.Thread(target = supervisor.policeloop)
+    police.setDaemon(True)
+    police.start()
+    
+    while True:
+        try:
+            command, args, answer = connection.recv()
+        except (EOFError, IOError):
+            break
+        
+        if command == "stop":
+            break
+        
+        try:
+            if command == "getresultparts":
+                try:
+                    supervisor.lock()
+                    value = (formatresults(supervisor.services), formatlatencies(supervisor.servicelatencies),
+                             supervisor.hostlatencies)
+                    if answer:
+                        connection.send((True, value))
+                finally:
+                    supervisor.release()
+            elif command == "getmetrics":
+                value = registry.snapshot()
+                if answer:
+                    connection.send((True, value))
+            else:
+                value = getattr(supervisor, command)(*args)
+                if answer:
+                    connection.send((True, value))
+        except KeyboardInterrupt:
+            raise
+        except:
+            if answer:
+                connection.send((False, traceback.format_exc()))
+            else:
+                traceback.print_exc()
+    
+    supervisor.shutdown()
+    police.join(5.0)
+    connection.close()
+#--------------------------------------------------------------------------
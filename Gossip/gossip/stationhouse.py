@@ -4,10 +4,27 @@ Created on Jul 24, 2012
 @author: Patrick Rockenschaub
 '''
 
-import heapq
+import array
+import errno
+import fcntl
+import httplib
+import math
+import os
+import Queue
+import random
+import re
+import select
+import socket
+import ssl
+import sys
 import threading
 import time
-import urllib
+import traceback
+import zlib
+
+from metrics import InstrumentedLock, ProbeLatency, registry
+
+_patterns = {}      # compiled regular expressions by pattern, see 'compilepattern'
 
 class Supervisor(object):
 #===========================================================l===================
@@ -20,28 +37,130 @@ class Supervisor(object):
     execution. Allows to define a handler for any desired protocol type. The 
     handler therefore has to be a subclass of 'services.Service' and must
     override the '_police()' method in order to work properly.
+    
+    Due services are checked by a fixed pool of worker threads (see 
+    'ProbeExecutor'), so the amount of concurrent checks is a setting of the
+    supervisor and doesn't depend on the amount of services due at a time.
+    Alternatively all checks can be driven by a single event loop thread 
+    using non-blocking sockets (see 'ProbeReactor').
+    
+    The queue of services is either an indexed binary heap ('ServiceQueue')
+    or, for very large service lists, a hierarchical timing wheel 
+    ('TimingWheel') which schedules with a resolution of one tick.
+    
+    New services are spread over their interval by a phase derived from their
+    uid, so services announced at the same time aren't checked in lockstep.
+    Optionally every following check can be shifted by a random jitter.
+    
+    If a 'HostLimiter' is given, services whose target host is currently 
+    busy are deferred instead of being checked.
+    
+    Services sharing the same protocol, host, port and pattern (e.g. announced
+    by several babblers) are coalesced: the target is checked at most once per
+    shortest interval of its services and the result is passed on to all of 
+    them (see 'ProbeTarget').
+    
+    The latest results of every service are kept in a ring buffer of fixed 
+    size (see 'ResultHistory') to query its availability and flapping. The 
+    latencies of the checks are collected per service and per host in 
+    histograms (see 'metrics.ProbeLatency').
+    
+    If an 'AdaptiveInterval' is given, the interval of every service varies
+    between the bounds of its definition depending on its stability.
+    
+    The finished checks by outcome, their durations, the scheduling lag and 
+    the contention of 'self.servicelock' are recorded in 'metrics.registry'.
     """
-
-    def __init__( self, handler ):
+    
+    THREADS = "threads"
+    REACTOR = "reactor"
+    
+    HEAP = "heap"
+    WHEEL = "wheel"
+    
+    def __init__( self, handler, workers = 10, queuesize = 100, engine = THREADS, scheduler = HEAP, tick = 1.0,
+                  spread = True, jitter = 0.0, limiter = None, coalesce = True, historysize = 100,
+                  adaptive = None ):
     #--------------------------------------------------------------------------
         """
         Initialize the service supervisor object. Registers given handler functions
         and creates a service list and a related RLock object.
         
         :param handler: map of protocol name to according handler object
+        :param workers: maximum number of services checked concurrently
+        :param queuesize: maximum number of due services waiting for a free 
+                            worker. If exceeded 'checkservice' blocks until 
+                            a worker is available again.
+        :param engine: 'Supervisor.THREADS' to check services with a pool of
+                        worker threads, 'Supervisor.REACTOR' to check them
+                        within a single event loop (handler must provide 
+                        'asyncprobe()' for that)
+        :param scheduler: 'Supervisor.HEAP' to queue services in a binary heap,
+                            'Supervisor.WHEEL' to use a timing wheel
+        :param tick: resolution of the timing wheel in seconds
+        :param spread: 'True' to schedule the first check of a new service at 
+                        its uid's phase within the interval, 'False' to check
+                        it one interval after it has been queued
+        :param jitter: maximum random shift of the following checks as a 
+                        fraction of the interval (e.g. 0.1 for +/- 10%)
+        :param limiter: optional 'HostLimiter' restricting checks per target host
+        :param coalesce: 'True' to check services with identical targets only once
+        :param historysize: number of results kept per service, 0 to keep none
+        :param adaptive: optional 'AdaptiveInterval' varying the check intervals
         """
         self.servicehandler = {}
         
         for protocol in handler:
             self.sethandler(protocol, handler[protocol])
-            
+        
         self.sethandler("UNKNOWN", Service)
         
-        self.services = []
-        self.servicelock = threading.RLock()
+        if scheduler == Supervisor.WHEEL:
+            self.services = TimingWheel(tick)
+        elif scheduler == Supervisor.HEAP:
+            self.services = ServiceQueue()
+        else:
+            raise ValueError("Unknown scheduler '%s'" % scheduler)
+        
+        self.servicelock = InstrumentedLock("gossip_servicelock", threading.RLock())
+        self.servicecondition = threading.Condition(self.servicelock)
+        self.running = False
+        
+        self.spread = spread
+        self.jitter = jitter
+        self.limiter = limiter
+        self.deferred = 0
+        self.adaptive = adaptive
+        
+        self.coalesce = coalesce
+        self.coalesced = 0
+        self.targets = {}
+        
+        self.__changed = {}
+        self.__reported = {}
+        
+        self.historysize = historysize
+        self.histories = {}
+        
+        self.servicelatencies = {}
+        self.hostlatencies = {}
+        
+        self.probecounters = {True: registry.counter("gossip_probes_total", "Finished checks by outcome", outcome = "up"),
+                              False: registry.counter("gossip_probes_total", "Finished checks by outcome", outcome = "down")}
+        self.probeduration = registry.histogram("gossip_probe_duration_seconds", "Duration of the checks")
+        self.schedulerlag = registry.histogram("gossip_scheduler_lag_seconds", 
+                                               "Delay of the most overdue service per scheduling pass",
+                                               minimum = 0.0001, maximum = 600.0)
+        
+        if engine == Supervisor.REACTOR:
+            self.executor = ProbeReactor(workers, queuesize, self.__probedone)
+        elif engine == Supervisor.THREADS:
+            self.executor = ProbeExecutor(workers, queuesize, self.__probedone)
+        else:
+            raise ValueError("Unknown probe engine '%s'" % engine)
     #--------------------------------------------------------------------------
-
-
+    
+    
     def __gethandler( self, protocol ):
     #--------------------------------------------------------------------------
         """
@@ -58,6 +177,108 @@ class Supervisor(object):
         return self.servicehandler["UNKNOWN"]()
     #--------------------------------------------------------------------------
     
+    def __adapt( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Let the interval policy choose the interval of a service which has 
+        just been checked and reschedule the service accordingly. Must be 
+        called while holding the lock, before the result is tracked.
+        
+        :param service: handler object which has been checked
+        """
+        
+        if self.adaptive is None:
+            return
+        
+        interval = self.adaptive.getinterval(service, self.__reported.get(service.uid, -1))
+        if interval == service.currentinterval:
+            return
+        
+        service.currentinterval = interval
+        
+        schedule = service.lastschedule + interval
+        self.services.reschedule(service.uid, schedule)
+        if schedule <= self.services.peek():
+            self.servicecondition.notify()      # wake up 'policeloop' earlier
+    #--------------------------------------------------------------------------
+    
+    def __dispatch( self, services, now ):
+    #--------------------------------------------------------------------------
+        """
+        Requeue services taken from the queue and return those which should be
+        handed over to the probe executor. Must be called while holding the lock.
+        
+        Services still checked are just requeued. Services whose target is 
+        currently checked or has been checked recently on behalf of another 
+        service take over the target's result. Services whose target host 
+        is busy according to the host limiter are requeued for the time the 
+        limiter asks to wait, without counting as checked.
+        
+        :param services: list of handler objects taken from the queue
+        :param now: unix time stamp of the check
+        :return: list of handler objects to check
+        """
+        
+        dispatch = []
+        for service in services:
+            target = self.targets.get(service.gettargetkey())
+            
+            if target is not None and target.isfresh(now, self.jitter, self.executor, service.currentinterval):
+                # another service checks or just checked the same target
+                self.coalesced += 1
+                service.lastschedule = now
+                service.laststatus = target.laststatus
+                self.__track(service)
+                self.__queueservice(service)
+                continue
+            
+            if not self.executor.isbusy(service.uid) and self.limiter is not None:
+                delay = self.limiter.acquire(service, now)
+                if delay > 0:
+                    self.deferred += 1
+                    self.__queueservice(service, schedule = now + delay)
+                    continue
+            
+            if target is not None:
+                target.inflight = service.uid
+            
+            service.lastschedule = now
+            self.__queueservice(service)
+            dispatch.append(service)
+        
+        return dispatch
+    #--------------------------------------------------------------------------
+    
+    def __getschedule( self, service, first ):
+    #--------------------------------------------------------------------------
+        """
+        Return the time at which the given service should be checked next.
+        
+        If spreading is enabled a service checked for the first time gets the
+        next point in time matching its phase (see 'getphase'). The following
+        checks are scheduled one (current) interval after the last one, shifted
+        by a random jitter if configured.
+        
+        :param service: handler object about to be queued
+        :param first: 'True' if the service hasn't been queued before
+        :return: scheduled time as unix time stamp
+        """
+        
+        if first and self.spread and service.interval > 0:
+            now = time.time()
+            schedule = now - now % service.interval + getphase(service.uid) * service.interval
+            if schedule < now:
+                schedule += service.interval
+            
+            return schedule
+        
+        schedule = service.lastschedule + service.currentinterval
+        if not first and self.jitter > 0:
+            schedule += random.uniform(-self.jitter, self.jitter) * service.currentinterval
+        
+        return schedule
+    #--------------------------------------------------------------------------
+    
     def __getnextservice( self ):
     #--------------------------------------------------------------------------
         """
@@ -70,7 +291,7 @@ class Supervisor(object):
         
         try:
             self.lock()
-            service = heapq.heappop(self.services)[1]
+            service = self.services.pop()
         except KeyboardInterrupt:
             raise
         except:
@@ -80,13 +301,14 @@ class Supervisor(object):
         
         return service
     #--------------------------------------------------------------------------
-
-    def __newservice( self, uid, protocol, host, port, timeout, pattern, interval ):
+    
+    def __newservice( self, uid, protocol, host, port, timeout, pattern, interval, 
+                      mininterval = None, maxinterval = None, method = None ):
     #--------------------------------------------------------------------------
         """
         Returns new handler instance for given service type already initialized with
         necessary information.
-
+        
         :param uid: unique identifier (e.g. a combination of host, port and service)
         :param protocol: abbreviation of the protocol necessary to communicate with 
                             the service
@@ -96,16 +318,60 @@ class Supervisor(object):
         :param pattern: string to look for in the service response (mismatch
                         may indicate a fault)
         :param interval: periodically check service again after given number in seconds 
-                        
+        :param mininterval: shortest interval chosen by the interval policy
+        :param maxinterval: longest interval chosen by the interval policy
+        :param method: request method of protocols knowing one (e.g. HTTP)
         """
         
         service =  self.__gethandler(protocol)
-        service.setbasicvalues(uid, protocol, host, port, timeout, pattern, interval)
+        service.setbasicvalues(uid, protocol, host, port, timeout, pattern, interval, 
+                               mininterval, maxinterval, method)
         
         return service
     #--------------------------------------------------------------------------
     
-    def __queueservice( self, service, newflag = 0 ):
+    def __probedone( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Called by the probe executor after a service has been checked.
+        
+        :param service: handler object which has been checked
+        """
+        
+        if self.limiter is not None:
+            self.limiter.release(service)
+        
+        self.probecounters[bool(service.laststatus)].inc()
+        if service.lastlatency is not None:
+            self.probeduration.record(service.lastlatency)
+        
+        try:
+            self.lock()
+            
+            target = None
+            if self.coalesce:
+                target = self.targets.get(service.gettargetkey())
+            
+            latency = self.hostlatencies.get(service.host)
+            if latency is None:
+                latency = self.hostlatencies[service.host] = ProbeLatency()
+            latency.record(service)
+            
+            if target is not None and target.inflight == service.uid:
+                target.update(service)
+                for subscriber in target.subscribers.itervalues():
+                    self.__adapt(subscriber)
+                    self.__record(subscriber)
+                    self.__track(subscriber)
+            elif service.uid in self.services:
+                self.__adapt(service)
+                self.__record(service)
+                self.__track(service)
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def __queueservice( self, service, newflag = 0, schedule = None ):
     #--------------------------------------------------------------------------
         """
         Insert given service in priority queue. A item contained by the priority 
@@ -117,40 +383,305 @@ class Supervisor(object):
         
         The service list is locked the whole time to avoid anomalies. If the service is
         already present in the service list, it is just updated without touching the 
-        scheduled time. Otherwise it's added to the list.
+        scheduled time, and only reported as changed (see 'getchangedresults') if its
+        definition differs. Otherwise it's added to the list.
         
         :param service: handler object representing a single service
         :param newflag: indicate if the service was newly added or just requeued
+        :param schedule: scheduled time overriding the regular one
         """
         try:
             self.lock()
             
-            if service in self.services:
-                pos = self.services.index(service)
-                self.services[pos][1].setbasicvalues(service.uid, service.protocol, service.host, service.port, service.timeout, service.pattern, service.interval)
-                self.services[pos][2] = newflag
+            queued = self.services.get(service.uid)
+            if queued is not None:
+                if queued.getdefinition() != service.getdefinition():
+                    self.__unsubscribe(queued)
+                    queued.setbasicvalues(service.uid, service.protocol, service.host, service.port, 
+                                          service.timeout, service.pattern, service.interval, 
+                                          service.mininterval, service.maxinterval, service.method)
+                    self.__subscribe(queued)
+                    self.__changed[service.uid] = queued
+                self.services.setflag(service.uid, newflag)
             else:
-                heapq.heappush(self.services, [(service.lastschedule + time.time()), service, newflag])   
+                self.__subscribe(service)
+                self.__track(service)
+                
+                if schedule is None:
+                    schedule = self.__getschedule(service, newflag == 1)
+                
+                if self.isqueueempty() or schedule < self.services.peek():
+                    self.servicecondition.notify()      # wake up 'policeloop' earlier
+                
+                self.services.push(service.uid, service, schedule, newflag)
         finally:
             self.release()
     #--------------------------------------------------------------------------
     
+    def __record( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Append the result of the service's last check to its history and its
+        latency histograms. Must be called while holding the lock.
+        """
+        
+        latency = self.servicelatencies.get(service.uid)
+        if latency is None:
+            latency = self.servicelatencies[service.uid] = ProbeLatency()
+        latency.record(service)
+        
+        if self.historysize <= 0:
+            return
+        
+        history = self.histories.get(service.uid)
+        if history is None:
+            history = self.histories[service.uid] = ResultHistory(self.historysize)
+        
+        history.append(service.lastschedule, service.laststatus, service.lastlatency)
+    #--------------------------------------------------------------------------
+    
+    def __subscribe( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Register the service with the probe target it shares with other 
+        services. Must be called while holding the lock.
+        """
+        
+        if not self.coalesce:
+            return
+        
+        key = service.gettargetkey()
+        target = self.targets.get(key)
+        if target is None:
+            target = self.targets[key] = ProbeTarget(key)
+        
+        target.subscribe(service)
+    #--------------------------------------------------------------------------
+    
+    def __track( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Mark the service as changed if its status differs from the one last 
+        seen. Must be called while holding the lock.
+        """
+        
+        if service.uid not in self.__reported or self.__reported[service.uid] != service.laststatus:
+            self.__reported[service.uid] = service.laststatus
+            self.__changed[service.uid] = service
+    #--------------------------------------------------------------------------
+    
+    def __unsubscribe( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Remove the service from its probe target. The target is forgotten as 
+        soon as no service uses it anymore. Must be called while holding the lock.
+        """
+        
+        if not self.coalesce:
+            return
+        
+        key = service.gettargetkey()
+        target = self.targets.get(key)
+        if target is not None and target.unsubscribe(service) == 0:
+            del self.targets[key]
+    #--------------------------------------------------------------------------
+    
     def checkservice( self ):
     #--------------------------------------------------------------------------
         """
         Check next service and requeue it.
+        
+        The service is requeued before it's handed over to the probe executor, 
+        so the service list is only locked for the queue operations. Handing 
+        over blocks as long as the executor's pending queue is full.
         """
         try:
             self.lock()
             
             service = self.__getnextservice()
-            if service is not None:
-                service.police()
-                self.__queueservice(service)
+            if service is None:
+                return
+            
+            services = self.__dispatch([service], time.time())
+        finally:
+            self.release()
+        
+        self.executor.submitbatch(services)
+    #--------------------------------------------------------------------------  
+    
+    def checkdueservices( self, now = None ):
+    #--------------------------------------------------------------------------
+        """
+        Check all services due by now and requeue them.
+        
+        All due services are taken from the queue and requeued while locking 
+        the service list only once. Afterwards they are handed over to the probe
+        executor as one batch, which blocks as long as the executor's pending
+        queue is full.
+        
+        :param now: unix time stamp, defaults to the current time
+        :return: number of services handed over to the probe executor
+        """
+        
+        if now is None:
+            now = time.time()
+        
+        try:
+            self.lock()
+            
+            if not self.isqueueempty():
+                due = self.services.peek()
+                if due <= now:
+                    self.schedulerlag.record(now - due)
+            
+            services = self.__dispatch(self.services.popdue(now), now)
+        finally:
+            self.release()
+        
+        return self.executor.submitbatch(services)
+    #--------------------------------------------------------------------------  
+    
+    def getavailability( self, uid, since = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        Return the share of successful checks among the results kept for a 
+        service.
+        
+        :param uid: unique identifier of the service
+        :param since: only consider results not older than this unix time stamp
+        :return: ratio between 0.0 and 1.0, 'None' if there is no result
+        """
+        
+        try:
+            self.lock()
+            
+            history = self.histories.get(uid)
+            if history is None:
+                return None
+            
+            return history.getavailability(since)
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def getchangedresults( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the results of all services whose status changed since the last
+        call, including services added, updated or removed in the meantime.
+        
+        :return: dictionary of uid to a tuple of uid, last schedule, status and
+                    timeout (same values as in 'getresults'), 'None' for 
+                    removed services
+        """
+        
+        try:
+            self.lock()
+            
+            changes = {}
+            for uid, service in self.__changed.iteritems():
+                if service is None:
+                    changes[uid] = None
+                else:
+                    changes[uid] = (uid, service.lastschedule, int(service.laststatus), service.timeout)
+            
+            self.__changed = {}
+            return changes
         finally:
             self.release()
     #--------------------------------------------------------------------------  
     
+    def getflapcount( self, uid, since = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        Return how often the status of a service changed among the results 
+        kept for it.
+        
+        :param uid: unique identifier of the service
+        :param since: only consider results not older than this unix time stamp
+        :return: number of status changes, 'None' if the service is unknown
+        """
+        
+        try:
+            self.lock()
+            
+            history = self.histories.get(uid)
+            if history is None:
+                return None
+            
+            return history.getflapcount(since)
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def getgroupresults( self, groupidentifier ):
+    #--------------------------------------------------------------------------
+        """
+        Return the current results of all services of a group, whether they 
+        changed or not, e.g. to bring the announcing babbler up to date.
+        
+        :param groupidentifier: prefix shared by the uids of the group
+        :return: dictionary of uid to a tuple of uid, last schedule, status and
+                    timeout (see 'getchangedresults')
+        """
+        
+        try:
+            self.lock()
+            
+            results = {}
+            for service in self.services:
+                if service.uid.startswith(groupidentifier):
+                    results[service.uid] = (service.uid, service.lastschedule, int(service.laststatus), 
+                                            service.timeout)
+            
+            return results
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def gethistory( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        Return the results kept for a service.
+        
+        :param uid: unique identifier of the service
+        :return: list of tuples of time stamp, status and latency in seconds, 
+                    oldest first
+        """
+        
+        try:
+            self.lock()
+            
+            history = self.histories.get(uid)
+            if history is None:
+                return []
+            
+            return list(history)
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def getlatencies( self, uid = None, host = None ):
+    #--------------------------------------------------------------------------
+        """
+        Return the latency histograms of a service or of all services of a host.
+        
+        :param uid: unique identifier of the service
+        :param host: host name, used if no uid is given
+        :return: 'metrics.ProbeLatency' or 'None' if nothing has been checked
+        """
+        
+        try:
+            self.lock()
+            
+            if uid is not None:
+                return self.servicelatencies.get(uid)
+            
+            return self.hostlatencies.get(host)
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
     def getnextschedule( self ):
     #--------------------------------------------------------------------------
         """
@@ -166,25 +697,49 @@ class Supervisor(object):
             if self.isqueueempty():
                 return time.time()
             
-            service = self.services[0][1]
+            return self.services.peek()
         finally:
             self.release()
+    #--------------------------------------------------------------------------  
+    
+    def getprobestats( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the current metrics of the probe executor.
         
-        return service.lastschedule + service.interval
+        :return: dictionary as returned by 'ProbeExecutor.getstats' 
+                    respectively 'ProbeReactor.getstats', additionally 
+                    'deferred' counts the checks deferred by the host limiter,
+                    'coalesced' the checks answered by another service's 
+                    check, 'targets' the number of distinct targets and 
+                    'dnsfailures' the failed lookups of host names
+        """
+        
+        stats = self.executor.getstats()
+        stats["deferred"] = self.deferred
+        stats["coalesced"] = self.coalesced
+        stats["targets"] = len(self.targets)
+        stats["dnsfailures"] = Service.resolver.getstats()["failures"]
+        
+        return stats
     #--------------------------------------------------------------------------  
     
     def getresults( self ):
     #--------------------------------------------------------------------------  
+        """
+        Return the status of all services as JSON. Next to the 'results' the
+        object holds the 'latencies' of the checks per service and per host,
+        each as count, p50, p95 and p99 in seconds of the connect, first byte
+        and total latency (see 'metrics.ProbeLatency.tojson').
+        
+        :return: JSON string
+        """
         try:
             self.lock()
             
-            results = " "
-            
-            for s in range(0,len(self.services)):
-                results += '["%s", %f, %s, %d],' % \
-                              (self.services[s][1].uid, self.services[s][1].lastschedule, int(self.services[s][1].laststatus), self.services[s][1].timeout) 
-                              
-            return '{"results":[ %s ]}' % results[:len(results)-1]
+            return '{"results":[ %s ], "latencies": {"services": {%s}, "hosts": {%s}}}' % \
+                        (formatresults(self.services), formatlatencies(self.servicelatencies), 
+                         formatlatencies(self.hostlatencies))
         finally:
             self.release()
     #--------------------------------------------------------------------------  
@@ -220,7 +775,45 @@ class Supervisor(object):
         return False
     #--------------------------------------------------------------------------
     
-    def queueservice( self, uid, protocol, host, port, timeout, pattern, interval ):
+    def policeloop( self, onidle = None, maxwait = 30 ):
+    #--------------------------------------------------------------------------
+        """
+        Check due services until 'shutdown' is called.
+        
+        After dispatching all due services the loop waits on 'self.servicecondition'
+        until the next service is due. Queueing a service which is due earlier 
+        than all others wakes the loop up immediately, so new services don't 
+        have to wait for the end of a fixed sleep.
+        
+        :param onidle: optional function without parameters called every time
+                        before the loop starts waiting (e.g. to publish results)
+        :param maxwait: maximum seconds to wait at once
+        """
+        
+        self.running = True
+        
+        while self.running:
+            self.checkdueservices()
+            
+            if onidle is not None:
+                onidle()
+            
+            try:
+                self.lock()
+                
+                if self.isqueueempty():
+                    wait = maxwait
+                else:
+                    wait = min(maxwait, self.services.peek() - time.time())
+                
+                if wait > 0 and self.running:
+                    self.servicecondition.wait(wait)
+            finally:
+                self.release()
+    #--------------------------------------------------------------------------
+    
+    def queueservice( self, uid, protocol, host, port, timeout, pattern, interval, 
+                      mininterval = None, maxinterval = None, method = None ):
     #--------------------------------------------------------------------------
         """
         Insert a service defined by an external source into the queue. Therefore a new
@@ -236,9 +829,17 @@ class Supervisor(object):
         :param pattern: string to look for in the service response (mismatch
                         may indicate a fault)
         :param interval: periodically check service again after given number in seconds 
+        :param mininterval: shortest interval chosen by the interval policy, 
+                            defaults to 'interval'
+        :param maxinterval: longest interval chosen by the interval policy,
+                            defaults to 'interval'
+        :param method: request method of protocols knowing one, e.g. GET 
+                        (default) or HEAD for HTTP
+        :raise ValueError: if the handler doesn't support the method
         """
         
-        service = self.__newservice(uid, protocol, host, port, timeout, pattern, interval)
+        service = self.__newservice(uid, protocol, host, port, timeout, pattern, interval, 
+                                    mininterval, maxinterval, method)
         self.__queueservice(service, newflag = 1)
     #--------------------------------------------------------------------------
     
@@ -266,17 +867,44 @@ class Supervisor(object):
         rmlist = []
         try:
             self.lock()
-            for service in self.services:
-                if service[1].uid.startswith(groupidentifier):
-                    if service[2] == 0:
-                        rmlist.append(service)
+            for uid in self.services.uids():
+                if uid.startswith(groupidentifier):
+                    if self.services.getflag(uid) == 0:
+                        rmlist.append(uid)
                     else:
-                        service[2] = 0
-                    
-            for service in rmlist:
-                self.services.remove(service)
+                        self.services.setflag(uid, 0)
+            
+            for uid in rmlist:
+                self.__unsubscribe(self.services.remove(uid))
+                self.__reported.pop(uid, None)
+                self.histories.pop(uid, None)
+                self.servicelatencies.pop(uid, None)
+                self.__changed[uid] = None
+            
+            if rmlist:
+                hosts = set([service.host for service in self.services])
+                for host in self.hostlatencies.keys():
+                    if host not in hosts:
+                        del self.hostlatencies[host]
+        finally:
+            self.release()
+    #--------------------------------------------------------------------------
+    
+    def shutdown( self ):
+    #--------------------------------------------------------------------------
+        """
+        Stop 'policeloop' and the worker threads of the probe executor. Checks 
+        currently running are cancelled, pending ones are discarded.
+        """
+        
+        try:
+            self.lock()
+            self.running = False
+            self.servicecondition.notifyAll()
         finally:
             self.release()
+        
+        self.executor.stop()
     #--------------------------------------------------------------------------
     
     def sethandler( self, protocol, handler ):
@@ -297,151 +925,3771 @@ class Supervisor(object):
 
 
 
-class Service( object ):
+class ServiceQueue( object ):
 #==============================================================================
     """
-    Representation of a basic service.
-
-    >>> service = Service()
-
-    This class should be used for unknown protocol types. Service handler 
-    should inherit the behavior and override the _police() method.
+    Indexed priority queue of services ordered by their next scheduled time.
+    
+    >>> queue = ServiceQueue()
+    
+    Works like a binary heap but additionally maps the uid of every queued 
+    service to its current slot in the heap. Membership tests and lookups are 
+    therefore constant, while requeueing with a new scheduled time (decrease 
+    or increase key) and removing arbitrary services is logarithmic.
+    
+    Each slot holds an immutable tuple consisting of the scheduled time, the 
+    uid, the handler object and the 'outdated' flag used by the supervisor,
+    changes replace the tuple. The queue doesn't lock itself, the owner is 
+    responsible for synchronization.
+    """
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty service queue.
+        """
+        
+        self.__heap = []
+        self.__index = {}
+    #--------------------------------------------------------------------------
+    
+    def __contains__( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'True' if a service with the given uid is queued
+        """
+        
+        return uid in self.__index
+    #--------------------------------------------------------------------------
+    
+    def __iter__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Iterate over the queued handler objects in heap order (not sorted).
+        """
+        
+        for entry in self.__heap:
+            yield entry[2]
+    #--------------------------------------------------------------------------
+    
+    def __len__( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: amount of queued services
+        """
+        
+        return len(self.__heap)
+    #--------------------------------------------------------------------------
+    
+    def __moveto( self, entry, pos ):
+    #--------------------------------------------------------------------------
+        """
+        Place entry at given heap position and update the uid index.
+        """
+        
+        self.__heap[pos] = entry
+        self.__index[entry[1]] = pos
+    #--------------------------------------------------------------------------
+    
+    def __siftdown( self, pos ):
+    #--------------------------------------------------------------------------
+        """
+        Move the entry at given position towards the leaves until the heap 
+        property is restored.
+        """
+        
+        heap = self.__heap
+        size = len(heap)
+        entry = heap[pos]
+        
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            
+            if child + 1 < size and heap[child + 1][0] < heap[child][0]:
+                child += 1
+            
+            if heap[child][0] >= entry[0]:
+                break
+            
+            self.__moveto(heap[child], pos)
+            pos = child
+        
+        self.__moveto(entry, pos)
+    #--------------------------------------------------------------------------
+    
+    def __siftup( self, pos ):
+    #--------------------------------------------------------------------------
+        """
+        Move the entry at given position towards the root until the heap 
+        property is restored.
+        
+        :return: final position of the entry
+        """
+        
+        heap = self.__heap
+        entry = heap[pos]
+        
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if heap[parent][0] <= entry[0]:
+                break
+            
+            self.__moveto(heap[parent], pos)
+            pos = parent
+        
+        self.__moveto(entry, pos)
+        return pos
+    #--------------------------------------------------------------------------
+    
+    def __restore( self, pos ):
+    #--------------------------------------------------------------------------
+        """
+        Restore the heap property for an entry whose scheduled time changed.
+        """
+        
+        if self.__siftup(pos) == pos:
+            self.__siftdown(pos)
+    #--------------------------------------------------------------------------
+    
+    def get( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        Return the queued handler object for the given uid.
+        
+        :param uid: unique identifier of the service
+        :return: handler object or 'None' if the service isn't queued
+        """
+        
+        pos = self.__index.get(uid)
+        if pos is None:
+            return None
+        
+        return self.__heap[pos][2]
+    #--------------------------------------------------------------------------
+    
+    def getflag( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a queued service
+        :return: 'outdated' flag of the service
+        :raise KeyError: if the service isn't queued
+        """
+        
+        return self.__heap[self.__index[uid]][3]
+    #--------------------------------------------------------------------------
+    
+    def getschedule( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a queued service
+        :return: scheduled time of the service as unix time stamp
+        :raise KeyError: if the service isn't queued
+        """
+        
+        return self.__heap[self.__index[uid]][0]
+    #--------------------------------------------------------------------------
+    
+    def peek( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: scheduled time of the first service in row
+        :raise IndexError: if the queue is empty
+        """
+        
+        return self.__heap[0][0]
+    #--------------------------------------------------------------------------
+    
+    def pop( self ):
+    #--------------------------------------------------------------------------
+        """
+        Remove and return the service scheduled next.
+        
+        :return: handler object of the first service in row
+        :raise IndexError: if the queue is empty
+        """
+        
+        entry = self.__heap[0]
+        self.remove(entry[1])
+        
+        return entry[2]
+    #--------------------------------------------------------------------------
+    
+    def popdue( self, now ):
+    #--------------------------------------------------------------------------
+        """
+        Remove all services scheduled for the given time or earlier.
+        
+        :param now: unix time stamp
+        :return: list of handler objects in order of their scheduled time
+        """
+        
+        services = []
+        while self.__heap and self.__heap[0][0] <= now:
+            services.append(self.pop())
+        
+        return services
+    #--------------------------------------------------------------------------
+    
+    def push( self, uid, service, schedule, flag = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        Insert a service into the queue. If the uid is already queued, the 
+        handler object, scheduled time and flag of the existing entry are 
+        replaced instead.
+        
+        :param uid: unique identifier of the service
+        :param service: handler object representing the service
+        :param schedule: next scheduled time as unix time stamp
+        :param flag: 'outdated' flag maintained by the supervisor
+        """
+        
+        pos = self.__index.get(uid)
+        if pos is not None:
+            self.__heap[pos] = (schedule, uid, service, flag)
+            self.__restore(pos)
+            return
+        
+        self.__heap.append((schedule, uid, service, flag))
+        self.__siftup(len(self.__heap) - 1)
+    #--------------------------------------------------------------------------
+    
+    def remove( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        Remove the service with given uid from the queue.
+        
+        :param uid: unique identifier of the service
+        :return: removed handler object
+        :raise KeyError: if the service isn't queued
+        """
+        
+        pos = self.__index.pop(uid)
+        entry = self.__heap[pos]
+        last = self.__heap.pop()
+        
+        if pos < len(self.__heap):
+            self.__moveto(last, pos)
+            self.__restore(pos)
+        
+        return entry[2]
+    #--------------------------------------------------------------------------
+    
+    def reschedule( self, uid, schedule ):
+    #--------------------------------------------------------------------------
+        """
+        Change the scheduled time of a queued service (decrease or increase key).
+        
+        :param uid: unique identifier of the service
+        :param schedule: new scheduled time as unix time stamp
+        :raise KeyError: if the service isn't queued
+        """
+        
+        pos = self.__index[uid]
+        self.__heap[pos] = (schedule,) + self.__heap[pos][1:]
+        self.__restore(pos)
+    #--------------------------------------------------------------------------
+    
+    def setflag( self, uid, flag ):
+    #--------------------------------------------------------------------------
+        """
+        Set the 'outdated' flag of a queued service.
+        
+        :param uid: unique identifier of the service
+        :param flag: new flag value
+        :raise KeyError: if the service isn't queued
+        """
+        
+        pos = self.__index[uid]
+        self.__heap[pos] = self.__heap[pos][:3] + (flag,)
+    #--------------------------------------------------------------------------
+    
+    def uids( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: list of all queued uids
+        """
+        
+        return self.__index.keys()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class TimingWheel( object ):
+#==============================================================================
+    """
+    Hierarchical timing wheel of services ordered by their next scheduled time.
+    
+    >>> wheel = TimingWheel(1.0)
+    
+    Offers the same interface as 'ServiceQueue'. Time is divided into ticks of
+    a fixed length. The first level holds one slot per tick for the next 256 
+    ticks, each of the three further levels holds 64 slots covering 64 times 
+    the span of a slot of the level below. Services scheduled even later are 
+    kept in an overflow slot.
+    
+    Inserting and removing a service is constant. When the wheel advances to
+    a new tick, the slot of that tick expires as a whole and the slots of the
+    higher levels are cascaded down once the lower level wrapped around. A
+    service never expires before its scheduled time but up to one tick later.
+    
+    Each service is stored as an immutable tuple consisting of the scheduled 
+    time, the uid, the handler object, the 'outdated' flag and the slot it's
+    contained in, changes replace the tuple. The wheel doesn't lock itself, 
+    the owner is responsible for synchronization.
+    """
+    
+    LEVELS = ((0, 256), (8, 64), (14, 64), (20, 64))    # (shift, slots) per level
+    
+    def __init__( self, tick = 1.0, now = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty timing wheel.
+        
+        :param tick: length of a tick in seconds
+        :param now: unix time stamp the wheel starts at, defaults to current time
+        """
+        
+        if tick <= 0:
+            raise ValueError("Tick must be a positive number of seconds")
+        
+        if now is None:
+            now = time.time()
+        
+        self.tick = float(tick)
+        self.__current = int(now / self.tick)
+        self.__entries = {}
+        self.__ready = {}
+        self.__overflow = {}
+        self.__wheels = [[{} for _ in range(0, slots)] for _, slots in TimingWheel.LEVELS]
+        
+        # number of services in the first level, allows to skip empty ticks
+        self.__firstlevel = set(id(slot) for slot in self.__wheels[0])
+        self.__firstlevelcount = 0
+    #--------------------------------------------------------------------------
+    
+    def __contains__( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'True' if a service with the given uid is queued
+        """
+        
+        return uid in self.__entries
+    #--------------------------------------------------------------------------
+    
+    def __iter__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Iterate over the queued handler objects (not sorted).
+        """
+        
+        for entry in self.__entries.itervalues():
+            yield entry[2]
+    #--------------------------------------------------------------------------
+    
+    def __len__( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: amount of queued services
+        """
+        
+        return len(self.__entries)
+    #--------------------------------------------------------------------------
+    
+    def __advance( self, target ):
+    #--------------------------------------------------------------------------
+        """
+        Advance the wheel tick by tick up to the given tick. Expired slots are 
+        moved to the ready slot, higher levels are cascaded when wrapping.
+        
+        :param target: tick number to advance to
+        """
+        
+        if len(self.__entries) == len(self.__ready):
+            self.__current = max(self.__current, target)
+            return
+        
+        while self.__current < target:
+            if self.__firstlevelcount == 0:
+                # nothing expires before the first level wraps around
+                self.__current = min(target, self.__current | 0xff)
+                if self.__current == target:
+                    return
+            
+            self.__current += 1
+            current = self.__current
+            
+            if current & 0xff == 0:
+                for level in range(1, len(TimingWheel.LEVELS)):
+                    shift, slots = TimingWheel.LEVELS[level]
+                    index = (current >> shift) & (slots - 1)
+                    self.__cascade(self.__wheels[level][index])
+                    
+                    if index != 0:
+                        break
+                else:
+                    self.__cascade(self.__overflow)
+            
+            self.__cascade(self.__wheels[0][current & 0xff])
+    #--------------------------------------------------------------------------
+    
+    def __cascade( self, slot ):
+    #--------------------------------------------------------------------------
+        """
+        Empty the given slot and place its services again relative to the 
+        current tick.
+        """
+        
+        if not slot:
+            return
+        
+        if id(slot) in self.__firstlevel:
+            self.__firstlevelcount -= len(slot)
+        
+        entries = slot.values()
+        slot.clear()
+        
+        for entry in entries:
+            self.__place(entry)
+    #--------------------------------------------------------------------------
+    
+    def __expiry( self, schedule ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of the tick in which a service scheduled for the given
+                    time expires
+        """
+        
+        return int(math.ceil(schedule / self.tick))
+    #--------------------------------------------------------------------------
+    
+    def __place( self, entry ):
+    #--------------------------------------------------------------------------
+        """
+        Put an entry into the slot matching its scheduled time. The entry is
+        replaced by one referring to the new slot.
+        """
+        
+        expiry = self.__expiry(entry[0])
+        delta = expiry - self.__current
+        
+        if delta <= 0:
+            slot = self.__ready
+        else:
+            slot = self.__overflow
+            for level, (shift, slots) in enumerate(TimingWheel.LEVELS):
+                if delta < (slots << shift):
+                    slot = self.__wheels[level][(expiry >> shift) & (slots - 1)]
+                    break
+        
+        entry = entry[:4] + (slot,)
+        slot[entry[1]] = entry
+        self.__entries[entry[1]] = entry
+        
+        if id(slot) in self.__firstlevel:
+            self.__firstlevelcount += 1
+    #--------------------------------------------------------------------------
+    
+    def __unplace( self, entry ):
+    #--------------------------------------------------------------------------
+        """
+        Take an entry out of its slot.
+        """
+        
+        del entry[4][entry[1]]
+        
+        if id(entry[4]) in self.__firstlevel:
+            self.__firstlevelcount -= 1
+    #--------------------------------------------------------------------------
+    
+    def get( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        Return the queued handler object for the given uid.
+        
+        :param uid: unique identifier of the service
+        :return: handler object or 'None' if the service isn't queued
+        """
+        
+        entry = self.__entries.get(uid)
+        if entry is None:
+            return None
+        
+        return entry[2]
+    #--------------------------------------------------------------------------
+    
+    def getflag( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a queued service
+        :return: 'outdated' flag of the service
+        :raise KeyError: if the service isn't queued
+        """
+        
+        return self.__entries[uid][3]
+    #--------------------------------------------------------------------------
+    
+    def getschedule( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a queued service
+        :return: scheduled time of the service as unix time stamp
+        :raise KeyError: if the service isn't queued
+        """
+        
+        return self.__entries[uid][0]
+    #--------------------------------------------------------------------------
+    
+    def peek( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the time at which the next service expires. Services already 
+        expired report their scheduled time.
+        
+        :return: unix time stamp
+        :raise IndexError: if the wheel is empty
+        """
+        
+        if not self.__entries:
+            raise IndexError("peek into empty timing wheel")
+        
+        if self.__ready:
+            return min(entry[0] for entry in self.__ready.itervalues())
+        
+        # the first occupied slot of each level holds the earliest service of 
+        # that level, but a higher level may still expire earlier than a 
+        # lower one as it's cascaded only at its slot boundaries
+        candidates = [entry[0] for entry in self.__overflow.itervalues()]
+        
+        for level, (shift, slots) in enumerate(TimingWheel.LEVELS):
+            for i in range(1, slots + 1):
+                slot = self.__wheels[level][((self.__current >> shift) + i) & (slots - 1)]
+                if slot:
+                    candidates.append(min(entry[0] for entry in slot.itervalues()))
+                    break
+        
+        return self.__expiry(min(candidates)) * self.tick
+    #--------------------------------------------------------------------------
+    
+    def pop( self ):
+    #--------------------------------------------------------------------------
+        """
+        Remove and return an expired service. If no service has expired yet, 
+        the wheel advances to the tick of the next service.
+        
+        :return: handler object of a service in row
+        :raise IndexError: if the wheel is empty
+        """
+        
+        self.__advance(int(time.time() / self.tick))
+        
+        if not self.__ready:
+            self.__advance(self.__expiry(self.peek()))
+        
+        uid, entry = self.__ready.popitem()
+        del self.__entries[uid]
+        
+        return entry[2]
+    #--------------------------------------------------------------------------
+    
+    def popdue( self, now ):
+    #--------------------------------------------------------------------------
+        """
+        Advance the wheel to the given time and remove all expired services.
+        
+        :param now: unix time stamp
+        :return: list of handler objects
+        """
+        
+        self.__advance(int(now / self.tick))
+        
+        services = []
+        for uid, entry in self.__ready.iteritems():
+            del self.__entries[uid]
+            services.append(entry[2])
+        
+        self.__ready.clear()
+        return services
+    #--------------------------------------------------------------------------
+    
+    def push( self, uid, service, schedule, flag = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        Insert a service into the wheel. If the uid is already queued, the 
+        handler object, scheduled time and flag of the existing entry are 
+        replaced instead.
+        
+        :param uid: unique identifier of the service
+        :param service: handler object representing the service
+        :param schedule: next scheduled time as unix time stamp
+        :param flag: 'outdated' flag maintained by the supervisor
+        """
+        
+        entry = self.__entries.get(uid)
+        if entry is not None:
+            self.__unplace(entry)
+        
+        self.__place((schedule, uid, service, flag, None))
+    #--------------------------------------------------------------------------
+    
+    def remove( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        Remove the service with given uid from the wheel.
+        
+        :param uid: unique identifier of the service
+        :return: removed handler object
+        :raise KeyError: if the service isn't queued
+        """
+        
+        entry = self.__entries.pop(uid)
+        self.__unplace(entry)
+        
+        return entry[2]
+    #--------------------------------------------------------------------------
+    
+    def reschedule( self, uid, schedule ):
+    #--------------------------------------------------------------------------
+        """
+        Change the scheduled time of a queued service.
+        
+        :param uid: unique identifier of the service
+        :param schedule: new scheduled time as unix time stamp
+        :raise KeyError: if the service isn't queued
+        """
+        
+        entry = self.__entries[uid]
+        self.__unplace(entry)
+        self.__place((schedule,) + entry[1:])
+    #--------------------------------------------------------------------------
+    
+    def setflag( self, uid, flag ):
+    #--------------------------------------------------------------------------
+        """
+        Set the 'outdated' flag of a queued service.
+        
+        :param uid: unique identifier of the service
+        :param flag: new flag value
+        :raise KeyError: if the service isn't queued
+        """
+        
+        entry = self.__entries[uid][:3] + (flag, self.__entries[uid][4])
+        self.__entries[uid] = entry
+        entry[4][uid] = entry
+    #--------------------------------------------------------------------------
+    
+    def uids( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: list of all queued uids
+        """
+        
+        return self.__entries.keys()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class AdaptiveInterval( object ):
+#==============================================================================
+    """
+    Adapts the check interval of a service to the stability of its status.
+    
+    >>> adaptive = AdaptiveInterval(5, 2.0)
+    
+    A service which has been alright for 'stableafter' checks in a row is 
+    checked less and less often, its interval grows by 'factor' with every 
+    further check up to the service's 'maxinterval'. As soon as the status 
+    changes, the service is checked again after its 'mininterval' to confirm 
+    the change, afterwards it falls back to its regular interval. Faulty
+    services are always checked at their regular interval. Services without
+    bounds (both default to the regular interval) keep their interval.
+    
+    Not thread safe, the supervisor locks it together with the service list.
+    """
+    
+    def __init__( self, stableafter = 5, factor = 2.0 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the interval policy.
+        
+        :param stableafter: number of equal results after which a service is
+                            considered as stable
+        :param factor: growth of the interval per check of a stable service
+        """
+        
+        if stableafter < 1 or factor < 1:
+            raise ValueError("Interval policy must not shrink intervals")
+        
+        self.stableafter = stableafter
+        self.factor = factor
+    #--------------------------------------------------------------------------
+    
+    def getinterval( self, service, previous ):
+    #--------------------------------------------------------------------------
+        """
+        Return the interval until the next check of a service which has just
+        been checked and count its stable results.
+        
+        :param service: handler object which has been checked
+        :param previous: status of the service before the check
+        :return: interval in seconds
+        """
+        
+        if previous != -1 and service.laststatus != previous:
+            # confirm the change as soon as possible
+            service.stablecount = 0
+            return service.mininterval
+        
+        service.stablecount += 1
+        
+        if service.laststatus is not True or service.stablecount < self.stableafter:
+            return service.interval
+        
+        return min(service.maxinterval, max(service.interval, service.currentinterval) * self.factor)
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class HostLimiter( object ):
+#==============================================================================
+    """
+    Limits the checks per target host.
+    
+    >>> limiter = HostLimiter(2, 1.0, 5)
+    
+    Every target host has a token bucket refilled at a fixed rate and a cap on
+    the number of checks running at the same time. A check may only start if
+    a token is available and the cap isn't reached yet. Optionally the same 
+    limits are enforced for the /24 network of IPv4 addresses as well.
+    
+    Thread safe, as checks are started by the supervisor but finished by the
+    threads of the probe executor.
+    """
+    
+    def __init__( self, maxinflight = 2, rate = 1.0, burst = 5, subnet = False ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the host limiter.
+        
+        :param maxinflight: maximum number of concurrent checks per host
+        :param rate: number of checks per second allowed per host on average
+        :param burst: number of checks allowed per host at once after being idle
+        :param subnet: 'True' to apply the limits to /24 networks as well
+        """
+        
+        if maxinflight < 1 or rate <= 0 or burst < 1:
+            raise ValueError("Limits must allow at least one check")
+        
+        self.maxinflight = maxinflight
+        self.rate = float(rate)
+        self.burst = burst
+        self.subnet = subnet
+        
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+        self.__acquired = 0
+    #--------------------------------------------------------------------------
+    
+    def __getkeys( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        :return: list of keys the limits apply to for the given service
+        """
+        
+        keys = [service.host]
+        
+        if self.subnet:
+            octets = service.host.split(".")
+            if len(octets) == 4 and all(octet.isdigit() for octet in octets):
+                keys.append("%s.0/24" % ".".join(octets[:3]))
+        
+        return keys
+    #--------------------------------------------------------------------------
+    
+    def __prune( self, now ):
+    #--------------------------------------------------------------------------
+        """
+        Forget buckets without checks running which are completely refilled.
+        """
+        
+        for key, bucket in self.__buckets.items():
+            if not bucket[2] and bucket[0] + (now - bucket[1]) * self.rate >= self.burst:
+                del self.__buckets[key]
+    #--------------------------------------------------------------------------
+    
+    def acquire( self, service, now = None ):
+    #--------------------------------------------------------------------------
+        """
+        Try to start a check of the given service. If allowed, a token is taken
+        and the check counts as running until 'release' is called.
+        
+        :param service: handler object which should be checked
+        :param now: unix time stamp, defaults to the current time
+        :return: 0 if the check may start, otherwise seconds to wait before 
+                    trying again
+        """
+        
+        if now is None:
+            now = time.time()
+        
+        with self.__lock:
+            self.__acquired += 1
+            if self.__acquired % 1000 == 0:
+                self.__prune(now)
+            
+            buckets = []
+            delay = 0
+            
+            for key in self.__getkeys(service):
+                bucket = self.__buckets.get(key)
+                if bucket is None:
+                    bucket = self.__buckets[key] = [float(self.burst), now, set()]
+                
+                # bucket: [tokens, last refill, uids of running checks]
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                
+                if len(bucket[2]) >= self.maxinflight:
+                    delay = max(delay, 1.0 / self.rate)
+                elif bucket[0] < 1:
+                    delay = max(delay, (1 - bucket[0]) / self.rate)
+                
+                buckets.append(bucket)
+            
+            if delay > 0:
+                return delay
+            
+            for bucket in buckets:
+                bucket[0] -= 1
+                bucket[2].add(service.uid)
+        
+        return 0
+    #--------------------------------------------------------------------------
+    
+    def release( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Mark the check of the given service as finished.
+        
+        :param service: handler object which has been checked
+        """
+        
+        with self.__lock:
+            for key in self.__getkeys(service):
+                bucket = self.__buckets.get(key)
+                if bucket is not None:
+                    bucket[2].discard(service.uid)
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ProbeTarget( object ):
+#==============================================================================
+    """
+    Physical target shared by services with identical protocol, host, port 
+    and pattern.
+    
+    >>> target = ProbeTarget(("HTTP", "www.example.com", "80", "200"))
+    
+    Keeps track of the services using the target, the shortest of their 
+    intervals and the result of the last check. Only one of the services 
+    checks the target at a time, the result is passed on to all others.
+    Not thread safe, the supervisor locks it together with the service list.
+    """
+    
+    def __init__( self, key ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize a target without services.
+        
+        :param key: target key as returned by 'Service.gettargetkey'
+        """
+        
+        self.key = key
+        self.subscribers = {}
+        self.interval = None
+        self.inflight = None
+        self.lastprobe = None
+        self.laststatus = -1
+    #--------------------------------------------------------------------------
+    
+    def isfresh( self, now, jitter, executor, interval = None ):
+    #--------------------------------------------------------------------------
+        """
+        Return whether a service of this target can take over the target's 
+        result instead of checking it again. This is the case while another 
+        service is checking the target or if the last check is younger than the
+        shortest interval (reduced by the jitter).
+        
+        :param now: unix time stamp
+        :param jitter: jitter of the supervisor as a fraction of the interval
+        :param executor: probe executor, used to verify a check is still running
+        :param interval: interval of the requesting service, if shorter than 
+                            the target's one (e.g. to confirm a status change)
+        :return: 'True' if the result can be taken over
+        """
+        
+        if self.inflight is not None:
+            if executor.isbusy(self.inflight):
+                return True
+            
+            self.inflight = None
+        
+        if self.lastprobe is None:
+            return False
+        
+        if interval is None or interval > self.interval:
+            interval = self.interval
+        
+        return now - self.lastprobe < interval * (1 - jitter)
+    #--------------------------------------------------------------------------
+    
+    def subscribe( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Add a service to this target.
+        
+        :param service: handler object
+        """
+        
+        self.subscribers[service.uid] = service
+        if self.interval is None or service.interval < self.interval:
+            self.interval = service.interval
+    #--------------------------------------------------------------------------
+    
+    def unsubscribe( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Remove a service from this target.
+        
+        :param service: handler object
+        :return: number of services still using the target
+        """
+        
+        self.subscribers.pop(service.uid, None)
+        
+        if self.subscribers:
+            self.interval = min(s.interval for s in self.subscribers.itervalues())
+        
+        return len(self.subscribers)
+    #--------------------------------------------------------------------------
+    
+    def update( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Take over the result of a finished check and pass it on to all services
+        of this target.
+        
+        :param service: handler object which checked the target
+        """
+        
+        self.inflight = None
+        self.lastprobe = service.lastschedule
+        self.laststatus = service.laststatus
+        
+        for subscriber in self.subscribers.itervalues():
+            subscriber.laststatus = service.laststatus
+            subscriber.lastconnect = service.lastconnect
+            subscriber.lastfirstbyte = service.lastfirstbyte
+            subscriber.lastlatency = service.lastlatency
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ResultHistory( object ):
+#==============================================================================
+    """
+    Fixed-size ring buffer of the latest check results of a service.
+    
+    >>> history = ResultHistory(1000)
+    
+    Every sample consists of the unix time stamp of the check, its status and
+    its latency. The samples are kept in three preallocated 'array' columns 
+    instead of a list of tuples, so a sample takes 7 bytes (4 for the time 
+    stamp, 1 for the status, 2 for the latency in milliseconds) and the memory
+    of a history doesn't grow after its creation. Once the buffer is full the 
+    oldest sample is overwritten.
+    
+    Not thread safe, the supervisor locks it together with the service list.
+    """
+    
+    MAXLATENCY = 65535      # milliseconds, largest value of the 'H' column
+    
+    def __init__( self, size = 100 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty history.
+        
+        :param size: maximum number of samples kept
+        """
+        
+        if size < 1:
+            raise ValueError("History size must be positive")
+        
+        self.size = size
+        self.timestamps = array.array("I", [0]) * size
+        self.statuses = array.array("b", [0]) * size
+        self.latencies = array.array("H", [0]) * size
+        self.position = 0
+        self.count = 0
+    #--------------------------------------------------------------------------
+    
+    def __iter__( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: iterator over all samples, oldest first, as tuples of time 
+                    stamp, status and latency in seconds
+        """
+        
+        start = (self.position - self.count) % self.size
+        for i in xrange(0, self.count):
+            pos = (start + i) % self.size
+            yield (self.timestamps[pos], self.statuses[pos], self.latencies[pos] / 1000.0)
+    #--------------------------------------------------------------------------
+    
+    def __len__( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of samples currently kept
+        """
+        
+        return self.count
+    #--------------------------------------------------------------------------
+    
+    def append( self, timestamp, status, latency = None ):
+    #--------------------------------------------------------------------------
+        """
+        Add a sample, overwriting the oldest one if the history is full.
+        
+        :param timestamp: unix time stamp of the check
+        :param status: 'True', 'False' or -1 if the service is unchecked
+        :param latency: duration of the check in seconds, 'None' if unknown
+        """
+        
+        if latency is None:
+            latency = 0
+        else:
+            latency = min(int(latency * 1000), ResultHistory.MAXLATENCY)
+        
+        pos = self.position
+        self.timestamps[pos] = int(timestamp)
+        self.statuses[pos] = int(status)
+        self.latencies[pos] = max(latency, 0)
+        
+        self.position = (pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+    #--------------------------------------------------------------------------
+    
+    def getavailability( self, since = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        Return the share of successful checks. Samples of unchecked services 
+        are ignored.
+        
+        :param since: only consider samples not older than this unix time stamp
+        :return: ratio between 0.0 and 1.0, 'None' if there is no sample
+        """
+        
+        up = 0
+        total = 0
+        for timestamp, status, _ in self:
+            if timestamp < since or status == -1:
+                continue
+            
+            total += 1
+            if status == 1:
+                up += 1
+        
+        if total == 0:
+            return None
+        
+        return float(up) / total
+    #--------------------------------------------------------------------------
+    
+    def getflapcount( self, since = 0 ):
+    #--------------------------------------------------------------------------
+        """
+        Return how often the status changed between consecutive checks. 
+        Samples of unchecked services are ignored.
+        
+        :param since: only consider samples not older than this unix time stamp
+        :return: number of status changes
+        """
+        
+        flaps = 0
+        previous = None
+        for timestamp, status, _ in self:
+            if timestamp < since or status == -1:
+                continue
+            
+            if previous is not None and status != previous:
+                flaps += 1
+            previous = status
+        
+        return flaps
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ProbeExecutor( object ):
+#==============================================================================
+    """
+    Fixed-size pool of worker threads checking services.
+    
+    >>> executor = ProbeExecutor(10, 100)
+    
+    Services are handed over by 'submit' and put into a bounded pending queue
+    from which the workers take them one by one. If the pending queue is full,
+    'submit' blocks the caller until a worker becomes available again, which 
+    slows down the scheduler instead of starting more threads.
+    
+    A service is never pending or checked twice at the same time. Metrics
+    about the pending queue and the workers are returned by 'getstats'.
+    
+    Every check runs under the deadline given by the service's budget (see 
+    'Service.getbudget'). A check finishing after its deadline counts as 
+    timed out and fails. A watchdog thread cancels checks which are still
+    running 'ProbeExecutor.GRACE' seconds after their deadline, so a stuck 
+    target can't keep a worker busy.
+    """
+    
+    GRACE = 1.0     # seconds a check may overrun its deadline before it is cancelled
+    
+    def __init__( self, workers = 10, queuesize = 100, ondone = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the executor and start its worker threads.
+        
+        :param workers: number of worker threads (maximum concurrent checks)
+        :param queuesize: maximum number of services waiting for a worker
+        :param ondone: optional function called with the service as parameter
+                        after it has been checked
+        """
+        
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+        
+        self.pending = Queue.Queue(queuesize)
+        self.ondone = ondone
+        self.shutdown = False
+        
+        self.__inflight = set()
+        self.__running = {}
+        self.__statslock = threading.Lock()
+        self.__active = 0
+        self.__cancelled = 0
+        self.__completed = 0
+        self.__maxqueued = 0
+        self.__skipped = 0
+        self.__submitted = 0
+        self.__timedout = 0
+        
+        self.workers = []
+        for _ in range(0, workers):
+            t = threading.Thread(target = self.__work)
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+        
+        self.watchdog = threading.Thread(target = self.__watch)
+        self.watchdog.setDaemon(True)
+        self.watchdog.start()
+    #--------------------------------------------------------------------------
+    
+    def __watch( self ):
+    #--------------------------------------------------------------------------
+        """
+        Main loop of the watchdog thread. Cancel checks which overran their
+        deadline by more than 'ProbeExecutor.GRACE' seconds, until 
+        'self.shutdown' is set to 'True'.
+        """
+        
+        while not self.shutdown:
+            time.sleep(0.5)
+            
+            now = time.time()
+            with self.__statslock:
+                overdue = [service for service, deadline in self.__running.itervalues() 
+                           if now > deadline + ProbeExecutor.GRACE]
+            
+            for service in overdue:
+                service.cancel()
+            
+            if overdue:
+                with self.__statslock:
+                    self.__cancelled += len(overdue)
+    #--------------------------------------------------------------------------
+    
+    def __work( self ):
+    #--------------------------------------------------------------------------
+        """
+        Main loop of a worker thread. Take the next pending service and check
+        it until 'self.shutdown' is set to 'True'.
+        """
+        
+        while not self.shutdown:
+            try:
+                service = self.pending.get(timeout = 1)
+            except Queue.Empty:
+                continue
+            
+            deadline = time.time() + service.getbudget()
+            with self.__statslock:
+                self.__active += 1
+                self.__running[service.uid] = (service, deadline)
+            
+            try:
+                try:
+                    service.probe()
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    service.laststatus = False
+                    traceback.print_exc()
+                
+                with self.__statslock:
+                    del self.__running[service.uid]
+                    if time.time() > deadline:
+                        self.__timedout += 1
+                        service.laststatus = False
+                
+                if self.ondone is not None:
+                    try:
+                        self.ondone(service)
+                    except KeyboardInterrupt:
+                        raise
+                    except:
+                        traceback.print_exc()
+            finally:
+                with self.__statslock:
+                    self.__running.pop(service.uid, None)
+                    self.__active -= 1
+                    self.__completed += 1
+                    self.__inflight.discard(service.uid)
+    #--------------------------------------------------------------------------
+    
+    def getqueuedepth( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of services waiting for a worker
+        """
+        
+        return self.pending.qsize()
+    #--------------------------------------------------------------------------
+    
+    def getstats( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return a snapshot of the executor's metrics: 
+        
+        - 'workers': size of the worker pool
+        - 'active': number of services currently checked
+        - 'queued': number of services waiting for a worker
+        - 'maxqueued': highest number of waiting services seen so far
+        - 'queuesize': capacity of the pending queue
+        - 'submitted', 'completed': total number of services handed over and 
+                                    checked
+        - 'skipped': services not handed over because they were still pending
+                        or checked
+        - 'timedout': checks which finished after their deadline
+        - 'cancelled': checks cancelled by the watchdog
+        
+        :return: dictionary of metric name to value
+        """
+        
+        with self.__statslock:
+            return {"workers": len(self.workers),
+                    "active": self.__active,
+                    "queued": self.pending.qsize(),
+                    "maxqueued": self.__maxqueued,
+                    "queuesize": self.pending.maxsize,
+                    "submitted": self.__submitted,
+                    "completed": self.__completed,
+                    "skipped": self.__skipped,
+                    "timedout": self.__timedout,
+                    "cancelled": self.__cancelled}
+    #--------------------------------------------------------------------------
+    
+    def isbusy( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a service
+        :return: 'True' if the service is pending or currently checked
+        """
+        
+        with self.__statslock:
+            return uid in self.__inflight
+    #--------------------------------------------------------------------------
+    
+    def stop( self, timeout = 5.0 ):
+    #--------------------------------------------------------------------------
+        """
+        Cancel the running checks and wait for the worker threads to terminate.
+        
+        :param timeout: maximum seconds to wait for the threads
+        """
+        
+        self.shutdown = True
+        
+        with self.__statslock:
+            running = [service for service, _ in self.__running.itervalues()]
+        for service in running:
+            service.cancel()
+        
+        deadline = time.time() + timeout
+        for t in self.workers + [self.watchdog]:
+            t.join(max(deadline - time.time(), 0))
+    #--------------------------------------------------------------------------
+    
+    def submitbatch( self, services, timeout = None ):
+    #--------------------------------------------------------------------------
+        """
+        Hand a list of services over at once. Services still pending or checked
+        are skipped. Blocks while the pending queue is full.
+        
+        :param services: list of handler objects which should be checked
+        :param timeout: maximum seconds to wait for a free slot per service, 
+                        'None' blocks until one is available
+        :return: number of services queued
+        """
+        
+        with self.__statslock:
+            accepted = [service for service in services if service.uid not in self.__inflight]
+            self.__inflight.update(service.uid for service in accepted)
+            self.__skipped += len(services) - len(accepted)
+        
+        queued = 0
+        for service in accepted:
+            try:
+                self.pending.put(service, timeout = timeout)
+                queued += 1
+            except Queue.Full:
+                with self.__statslock:
+                    self.__inflight.discard(service.uid)
+        
+        with self.__statslock:
+            self.__submitted += queued
+            self.__maxqueued = max(self.__maxqueued, self.pending.qsize())
+        
+        return queued
+    #--------------------------------------------------------------------------
+    
+    def submit( self, service, timeout = None ):
+    #--------------------------------------------------------------------------
+        """
+        Hand a service over to the worker pool. Blocks while the pending queue
+        is full.
+        
+        :param service: handler object which should be checked
+        :param timeout: maximum seconds to wait for a free slot, 'None' blocks
+                        until one is available
+        :return: 'True' if the service was queued, 'False' if it is still 
+                    pending or checked or no slot became available in time
+        """
+        
+        with self.__statslock:
+            if service.uid in self.__inflight:
+                self.__skipped += 1
+                return False
+            
+            self.__inflight.add(service.uid)
+        
+        try:
+            self.pending.put(service, timeout = timeout)
+        except Queue.Full:
+            with self.__statslock:
+                self.__inflight.discard(service.uid)
+            return False
+        
+        with self.__statslock:
+            self.__submitted += 1
+            self.__maxqueued = max(self.__maxqueued, self.pending.qsize())
+        
+        return True
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ProbeReactor( object ):
+#==============================================================================
+    """
+    Single threaded event loop checking services with non-blocking sockets.
+    
+    >>> reactor = ProbeReactor(1000, 10000)
+    
+    Offers the same interface as 'ProbeExecutor' but instead of occupying a 
+    thread per check, every service is asked for an 'AsyncProbe' (see 
+    'Service.asyncprobe') which is driven by one event loop thread. Up to a
+    configurable number of probes are in flight at a time, each of them is
+    aborted and considered as a fault when exceeding its deadline.
+    
+    Host names missing in the resolver cache are looked up in the background
+    ('Resolver.resolveasync'); meanwhile the probe is parked and counts as in
+    flight, its deadline applies to the lookup as well.
+    
+    Handlers not providing an asynchronous probe are checked by calling 
+    'probe()' within the event loop, so they should return quickly.
+    """
+    
+    def __init__( self, maxinflight = 1000, queuesize = 10000, ondone = None, timeout = 30 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the reactor and start its event loop thread.
+        
+        :param maxinflight: maximum number of probes running at a time
+        :param queuesize: maximum number of services waiting to be probed
+        :param ondone: optional function called with the service as parameter
+                        after it has been checked
+        :param timeout: upper limit of a probe's deadline in seconds, applies 
+                        if the service's timeout is longer or not set
+        """
+        
+        if maxinflight < 1:
+            raise ValueError("At least one probe must be allowed in flight")
+        
+        self.pending = Queue.Queue(queuesize)
+        self.maxinflight = maxinflight
+        self.ondone = ondone
+        self.timeout = timeout
+        self.shutdown = False
+        
+        self.__probes = {}
+        self.__resolving = set()
+        self.__resolved = Queue.Queue()
+        self.__inflight = set()
+        self.__statslock = threading.Lock()
+        self.__cancelled = 0
+        self.__completed = 0
+        self.__maxqueued = 0
+        self.__skipped = 0
+        self.__submitted = 0
+        self.__timedout = 0
+        
+        self.__wakeup = os.pipe()
+        for fd in self.__wakeup:
+            setnonblocking(fd)
+        
+        if hasattr(select, "poll"):
+            self.__poller = select.poll()
+            self.__poller.register(self.__wakeup[0], select.POLLIN)
+        else:
+            self.__poller = None
+        
+        self.thread = threading.Thread(target = self.__loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    #--------------------------------------------------------------------------
+    
+    def __admit( self ):
+    #--------------------------------------------------------------------------
+        """
+        Start pending probes as long as the in-flight limit isn't reached.
+        """
+        
+        while len(self.__probes) + len(self.__resolving) < self.maxinflight:
+            try:
+                service = self.pending.get_nowait()
+            except Queue.Empty:
+                return
+            
+            probe = None
+            try:
+                probe = service.asyncprobe()
+                if probe is None:
+                    service.probe()
+                else:
+                    timeout = self.timeout
+                    if service.timeout > 0:
+                        timeout = min(timeout, service.timeout)
+                    probe.prepare(time.time() + timeout)
+                    
+                    addresses = service.resolver.resolveasync(service.host, service.port, 
+                                                              self.__getresolvedhandler(probe))
+                    if addresses is None:
+                        self.__resolving.add(probe)
+                        continue
+                    
+                    probe.connect(addresses)
+            except KeyboardInterrupt:
+                raise
+            except:
+                if probe is not None:
+                    probe.finish(False)
+                else:
+                    service.laststatus = False
+                if not isinstance(sys.exc_info()[1], socket.error):
+                    traceback.print_exc()   # host names cached as unresolvable are expected
+            
+            self.__track(probe, service)
+    #--------------------------------------------------------------------------
+    
+    def __connectresolved( self ):
+    #--------------------------------------------------------------------------
+        """
+        Start connecting the parked probes whose host names have been resolved.
+        """
+        
+        while True:
+            try:
+                probe, addresses, error = self.__resolved.get_nowait()
+            except Queue.Empty:
+                return
+            
+            if probe not in self.__resolving:
+                continue        # expired while resolving
+            
+            self.__resolving.discard(probe)
+            try:
+                if error is not None:
+                    probe.finish(False)
+                else:
+                    probe.connect(addresses)
+            except KeyboardInterrupt:
+                raise
+            except:
+                probe.finish(False)
+                traceback.print_exc()
+            
+            self.__track(probe, probe.service)
+    #--------------------------------------------------------------------------
+    
+    def __expire( self, now ):
+    #--------------------------------------------------------------------------
+        """
+        Abort all probes whose deadline has passed.
+        
+        :return: seconds until the next deadline
+        """
+        
+        nextdeadline = now + 1
+        for fd, probe in self.__probes.items():
+            if probe.deadline <= now:
+                probe.abort()
+                with self.__statslock:
+                    self.__timedout += 1
+                self.__retire(fd, probe)
+            else:
+                nextdeadline = min(nextdeadline, probe.deadline)
+        
+        for probe in list(self.__resolving):
+            if probe.deadline <= now:
+                probe.abort()
+                with self.__statslock:
+                    self.__timedout += 1
+                self.__resolving.discard(probe)
+                self.__finish(probe.service)
+            else:
+                nextdeadline = min(nextdeadline, probe.deadline)
+        
+        return max(0, nextdeadline - now)
+    #--------------------------------------------------------------------------
+    
+    def __finish( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Call the completion handler and release the service.
+        """
+        
+        try:
+            if self.ondone is not None:
+                self.ondone(service)
+        except KeyboardInterrupt:
+            raise
+        except:
+            traceback.print_exc()
+        finally:
+            with self.__statslock:
+                self.__completed += 1
+                self.__inflight.discard(service.uid)
+    #--------------------------------------------------------------------------
+    
+    def __loop( self ):
+    #--------------------------------------------------------------------------
+        """
+        Event loop. Admit pending services, wait for socket events or the 
+        next deadline and dispatch them to the probes until 'self.shutdown' 
+        is set to 'True'.
+        """
+        
+        while not self.shutdown:
+            self.__connectresolved()
+            self.__admit()
+            wait = self.__expire(time.time())
+            
+            try:
+                events = self.__poll(wait)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for fd, readable, writable in events:
+                if fd == self.__wakeup[0]:
+                    try:
+                        while os.read(fd, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                
+                probe = self.__probes.get(fd)
+                if probe is None:
+                    continue
+                
+                try:
+                    if writable:
+                        probe.onwritable()
+                    if readable and not probe.done:
+                        probe.onreadable()
+                except:
+                    probe.finish(False)
+                
+                if probe.done:
+                    self.__retire(fd, probe)
+                else:
+                    if probe.fileno() != fd:
+                        self.__unregister(fd)     # fell back to another address
+                        del self.__probes[fd]
+                        self.__probes[probe.fileno()] = probe
+                    self.__register(probe)
+        
+        for fd, probe in self.__probes.items():
+            probe.abort()
+            with self.__statslock:
+                self.__cancelled += 1
+            self.__retire(fd, probe)
+        
+        for probe in list(self.__resolving):
+            probe.abort()
+            with self.__statslock:
+                self.__cancelled += 1
+            self.__resolving.discard(probe)
+            self.__finish(probe.service)
+    #--------------------------------------------------------------------------
+    
+    def __getresolvedhandler( self, probe ):
+    #--------------------------------------------------------------------------
+        """
+        Return the function called by the resolver's thread once the host name
+        of a parked probe has been looked up. It passes the result on to the 
+        event loop.
+        
+        :param probe: 'AsyncProbe' waiting for its addresses
+        :return: function accepting the addresses and the error of the lookup
+        """
+        
+        def onresolved( addresses, error ):
+            self.__resolved.put((probe, addresses, error))
+            self.__wake()
+        
+        return onresolved
+    #--------------------------------------------------------------------------
+    
+    def __poll( self, timeout ):
+    #--------------------------------------------------------------------------
+        """
+        Wait for socket events. Uses 'select.poll' if available as it isn't 
+        restricted in the number of file descriptors, 'select.select' otherwise.
+        
+        :param timeout: maximum seconds to wait
+        :return: list of (file descriptor, readable, writable) tuples
+        """
+        
+        if self.__poller is not None:
+            ready = self.__poller.poll(timeout * 1000)
+            return [(fd, bool(mask & (select.POLLIN | select.POLLHUP | select.POLLERR)), 
+                     bool(mask & (select.POLLOUT | select.POLLERR))) for fd, mask in ready]
+        
+        rlist = [self.__wakeup[0]]
+        wlist = []
+        for fd, probe in self.__probes.items():
+            if probe.wantswrite():
+                wlist.append(fd)
+            else:
+                rlist.append(fd)
+        
+        readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        writable = set(writable)
+        
+        return [(fd, True, fd in writable) for fd in readable] + \
+               [(fd, False, True) for fd in writable if fd not in readable]
+    #--------------------------------------------------------------------------
+    
+    def __register( self, probe ):
+    #--------------------------------------------------------------------------
+        """
+        Register or modify the events the poller waits for on a probe's socket.
+        """
+        
+        if self.__poller is None:
+            return
+        
+        if probe.wantswrite():
+            self.__poller.register(probe.fileno(), select.POLLOUT)
+        else:
+            self.__poller.register(probe.fileno(), select.POLLIN)
+    #--------------------------------------------------------------------------
+    
+    def __retire( self, fd, probe ):
+    #--------------------------------------------------------------------------
+        """
+        Forget a finished probe and release its service.
+        """
+        
+        del self.__probes[fd]
+        self.__unregister(fd)
+        
+        probe.close()
+        self.__finish(probe.service)
+    #--------------------------------------------------------------------------
+    
+    def __track( self, probe, service ):
+    #--------------------------------------------------------------------------
+        """
+        Wait for the socket events of a started probe or release its service
+        if it's already done.
+        
+        :param probe: started 'AsyncProbe' or 'None' if checked by 'probe()'
+        :param service: handler object checked by the probe
+        """
+        
+        if probe is None or probe.done:
+            self.__finish(service)
+        else:
+            self.__probes[probe.fileno()] = probe
+            self.__register(probe)
+    #--------------------------------------------------------------------------
+    
+    def __unregister( self, fd ):
+    #--------------------------------------------------------------------------
+        """
+        Stop waiting for events of a file descriptor.
+        """
+        
+        if self.__poller is not None:
+            try:
+                self.__poller.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+    #--------------------------------------------------------------------------
+    
+    def getqueuedepth( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of services waiting to be probed
+        """
+        
+        return self.pending.qsize()
+    #--------------------------------------------------------------------------
+    
+    def getstats( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return a snapshot of the reactor's metrics. Provides the same keys as
+        'ProbeExecutor.getstats' where 'workers' is the in-flight limit and 
+        'active' the number of probes in flight. 'timedout' counts the probes
+        aborted because of their deadline, 'cancelled' the probes aborted by
+        'stop'.
+        
+        :return: dictionary of metric name to value
+        """
+        
+        with self.__statslock:
+            return {"workers": self.maxinflight,
+                    "active": len(self.__probes) + len(self.__resolving),
+                    "queued": self.pending.qsize(),
+                    "maxqueued": self.__maxqueued,
+                    "queuesize": self.pending.maxsize,
+                    "submitted": self.__submitted,
+                    "completed": self.__completed,
+                    "skipped": self.__skipped,
+                    "timedout": self.__timedout,
+                    "cancelled": self.__cancelled}
+    #--------------------------------------------------------------------------
+    
+    def isbusy( self, uid ):
+    #--------------------------------------------------------------------------
+        """
+        :param uid: unique identifier of a service
+        :return: 'True' if the service is pending or currently probed
+        """
+        
+        with self.__statslock:
+            return uid in self.__inflight
+    #--------------------------------------------------------------------------
+    
+    def stop( self, timeout = 5.0 ):
+    #--------------------------------------------------------------------------
+        """
+        Let the event loop terminate and wait for its thread. Probes in flight
+        are aborted.
+        
+        :param timeout: maximum seconds to wait for the thread
+        """
+        
+        self.shutdown = True
+        self.__wake()
+        self.thread.join(timeout)
+    #--------------------------------------------------------------------------
+    
+    def submitbatch( self, services, timeout = None ):
+    #--------------------------------------------------------------------------
+        """
+        Hand a list of services over at once. Services still pending or probed
+        are skipped. Blocks while the pending queue is full.
+        
+        :param services: list of handler objects which should be checked
+        :param timeout: maximum seconds to wait for a free slot per service, 
+                        'None' blocks until one is available
+        :return: number of services queued
+        """
+        
+        with self.__statslock:
+            accepted = [service for service in services if service.uid not in self.__inflight]
+            self.__inflight.update(service.uid for service in accepted)
+            self.__skipped += len(services) - len(accepted)
+        
+        queued = 0
+        for service in accepted:
+            try:
+                self.pending.put(service, timeout = timeout)
+                queued += 1
+            except Queue.Full:
+                with self.__statslock:
+                    self.__inflight.discard(service.uid)
+            
+            if queued % 64 == 0:
+                self.__wake()       # let the loop admit while filling the queue
+        
+        self.__wake()
+        
+        with self.__statslock:
+            self.__submitted += queued
+            self.__maxqueued = max(self.__maxqueued, self.pending.qsize())
+        
+        return queued
+    #--------------------------------------------------------------------------
+    
+    def submit( self, service, timeout = None ):
+    #--------------------------------------------------------------------------
+        """
+        Hand a service over to the event loop. Blocks while the pending queue
+        is full.
+        
+        :param service: handler object which should be checked
+        :param timeout: maximum seconds to wait for a free slot, 'None' blocks
+                        until one is available
+        :return: 'True' if the service was queued, 'False' if it is still 
+                    pending or probed or no slot became available in time
+        """
+        
+        with self.__statslock:
+            if service.uid in self.__inflight:
+                self.__skipped += 1
+                return False
+            
+            self.__inflight.add(service.uid)
+        
+        try:
+            self.pending.put(service, timeout = timeout)
+        except Queue.Full:
+            with self.__statslock:
+                self.__inflight.discard(service.uid)
+            return False
+        
+        with self.__statslock:
+            self.__submitted += 1
+            self.__maxqueued = max(self.__maxqueued, self.pending.qsize())
+        
+        self.__wake()
+        return True
+    #--------------------------------------------------------------------------
+    
+    def __wake( self ):
+    #--------------------------------------------------------------------------
+        """
+        Interrupt the event loop's wait for socket events.
+        """
+        
+        try:
+            os.write(self.__wakeup[1], "x")
+        except OSError:
+            pass        # pipe is full, the loop will wake up anyway
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class Resolver( object ):
+#==============================================================================
+    """
+    Cache of host name lookups shared by all probes.
+    
+    >>> resolver = Resolver(300, 30)
+    
+    The system resolver doesn't tell the TTL of a record, so successful 
+    lookups are kept for a fixed 'ttl' and failed ones for 'negativettl', 
+    which keeps broken names from hammering the resolver. Once an entry is 
+    older than 'refreshahead' times its TTL, the next lookup still returns 
+    the cached addresses but triggers a refresh by a background thread, so 
+    checks of frequently used names never wait for the resolver. If the 
+    refresh fails, the old addresses are kept until they expire.
+    
+    Callers which must not block (e.g. the event loop of a 'ProbeReactor') 
+    use 'resolveasync': names missing in the cache are looked up by a small
+    pool of background threads, the same threads doing the refreshes.
+    
+    Concurrent lookups of the same uncached name wait for a single query.
+    Failed lookups are counted separately ('getstats'), so resolver outages 
+    can be told apart from faulty services.
+    
+    Thread safe.
+    """
+    
+    def __init__( self, ttl = 300, negativettl = 30, refreshahead = 0.8, workers = 4 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty cache.
+        
+        :param ttl: seconds a successful lookup is kept
+        :param negativettl: seconds a failed lookup is kept
+        :param refreshahead: fraction of the TTL after which an entry is 
+                                refreshed in the background
+        :param workers: number of background threads, started on first use
+        """
+        
+        self.ttl = ttl
+        self.negativettl = negativettl
+        self.refreshahead = refreshahead
+        self.workers = workers
+        
+        # (host, port): [addresses, error, time of the lookup, expiry]
+        self.__entries = {}
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        
+        # (host, port): functions waiting for a background lookup
+        self.__callbacks = {}
+        self.__jobs = Queue.Queue()
+        self.__refreshing = set()
+        self.__threads = []
+        
+        self.__lookups = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__failures = 0
+        self.__refreshed = 0
+    #--------------------------------------------------------------------------
+    
+    def __lookup( self, key, refresh = False ):
+    #--------------------------------------------------------------------------
+        """
+        Query the system resolver and store the result.
+        
+        :param key: tuple of host name and port
+        :param refresh: 'True' to keep a still valid entry if the query fails
+        :return: stored entry
+        """
+        
+        now = time.time()
+        try:
+            entry = [socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM), None, now, now + self.ttl]
+        except socket.gaierror, e:
+            entry = [None, e, now, now + self.negativettl]
+        
+        with self.__lock:
+            if entry[1] is not None:
+                self.__failures += 1
+                
+                current = self.__entries.get(key)
+                if refresh and current is not None and current[1] is None and current[3] > now:
+                    return current
+            
+            self.__entries[key] = entry
+        
+        return entry
+    #--------------------------------------------------------------------------
+    
+    def __prune( self, now ):
+    #--------------------------------------------------------------------------
+        """
+        Forget all expired entries. Must be called while holding the lock.
+        """
+        
+        for key, entry in self.__entries.items():
+            if entry[3] <= now:
+                del self.__entries[key]
+    #--------------------------------------------------------------------------
+    
+    def __enqueue( self, key, refresh ):
+    #--------------------------------------------------------------------------
+        """
+        Hand a lookup over to the background threads, starting them if not
+        done yet. Must be called while holding the lock.
+        
+        :param key: tuple of host name and port
+        :param refresh: 'True' to keep a still valid entry if the query fails
+        """
+        
+        self.__jobs.put((key, refresh))
+        
+        while len(self.__threads) < self.workers:
+            thread = threading.Thread(target = self.__work)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+    #--------------------------------------------------------------------------
+    
+    def __work( self ):
+    #--------------------------------------------------------------------------
+        """
+        Body of the background threads looking up names missing in the cache
+        and refreshing entries about to expire. Functions waiting for a name
+        are called once its lookup is done.
+        """
+        
+        while True:
+            key, refresh = self.__jobs.get()
+            try:
+                entry = self.__lookup(key, refresh)
+            except Exception, e:
+                entry = [None, e]
+            
+            with self.__lock:
+                if refresh:
+                    self.__refreshing.discard(key)
+                    self.__refreshed += 1
+                callbacks = self.__callbacks.pop(key, ())
+            
+            for callback in callbacks:
+                try:
+                    callback(entry[0], entry[1])
+                except:
+                    traceback.print_exc()
+    #--------------------------------------------------------------------------
+    
+    def getstats( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the metrics of the cache.
+        
+        :return: dictionary with 'hits' and 'misses' of the cache, 'failures'
+                    of the system resolver (including refreshes), 'refreshes'
+                    done in the background and the number of 'entries'
+        """
+        
+        with self.__lock:
+            return {"hits": self.__hits,
+                    "misses": self.__misses,
+                    "failures": self.__failures,
+                    "refreshes": self.__refreshed,
+                    "entries": len(self.__entries)}
+    #--------------------------------------------------------------------------
+    
+    def resolve( self, host, port ):
+    #--------------------------------------------------------------------------
+        """
+        Return the addresses of a host, from the cache if possible.
+        
+        :param host: host name or address
+        :param port: port number
+        :return: list of tuples as returned by 'socket.getaddrinfo'
+        :raise socket.gaierror: if the name can't be resolved (also if cached)
+        """
+        
+        key = (host, int(port))
+        
+        while True:
+            now = time.time()
+            
+            with self.__lock:
+                self.__lookups += 1
+                if self.__lookups % 1000 == 0:
+                    self.__prune(now)
+                
+                entry = self.__entries.get(key)
+                if entry is not None and entry[3] > now:
+                    self.__hits += 1
+                    
+                    if entry[1] is not None:
+                        raise entry[1]
+                    
+                    if now - entry[2] >= self.ttl * self.refreshahead and key not in self.__refreshing:
+                        self.__refreshing.add(key)
+                        self.__enqueue(key, True)
+                    
+                    return entry[0]
+                
+                event = self.__pending.get(key)
+                if event is None:
+                    # resolve it in this thread, others wait for the result
+                    event = self.__pending[key] = threading.Event()
+                    self.__misses += 1
+                    break
+            
+            event.wait()
+        
+        try:
+            entry = self.__lookup(key)
+        finally:
+            with self.__lock:
+                del self.__pending[key]
+            event.set()
+        
+        if entry[1] is not None:
+            raise entry[1]
+        
+        return entry[0]
+    #--------------------------------------------------------------------------
+    
+    def resolveasync( self, host, port, callback ):
+    #--------------------------------------------------------------------------
+        """
+        Return the addresses of a host if they are cached, otherwise look the
+        host up in the background without blocking the caller.
+        
+        :param host: host name or address
+        :param port: port number
+        :param callback: function called by a background thread with the list 
+                            of addresses (or 'None') and the error of the lookup 
+                            (or 'None') if the host isn't cached
+        :return: list of tuples as returned by 'socket.getaddrinfo' or 'None'
+                    if the callback will be called
+        :raise socket.gaierror: if the name can't be resolved according to 
+                                the cache
+        """
+        
+        key = (host, int(port))
+        now = time.time()
+        
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[3] > now:
+                self.__hits += 1
+                
+                if entry[1] is not None:
+                    raise entry[1]
+                
+                if now - entry[2] >= self.ttl * self.refreshahead and key not in self.__refreshing:
+                    self.__refreshing.add(key)
+                    self.__enqueue(key, True)
+                
+                return entry[0]
+            
+            callbacks = self.__callbacks.get(key)
+            if callbacks is None:
+                callbacks = self.__callbacks[key] = []
+                self.__misses += 1
+                self.__enqueue(key, False)
+            
+            callbacks.append(callback)
+        
+        return None
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class ConnectionPool( object ):
+#==============================================================================
+    """
+    Idle persistent HTTP connections per host and port.
+    
+    >>> pool = ConnectionPool(2, 30)
+    
+    A connection whose response has been read completely and which the server
+    keeps open is handed back to the pool after a check and reused by the next
+    check of the same host and port. This saves the name lookup and the TCP
+    handshake of every check but the first. Connections idle for longer than
+    'idletimeout' are closed, as the server has most likely dropped them.
+    
+    Thread safe, as checks are run by the threads of the probe executor.
+    """
+    
+    def __init__( self, maxidle = 2, idletimeout = 30 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize an empty connection pool.
+        
+        :param maxidle: maximum number of idle connections kept per host and port
+        :param idletimeout: seconds after which an idle connection is closed
+        """
+        
+        self.maxidle = maxidle
+        self.idletimeout = idletimeout
+        
+        self.__idle = {}
+        self.__lock = threading.Lock()
+        self.__released = 0
+    #--------------------------------------------------------------------------
+    
+    def __prune( self, now ):
+    #--------------------------------------------------------------------------
+        """
+        Close all connections idle for too long. Must be called while holding
+        the lock.
+        """
+        
+        for key, connections in self.__idle.items():
+            for connection, lastused in connections:
+                if now - lastused >= self.idletimeout:
+                    connection.close()
+            
+            connections[:] = [c for c in connections if now - c[1] < self.idletimeout]
+            if not connections:
+                del self.__idle[key]
+    #--------------------------------------------------------------------------
+    
+    def acquire( self, host, port ):
+    #--------------------------------------------------------------------------
+        """
+        Take an idle connection to the given host and port out of the pool.
+        
+        :param host: host name
+        :param port: port number
+        :return: 'httplib.HTTPConnection' or 'None' if there is no idle one
+        """
+        
+        now = time.time()
+        
+        with self.__lock:
+            connections = self.__idle.get((host, port))
+            
+            while connections:
+                connection, lastused = connections.pop()
+                if now - lastused < self.idletimeout:
+                    return connection
+                
+                connection.close()
+        
+        return None
+    #--------------------------------------------------------------------------
+    
+    def clear( self ):
+    #--------------------------------------------------------------------------
+        """
+        Close all idle connections.
+        """
+        
+        with self.__lock:
+            for connections in self.__idle.itervalues():
+                for connection, _ in connections:
+                    connection.close()
+            
+            self.__idle.clear()
+    #--------------------------------------------------------------------------
+    
+    def getidlecount( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: number of idle connections in the pool
+        """
+        
+        with self.__lock:
+            return sum(len(connections) for connections in self.__idle.itervalues())
+    #--------------------------------------------------------------------------
+    
+    def release( self, host, port, connection ):
+    #--------------------------------------------------------------------------
+        """
+        Hand a connection back to the pool after its response has been read 
+        completely. If there are enough idle connections to the host and 
+        port already, the connection is closed instead.
+        
+        :param host: host name
+        :param port: port number
+        :param connection: 'httplib.HTTPConnection'
+        """
+        
+        now = time.time()
+        
+        with self.__lock:
+            self.__released += 1
+            if self.__released % 1000 == 0:
+                self.__prune(now)
+            
+            connections = self.__idle.setdefault((host, port), [])
+            if len(connections) < self.maxidle:
+                connections.append((connection, now))
+                return
+        
+        connection.close()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class Service( object ):
+#==============================================================================
+    """
+    Representation of a basic service.
+    
+    >>> service = Service()
+    
+    This class should be used for unknown protocol types. Service handler 
+    should inherit the behavior and override the _police() method.
+    
+    A Service class and it's subclasses are identified by a unique identifier
+    stored in self.uid
+    
+    As the supervisor keeps an instance per watched service, attributes are 
+    declared in '__slots__' instead of an instance dictionary. Subclasses 
+    should declare their additional attributes (or an empty tuple) as well.
+    
+    Host names are resolved through the 'Resolver' shared by all services 
+    ('Service.resolver').
+    
+    Every check has to finish within the service's timeout ('getbudget'). 
+    Handlers should apply the remaining time as socket timeout and store the
+    socket they are waiting on in 'self.activesocket', so a check exceeding 
+    its budget can be cancelled from another thread ('cancel').
+    """
+    
+    __slots__ = ("uid", "protocol", "host", "port", "timeout", "pattern", "interval", 
+                 "mininterval", "maxinterval", "method", "currentinterval", "stablecount",
+                 "lastschedule", "laststatus", "lastconnect", "lastfirstbyte", "lastlatency",
+                 "activesocket")
+    
+    DEFAULTTIMEOUT = 30     # seconds, if the service doesn't define a timeout
+    
+    resolver = Resolver()
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the service object.
+        
+        Creates a dummy, actual data has to be set using the setvalues(...) method.
+        """
+        
+        
+        self.protocol = "UNKNOWN"
+        self.host = "localhost"
+        self.port = 0
+        self.timeout = 0
+        self.pattern = ""
+        self.lastschedule = time.time()
+        self.laststatus = -1
+        self.lastconnect = None
+        self.lastfirstbyte = None
+        self.lastlatency = None
+        self.interval = 999999999       # unknown service should only be
+                                        # controlled once in order to 
+                                        # indicate the missing specification
+        self.mininterval = self.interval
+        self.maxinterval = self.interval
+        self.method = None
+        self.currentinterval = None
+        self.stablecount = 0
+        self.activesocket = None
+    #--------------------------------------------------------------------------
+    
+    def __eq__(self, other):
+    #--------------------------------------------------------------------------
+        """
+        Two subclasses of 'Service' are equal if their 'uid' is euqal.
+        
+        :return: 'True' if the uids are euqal, 'False' otherwise
+        :raise TypeError: if the given object is not instance of the same
+                            class
+        """
+        
+        if isinstance(other, Service):
+            return self.uid == other.uid
+        
+        raise TypeError("Expected instance of 'Service' or subclass")
+    #--------------------------------------------------------------------------
+    
+    def asyncprobe( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return a non-blocking probe used by 'ProbeReactor' to check the service.
+        
+        Should be overridden by handlers able to check their service with 
+        non-blocking sockets. The default implementation returns 'None', in
+        which case the reactor falls back to calling 'probe()'.
+        
+        :return: instance of 'AsyncProbe' or 'None'
+        """
+        
+        return None
+    #--------------------------------------------------------------------------
+    
+    def cancel( self ):
+    #--------------------------------------------------------------------------
+        """
+        Cancel a running check by shutting down the socket it's waiting on. 
+        The check fails with a socket error then. May be called from any thread.
+        """
+        
+        sock = self.activesocket
+        if sock is None:
+            return
+        
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    #--------------------------------------------------------------------------
+    
+    def getbudget( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: seconds a check of the service may take, its timeout or 
+                    'Service.DEFAULTTIMEOUT' if it has none
+        """
+        
+        if self.timeout > 0:
+            return self.timeout
+        
+        return Service.DEFAULTTIMEOUT
+    #--------------------------------------------------------------------------
+    
+    def getdefinition( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: tuple of the values set by 'setbasicvalues', equal for two 
+                    services defined the same way
+        """
+        
+        return (self.protocol, self.host, self.port, self.timeout, self.pattern, self.interval,
+                self.mininterval, self.maxinterval, self.method)
+    #--------------------------------------------------------------------------
+    
+    def gettargetkey( self ):
+    #--------------------------------------------------------------------------
+        """
+        Return the key identifying the physical target checked by this service.
+        Services with equal keys yield the same result when checked.
+        
+        :return: tuple of protocol, host, port and pattern
+        """
+        
+        return (self.protocol.upper(), self.host, self.port, self.pattern)
+    #--------------------------------------------------------------------------
+    
+    def _police( self ):
+    #--------------------------------------------------------------------------
+        """
+        Dummy method used for unknown protocol types. While always announce a 
+        fault in order to indicate the missing information.
+        
+        Should be overridden by more precise service handler.
+        """
+        
+        self.laststatus = False
+    #--------------------------------------------------------------------------
+    
+    def police( self, executor = None ):
+    #--------------------------------------------------------------------------
+        """
+        Starts _police() method in new thread or hands the service over to 
+        the given probe executor.
+        
+        :param executor: optional 'ProbeExecutor' instance
+        :return: running instance of 'threading.Thread' or 'None' if an 
+                    executor is used
+        """
+        
+        if executor is not None:
+            executor.submit(self)
+            return None
+        
+        self.lastschedule = time.time()
+        t = threading.Thread(target=self.probe, args = [ ])
+        t.start()
+        
+        return t
+    #--------------------------------------------------------------------------    
+    
+    def probe( self ):
+    #--------------------------------------------------------------------------
+        """
+        Run _police() method in the calling thread. Any error raised by the 
+        handler is considered as a fault of the service. The duration of the 
+        check is stored in 'self.lastlatency'; handlers able to measure when 
+        the connection was established respectively the first byte arrived 
+        store it in 'self.lastconnect' and 'self.lastfirstbyte'.
+        """
+        
+        self.lastconnect = None
+        self.lastfirstbyte = None
+        
+        started = time.time()
+        try:
+            self._police()
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.laststatus = False
+        finally:
+            self.activesocket = None
+        
+        self.lastlatency = time.time() - started
+    #--------------------------------------------------------------------------
+    
+    def setbasicvalues( self, uid, protocol, host, port, timeout, pattern, interval, 
+                        mininterval = None, maxinterval = None, method = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the server object.
+        
+        :param uid: unique identifier (e.g. a combination of host, port and service)
+        :param protocol: abbreviation of the protocol necessary to communicate with 
+                            the service
+        :param host: host name as a string
+        :param port: port where service is listening, stored as integer if
+                        it's numeric
+        :param timeout: time period after which service will presumed as faulty
+        :param pattern: string to look for in the service response (mismatch
+                        may indicate a fault)
+        :param interval: periodically check service again after given number in seconds 
+        :param mininterval: shortest interval chosen by the interval policy, 
+                            defaults to 'interval'
+        :param maxinterval: longest interval chosen by the interval policy,
+                            defaults to 'interval'
+        :param method: request method of protocols knowing one (e.g. HTTP), 
+                        ignored by the others
+        """
+        
+        try:
+            port = int(port)
+        except ValueError:
+            if not isinstance(port, basestring):
+                port = str(port)
+            port = internstring(port)
+        
+        self.uid = uid
+        self.port = port
+        self.protocol = internstring(protocol)
+        self.host = internstring(host)
+        self.timeout = timeout
+        self.pattern = pattern
+        self.interval = interval
+        self.mininterval = min(mininterval or interval, interval)
+        self.maxinterval = max(maxinterval or interval, interval)
+        self.method = method
+        
+        if self.currentinterval is None:
+            self.currentinterval = interval
+        else:
+            self.currentinterval = min(max(self.currentinterval, self.mininterval), self.maxinterval)
+    #--------------------------------------------------------------------------
+
+#==============================================================================
+
+
+
+
+
+class HTTPService( Service ):
+#==============================================================================
+    """
+    Representation of a HTTP service.
+    
+    >>> httpserv = HTTPService()
+    
+    Checks the availability of an HTTP service at the given host name and port.
+    If the response code matches the given pattern (e.g. '200' for OK) the 
+    service is considered to be alright, otherwise a fault is presumed.
+    
+    A pattern which isn't a number is a regular expression looked for in the
+    body of the response instead. The service is alright if the response code
+    is below 400 and the expression is found within the first 
+    'HTTPService.maxbody' bytes. The body is read chunk by chunk and the 
+    check stops at the first match, so large pages are never held in memory.
+    
+    The root document is requested with the service's method, GET unless the
+    service definition asks for HEAD (one of 'HTTPService.METHODS'). HEAD only
+    transfers the status line and headers, but isn't answered properly by 
+    every server; a body to check is always requested with GET. Connections 
+    are kept alive in 'HTTPService.pool' and reused by the following checks 
+    of the same host and port. After a GET without pattern the connection is
+    closed behind the headers.
+    """
+    
+    __slots__ = ("matcher",)
+    
+    METHODS = ("GET", "HEAD")
+    DEFAULTMETHOD = "GET"
+    maxbody = 65536
+    pool = ConnectionPool()
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the HTTPService object.
+        
+        Creates a dummy, actual data has to be set using the setvalues(...) method.
+        """
+        Service.__init__(self)
+        self.matcher = None
+        self.method = HTTPService.DEFAULTMETHOD
+    #--------------------------------------------------------------------------
+    
+    def asyncprobe( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'HTTPProbe' requesting the root document of own host and port
+        """
+        
+        return HTTPProbe(self)
+    #--------------------------------------------------------------------------
+    
+    def __getmethod( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: request method, GET if the body has to be checked
+        """
+        
+        if self.matcher is not None:
+            return "GET"
+        
+        return self.method
+    #--------------------------------------------------------------------------
+    
+    def __request( self, connection, started, deadline ):
+    #--------------------------------------------------------------------------
+        """
+        Send the request over given connection and wait for the response 
+        headers.
+        
+        :return: 'httplib.HTTPResponse' with unread body
+        """
+        
+        self.__settimeout(connection, deadline)
+        connection.request(self.__getmethod(), "/")
+        response = connection.getresponse()
+        self.lastfirstbyte = time.time() - started
+        
+        return response
+    #--------------------------------------------------------------------------
+    
+    def __scan( self, connection, response, deadline ):
+    #--------------------------------------------------------------------------
+        """
+        Read the body of the response until the pattern is found, the body
+        ends or 'HTTPService.maxbody' bytes have been read.
+        
+        :return: 'True' if the pattern has been found
+        :raise socket.timeout: if the deadline passes
+        """
+        
+        if response.status >= 400:
+            return False
+        
+        scanner = PatternScanner(self.matcher, HTTPService.maxbody)
+        
+        verdict = None
+        while verdict is None:
+            self.__settimeout(connection, deadline)
+            verdict = scanner.feed(response.read(4096))
+        
+        return verdict
+    #--------------------------------------------------------------------------
+    
+    def __settimeout( self, connection, deadline ):
+    #--------------------------------------------------------------------------
+        """
+        Apply the time left until the deadline as timeout of the connection's
+        socket, so no single operation waits beyond the deadline.
+        
+        :raise socket.timeout: if the deadline already passed
+        """
+        
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("Deadline of the check passed")
+        
+        connection.sock.settimeout(remaining)
+        self.activesocket = connection.sock
+    #--------------------------------------------------------------------------
+    
+    def _police( self ):
+    #--------------------------------------------------------------------------
+        """
+        Uses httplib to make a HTTP request to own host name and port. If the
+        response code matches the pattern (respectively the body contains it),
+        the service is considered to be alright. Measures the time until the 
+        connection is established and until the response headers have been 
+        received.
+        
+        An idle connection of the pool is tried first. If the server closed it
+        in the meantime, the request is repeated with a new connection.
+        
+        No socket operation waits beyond the service's budget (see 'getbudget').
+        """
+        started = time.time()
+        deadline = started + self.getbudget()
+        response = None
+        
+        connection = HTTPService.pool.acquire(self.host, self.port)
+        if connection is not None:
+            try:
+                response = self.__request(connection, started, deadline)
+            except socket.timeout:
+                connection.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+        
+        try:
+            if response is None:
+                connection = httplib.HTTPConnection(self.host, int(self.port))
+                connection.sock = createconnection(self.resolver.resolve(self.host, self.port), 
+                                                   max(deadline - time.time(), 0.001))
+                self.lastconnect = time.time() - started
+                response = self.__request(connection, started, deadline)
+            
+            if self.matcher is not None:
+                self.laststatus = self.__scan(connection, response, deadline)
+            else:
+                self.laststatus = response.status == self.pattern
+                if self.__getmethod() == "HEAD":
+                    response.read()
+            
+            # only connections without unread data can be reused
+            if response.isclosed() and not response.will_close:
+                HTTPService.pool.release(self.host, self.port, connection)
+            else:
+                connection.close()
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.laststatus = False
+            if connection is not None:
+                connection.close()
+    #--------------------------------------------------------------------------
+    
+    def gettargetkey( self ):
+    #--------------------------------------------------------------------------
+        """
+        Services requested with different methods may answer differently.
+        
+        :return: key of 'Service.gettargetkey' extended by the request method
+        """
+        
+        return Service.gettargetkey(self) + (self.method,)
+    #--------------------------------------------------------------------------
+    
+    def setbasicvalues( self, uid, protocol, host, port, timeout, pattern, interval, 
+                        mininterval = None, maxinterval = None, method = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the service object, see 'Service.setbasicvalues'. A numeric
+        pattern (also as string) is the expected response code, any other 
+        string is compiled once as regular expression to look for in the body
+        (see 'compilepattern').
+        
+        :param method: request method, one of 'HTTPService.METHODS' in any 
+                        case, defaults to 'HTTPService.DEFAULTMETHOD'
+        :raise ValueError: if the method isn't supported
+        """
+        
+        if isinstance(pattern, basestring) and pattern.isdigit():
+            pattern = int(pattern)
+        
+        method = str(method or HTTPService.DEFAULTMETHOD).upper()
+        if method not in HTTPService.METHODS:
+            raise ValueError("Unsupported HTTP method '%s'" % method)
+        
+        Service.setbasicvalues(self, uid, protocol, host, port, timeout, pattern, interval, 
+                               mininterval, maxinterval, internstring(method))
+        
+        if isinstance(pattern, basestring):
+            self.matcher = compilepattern(pattern)
+        else:
+            self.matcher = None
+    #--------------------------------------------------------------------------
 
-    A Service class and it's subclasses are identified by a unique identifier
-    stored in self.uid
+#==============================================================================
+
+
+
+
+
+class TCPService( Service ):
+#==============================================================================
+    """
+    Representation of a service only checked for accepting connections.
+    
+    >>> tcpserv = TCPService()
+    
+    The service is considered to be alright as soon as a TCP connection to 
+    its host name and port is established. The pattern is ignored.
+    
+    The check is done by an 'AsyncProbe' on a non-blocking socket, driven by
+    the 'ProbeReactor' or, if checked by a worker thread, by 'AsyncProbe.run'.
+    Subclasses only have to return another probe in 'asyncprobe()'.
+    """
+    
+    __slots__ = ()
+    
+    def asyncprobe( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'AsyncProbe' connecting to own host and port
+        """
+        
+        return AsyncProbe(self)
+    #--------------------------------------------------------------------------
+    
+    def _police( self ):
+    #--------------------------------------------------------------------------
+        """
+        Run the probe returned by 'asyncprobe()' in the calling thread.
+        """
+        
+        self.asyncprobe().run(self.getbudget())
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class TLSService( TCPService ):
+#==============================================================================
+    """
+    Representation of a service speaking TLS.
+    
+    >>> tlsserv = TLSService()
+    
+    The service is considered to be alright if a TLS handshake with its host
+    name and port succeeds. The certificate isn't verified, the check is 
+    about the availability of the service.
+    """
+    
+    __slots__ = ()
+    
+    def asyncprobe( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'TLSProbe' connecting to own host and port
+        """
+        
+        return TLSProbe(self)
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class BannerService( TCPService ):
+#==============================================================================
+    """
+    Representation of a service greeting its clients with a banner line.
+    
+    >>> bannerserv = BannerService()
+    
+    The service is considered to be alright if the first line sent by the 
+    service after connecting matches the pattern. Numeric patterns (e.g. the
+    default status code of HTTP services) are replaced by 'self.banner', the 
+    expected greeting of the protocol. Subclasses define it for a specific 
+    protocol, the generic one accepts any banner.
+    """
+    
+    __slots__ = ("matcher",)
+    
+    banner = re.compile(".")
+    
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the BannerService object.
+        
+        Creates a dummy, actual data has to be set using the setvalues(...) method.
+        """
+        TCPService.__init__(self)
+        self.matcher = self.banner
+    #--------------------------------------------------------------------------
+    
+    def asyncprobe( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'BannerProbe' reading the banner of own host and port
+        """
+        
+        return BannerProbe(self)
+    #--------------------------------------------------------------------------
+    
+    def setbasicvalues( self, uid, protocol, host, port, timeout, pattern, interval, 
+                        mininterval = None, maxinterval = None, method = None ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the service object, see 'Service.setbasicvalues'. A non-numeric
+        pattern is compiled once as regular expression the banner has to match
+        (see 'compilepattern').
+        """
+        
+        TCPService.setbasicvalues(self, uid, protocol, host, port, timeout, pattern, interval, 
+                                  mininterval, maxinterval, method)
+        
+        if isinstance(pattern, basestring) and not pattern.isdigit():
+            self.matcher = compilepattern(pattern)
+        else:
+            self.matcher = self.banner
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class SMTPService( BannerService ):
+#==============================================================================
+    """
+    Representation of a SMTP service, alright if it greets with code 220.
+    
+    >>> smtpserv = SMTPService()
+    """
+    
+    __slots__ = ()
+    
+    banner = re.compile("^220[ -]")
+#==============================================================================
+
+
+
+
+
+
+class SSHService( BannerService ):
+#==============================================================================
+    """
+    Representation of a SSH service, alright if it sends its version string.
+    
+    >>> sshserv = SSHService()
+    """
+    
+    __slots__ = ()
+    
+    banner = re.compile("^SSH-")
+#==============================================================================
+
+
+
+
+
+
+class IMAPService( BannerService ):
+#==============================================================================
+    """
+    Representation of an IMAP service, alright if it greets with an untagged
+    OK or PREAUTH response.
+    
+    >>> imapserv = IMAPService()
+    """
+    
+    __slots__ = ()
+    
+    banner = re.compile("^\\* (OK|PREAUTH)")
+#==============================================================================
+
+
+
+
+
+
+class PatternScanner( object ):
+#==============================================================================
+    """
+    Looks for a regular expression in a stream of data.
+    
+    >>> scanner = PatternScanner(re.compile("Welcome"), 65536)
+    
+    The data is passed in chunk by chunk. Only the end of the data seen so 
+    far ('overlap' bytes) is kept to find matches spanning two chunks, so 
+    matches longer than that may be missed. The search stops after 'maxbytes'
+    bytes.
+    """
+    
+    def __init__( self, matcher, maxbytes = 65536, overlap = 1024 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the scanner.
+        
+        :param matcher: compiled regular expression
+        :param maxbytes: number of bytes after which the search is given up
+        :param overlap: number of bytes kept from the previous chunks
+        """
+        
+        self.matcher = matcher
+        self.maxbytes = maxbytes
+        self.overlap = overlap
+        self.count = 0
+        self.tail = ""
+    #--------------------------------------------------------------------------
+    
+    def feed( self, data ):
+    #--------------------------------------------------------------------------
+        """
+        Search the next chunk of data.
+        
+        :param data: chunk of data, empty if the stream ended
+        :return: 'True' if the expression has been found, 'False' if the 
+                    stream ended or the byte limit has been reached without
+                    a match, 'None' if more data is needed
+        """
+        
+        if not data:
+            return False
+        
+        data = data[:self.maxbytes - self.count]
+        self.count += len(data)
+        
+        window = self.tail + data
+        if self.matcher.search(window):
+            return True
+        
+        if self.count >= self.maxbytes:
+            return False
+        
+        self.tail = window[-self.overlap:]
+        return None
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+
+class AsyncProbe( object ):
+#==============================================================================
+    """
+    Non-blocking check of a single service driven by a 'ProbeReactor' or by
+    its own 'run()' method in a worker thread.
+    
+    >>> probe = AsyncProbe(service)
+    
+    Connects a non-blocking TCP socket to the service's host and port, sends
+    the data returned by 'request()' and feeds every received chunk to 
+    'response()' until it returns a verdict. A plain 'AsyncProbe' considers 
+    the service alright as soon as the connection is established. If the 
+    connection to an address of the host fails, the next one is tried.
+    
+    'start()' resolves the host name in the calling thread. The reactor 
+    instead calls 'prepare()' and, once the name has been resolved without
+    blocking its loop, 'connect()'. On socket events it calls 'onwritable()'
+    and 'onreadable()', 'abort()' when the deadline passed. As the socket 
+    changes when falling back to another address, 'fileno()' has to be
+    asked again after each event. Once 'self.done' is 'True' the result
+    has been stored in the service's 'laststatus'.
     """
     
-    def __init__( self ):
+    CONNECTING = 0
+    SENDING = 1
+    RECEIVING = 2
+    
+    def __init__( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the probe object.
+        
+        :param service: handler object which should be checked
+        """
+        
+        self.service = service
+        self.sock = None
+        self.addresses = []
+        self.state = AsyncProbe.CONNECTING
+        self.deadline = None
+        self.started = None
+        self.done = False
+        self.outbuffer = ""
+        self.__fileno = None
+    #--------------------------------------------------------------------------
+    
+    def abort( self ):
+    #--------------------------------------------------------------------------
+        """
+        Cancel the probe, the service is considered as faulty.
+        """
+        
+        self.finish(False)
+    #--------------------------------------------------------------------------
+    
+    def close( self ):
+    #--------------------------------------------------------------------------
+        """
+        Close the probe's socket.
+        """
+        
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+    #--------------------------------------------------------------------------
+    
+    def connect( self, addresses ):
+    #--------------------------------------------------------------------------
+        """
+        Start connecting to the first of the given addresses, the others are
+        tried in turn if the connection fails.
+        
+        :param addresses: list of tuples as returned by 'Resolver.resolve'
+        """
+        
+        self.addresses = list(addresses)
+        self.__connectnext()
+    #--------------------------------------------------------------------------
+    
+    def __connectnext( self ):
+    #--------------------------------------------------------------------------
+        """
+        Create a non-blocking socket for the next address and start connecting.
+        Finishes the probe as faulty if no address is left.
+        """
+        
+        while self.addresses:
+            family, socktype, proto, _, address = self.addresses.pop(0)
+            self.close()
+            
+            try:
+                self.sock = socket.socket(family, socktype, proto)
+                self.sock.setblocking(0)
+                self.__fileno = self.sock.fileno()
+                result = self.sock.connect_ex(address)
+            except socket.error:
+                continue
+            
+            if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                return
+        
+        self.finish(False)
+    #--------------------------------------------------------------------------
+    
+    def established( self ):
+    #--------------------------------------------------------------------------
+        """
+        Check whether the connection establishment has completed. If it failed,
+        the next address is tried (respectively the probe finished).
+        
+        :return: 'True' if connected, 'False' if still (or again) connecting
+        """
+        
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self.__connectnext()
+            return False
+        
+        try:
+            self.sock.getpeername()
+        except socket.error, e:
+            if e.args[0] == errno.ENOTCONN:
+                return False        # event of a former socket, still connecting
+            raise
+        
+        return True
+    #--------------------------------------------------------------------------
+    
+    def fileno( self ):
     #--------------------------------------------------------------------------
         """
-        Initialize the service object.
-
-        Creates a dummy, actual data has to be set using the setvalues(...) method.
+        :return: file descriptor of the probe's socket
         """
-
         
-        self.protocol = "UNKNOWN"
-        self.host = "localhost"
-        self.port = 0
-        self.timeout = 0
-        self.pattern = ""
-        self.lastschedule = time.time()
-        self.laststatus = -1
-        self.interval = 999999999       # unknown service should only be
-                                        # controlled once in order to 
-                                        # indicate the missing specification
+        return self.__fileno
     #--------------------------------------------------------------------------
     
-    def __eq__(self, other):
+    def finish( self, status ):
     #--------------------------------------------------------------------------
         """
-        Two subclasses of 'Service' are equal if their 'uid' is euqal.
+        Store the verdict in the service and close the socket. Only the first
+        verdict counts.
         
-        :return: 'True' if the uids are euqal, 'False' otherwise
-        :raise TypeError: if the given object is not instance of the same
-                            class
+        :param status: 'True' if the service is alright, 'False' otherwise
         """
         
-        if isinstance(other[1], self.__class__):
-            return self.uid == other[1].uid
+        if self.done:
+            return
         
-        raise TypeError("Expected instance of 'Service' or subclass")
+        self.done = True
+        self.service.laststatus = status
+        if self.started is not None:
+            self.service.lastlatency = time.time() - self.started
+        self.close()
     #--------------------------------------------------------------------------
     
-    def _police( self ):
+    def onreadable( self ):
     #--------------------------------------------------------------------------
         """
-        Dummy method used for unknown protocol types. While always announce a 
-        fault in order to indicate the missing information.
+        Receive available data and pass it to 'response()'.
+        """
         
-        Should be overridden by more precise service handler.
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.finish(False)
+            return
+        
+        if data and self.service.lastfirstbyte is None:
+            self.service.lastfirstbyte = time.time() - self.started
+        
+        verdict = self.response(data, len(data) == 0)
+        if verdict is not None:
+            self.finish(verdict)
+        elif not data:
+            self.finish(False)
+    #--------------------------------------------------------------------------
+    
+    def onwritable( self ):
+    #--------------------------------------------------------------------------
+        """
+        Complete the connection establishment respectively send the request.
         """
         
-        self.laststatus = False
+        if self.state == AsyncProbe.CONNECTING:
+            if not self.established():
+                return
+            
+            self.service.lastconnect = time.time() - self.started
+            self.state = AsyncProbe.SENDING
+            self.outbuffer = self.request()
+        
+        if self.outbuffer:
+            try:
+                sent = self.sock.send(self.outbuffer)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.finish(False)
+                return
+            self.outbuffer = self.outbuffer[sent:]
+        
+        if not self.outbuffer:
+            self.state = AsyncProbe.RECEIVING
+            verdict = self.response("", False)
+            if verdict is not None:
+                self.finish(verdict)
     #--------------------------------------------------------------------------
     
-    def police( self ):
+    def request( self ):
     #--------------------------------------------------------------------------
         """
-        Starts _police() method in new thread.
+        Return the data sent to the service after connecting. Should be 
+        overridden by probes which have to talk to the service.
         
-        :return: running instance of 'threading.Thread'
+        :return: request as string
         """
         
-        self.lastschedule = time.time()
-        t = threading.Thread(target=self._police, args = [ ])
-        t.start()
+        return ""
+    #--------------------------------------------------------------------------
+    
+    def response( self, data, eof ):
+    #--------------------------------------------------------------------------
+        """
+        Judge the data received from the service. Is called once with empty data
+        after the request has been sent and again for every received chunk.
+        Should be overridden by probes which have to talk to the service.
         
-        return t
-    #--------------------------------------------------------------------------    
+        :param data: chunk of data received, empty after sending the request
+        :param eof: 'True' if the service closed the connection
+        :return: 'True' or 'False' as verdict, 'None' if more data is needed
+        """
+        
+        return True
+    #--------------------------------------------------------------------------
     
-    def setbasicvalues( self, uid, protocol, host, port, timeout, pattern, interval):
+    def run( self, timeout ):
     #--------------------------------------------------------------------------
         """
-        Initialize the server object.
-
-        :param uid: unique identifier (e.g. a combination of host, port and service)
-        :param protocol: abbreviation of the protocol necessary to communicate with 
-                            the service
-        :param host: host name as a string
-        :param port: port where service is listening
-        :param timeout: time period after which service will presumed as faulty
-        :param pattern: string to look for in the service response (mismatch
-                        may indicate a fault)
-        :param interval: periodically check service again after given number in seconds 
-                        
+        Drive the probe in the calling thread until it's done, waiting for 
+        socket events with 'select.poll' (respectively 'select.select'). 
+        Allows handlers to use the same probe for worker threads as for the
+        'ProbeReactor'.
+        
+        :param timeout: seconds after which the probe is aborted
         """
         
-        self.uid = uid
-        self.protocol = protocol
-        self.host = host
-        self.port = str(port)
-        self.timeout = timeout
-        self.pattern = pattern
-        self.interval = interval
+        try:
+            self.start(time.time() + timeout)
+            
+            while not self.done:
+                self.service.activesocket = self.sock
+                wait = self.deadline - time.time()
+                if wait <= 0:
+                    self.abort()
+                    break
+                
+                write = self.wantswrite()
+                
+                if hasattr(select, "poll"):
+                    poller = select.poll()
+                    poller.register(self.fileno(), write and select.POLLOUT or select.POLLIN)
+                    ready = poller.poll(wait * 1000)
+                elif write:
+                    ready = select.select([], [self.fileno()], [], wait)[1]
+                else:
+                    ready = select.select([self.fileno()], [], [], wait)[0]
+                
+                if not ready:
+                    continue
+                
+                if write:
+                    self.onwritable()
+                else:
+                    self.onreadable()
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.finish(False)
+    #--------------------------------------------------------------------------
+    
+    def prepare( self, deadline ):
+    #--------------------------------------------------------------------------
+        """
+        Set the deadline and reset the timings of the service, before the host 
+        name is resolved.
+        
+        :param deadline: unix time stamp after which the probe is aborted
+        """
+        
+        self.deadline = deadline
+        self.started = time.time()
+        self.service.lastconnect = None
+        self.service.lastfirstbyte = None
+    #--------------------------------------------------------------------------
+    
+    def start( self, deadline ):
+    #--------------------------------------------------------------------------
+        """
+        Resolve the host name (blocking if it isn't cached) and start 
+        connecting to the service.
+        
+        :param deadline: unix time stamp after which the probe is aborted
+        """
+        
+        self.prepare(deadline)
+        self.connect(self.service.resolver.resolve(self.service.host, self.service.port))
     #--------------------------------------------------------------------------
     
+    def wantswrite( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'True' if the probe waits for the socket to become writable
+        """
+        
+        return self.state != AsyncProbe.RECEIVING
+    #--------------------------------------------------------------------------
 #==============================================================================
 
 
 
 
 
-class HTTPService( Service ):
+class HTTPProbe( AsyncProbe ):
 #==============================================================================
     """
-    Representation of a HTTP service.
+    Non-blocking check of a HTTP service.
+    
+    >>> probe = HTTPProbe(httpserv)
+    
+    Requests the root document with the service's method and compares the 
+    status code of the response with the service's pattern, just like 
+    'HTTPService._police()'. Only the status line is read, unless the body
+    has to be searched for the pattern. The connection is closed afterwards.
+    """
+    
+    def __init__( self, service ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the probe object.
+        
+        :param service: 'HTTPService' which should be checked
+        """
+        
+        AsyncProbe.__init__(self, service)
+        self.inbuffer = ""
+        self.scanner = None
+    #--------------------------------------------------------------------------
+    
+    def request( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: HTTP/1.0 request for the root document
+        """
+        
+        method = self.service.method or HTTPService.DEFAULTMETHOD
+        if self.service.matcher is not None:
+            method = "GET"
+        
+        return "%s / HTTP/1.0\r\nHost: %s:%s\r\nConnection: close\r\n\r\n" % \
+                    (method, self.service.host, self.service.port)
+    #--------------------------------------------------------------------------
+    
+    def response( self, data, eof ):
+    #--------------------------------------------------------------------------
+        """
+        Parse the status line as soon as it's complete. If the body has to be
+        checked, skip the headers and pass the body on to a 'PatternScanner'.
+        """
+        
+        if self.scanner is not None:
+            return self.scanner.feed(data)
+        
+        self.inbuffer += data
+        
+        if "\n" not in self.inbuffer:
+            if eof or len(self.inbuffer) > 1024:
+                return False
+            return None
+        
+        statusline = self.inbuffer.split("\n", 1)[0].split()
+        if len(statusline) < 2 or not statusline[0].startswith("HTTP/"):
+            return False
+        
+        try:
+            status = int(statusline[1])
+        except ValueError:
+            return False
+        
+        if self.service.matcher is None:
+            return status == self.service.pattern
+        
+        if status >= 400:
+            return False
+        
+        end = self.inbuffer.find("\r\n\r\n")
+        if end == -1:
+            if eof or len(self.inbuffer) > 16384:
+                return False
+            return None
+        
+        body = self.inbuffer[end + 4:]
+        self.inbuffer = ""
+        self.scanner = PatternScanner(self.service.matcher, HTTPService.maxbody)
+        
+        if body:
+            return self.scanner.feed(body)
+        if eof:
+            return False
+        
+        return None
+    #--------------------------------------------------------------------------
+#==============================================================================
 
-    >>> httpserv = HTTPService()
 
-    Checks the availability of an HTTP service at the given host name and port.
-    If the response code matches the given pattern (e.g. '200' for OK) the 
-    service is considered to be alright, otherwise a fault is presumed.
+
+
+
+class BannerProbe( AsyncProbe ):
+#==============================================================================
     """
+    Non-blocking check of a service greeting with a banner.
     
-    def __init__( self ):
+    >>> probe = BannerProbe(bannerserv)
+    
+    Sends nothing and matches the first line received against the service's
+    expression. The connection is closed afterwards.
+    """
+    
+    MAXBANNER = 1024        # bytes read at most while waiting for a line end
+    
+    def __init__( self, service ):
     #--------------------------------------------------------------------------
         """
-        Initialize the HTTPService object.
+        Initialize the probe object.
+        
+        :param service: 'BannerService' which should be checked
+        """
+        
+        AsyncProbe.__init__(self, service)
+        self.inbuffer = ""
+    #--------------------------------------------------------------------------
+    
+    def response( self, data, eof ):
+    #--------------------------------------------------------------------------
+        """
+        Match the banner as soon as its first line is complete.
+        """
+        
+        self.inbuffer += data
+        
+        if "\n" not in self.inbuffer and len(self.inbuffer) < BannerProbe.MAXBANNER:
+            if not eof:
+                return None
+            if not self.inbuffer:
+                return False
+        
+        banner = self.inbuffer.split("\n", 1)[0].rstrip("\r")
+        return self.service.matcher.search(banner) is not None
+    #--------------------------------------------------------------------------
+#==============================================================================
 
-        Creates a dummy, actual data has to be set using the setvalues(...) method.
+
+
+
+
+class TLSProbe( AsyncProbe ):
+#==============================================================================
+    """
+    Non-blocking TLS handshake with a service.
+    
+    >>> probe = TLSProbe(tlsserv)
+    
+    Wraps the socket once connected and drives the handshake, waiting for 
+    the socket to become readable or writable as requested by the TLS layer.
+    The service is alright as soon as the handshake succeeds.
+    """
+    
+    HANDSHAKING = 3
+    
+    def __init__( self, service ):
+    #--------------------------------------------------------------------------
         """
-        Service.__init__(self)
+        Initialize the probe object.
+        
+        :param service: 'TLSService' which should be checked
+        """
+        
+        AsyncProbe.__init__(self, service)
+        self.handshakewrite = True
     #--------------------------------------------------------------------------
     
-    def _police( self ):
+    def __handshake( self ):
     #--------------------------------------------------------------------------
         """
-        Uses urllib to make a HTTP GET request to own host name and port. If the
-        response code matches the pattern, the service is considered to be alright.
+        Continue the handshake until it completes or has to wait for the socket.
         """
+        
         try:
-            response = urllib.urlopen("http://" + self.host + ":" + str(self.port)).getcode()
-            self.laststatus = response == self.pattern
-        except KeyboardInterrupt:
-            raise
-        except:
-            self.laststatus = False
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.handshakewrite = False
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.handshakewrite = True
+                return
+            
+            self.finish(False)
+            return
+        
+        self.finish(True)
+    #--------------------------------------------------------------------------
+    
+    def onreadable( self ):
+    #--------------------------------------------------------------------------
+        """
+        Continue the handshake.
+        """
+        
+        if self.service.lastfirstbyte is None:
+            self.service.lastfirstbyte = time.time() - self.started
+        
+        self.__handshake()
+    #--------------------------------------------------------------------------
+    
+    def onwritable( self ):
+    #--------------------------------------------------------------------------
+        """
+        Wrap the socket once the connection is established and start the 
+        handshake respectively continue it.
+        """
+        
+        if self.state == AsyncProbe.CONNECTING:
+            if not self.established():
+                return
+            
+            self.service.lastconnect = time.time() - self.started
+            self.state = TLSProbe.HANDSHAKING
+            
+            if hasattr(ssl, "SSLContext"):
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                self.sock = context.wrap_socket(self.sock, server_hostname = self.service.host, 
+                                                do_handshake_on_connect = False)
+            else:
+                self.sock = ssl.wrap_socket(self.sock, do_handshake_on_connect = False)
+        
+        self.__handshake()
+    #--------------------------------------------------------------------------
+    
+    def wantswrite( self ):
+    #--------------------------------------------------------------------------
+        """
+        :return: 'True' if the probe waits for the socket to become writable
+        """
+        
+        if self.state == TLSProbe.HANDSHAKING:
+            return self.handshakewrite
+        
+        return True
     #--------------------------------------------------------------------------
+#==============================================================================
+
+
+
+
+
+def compilepattern( pattern ):
+#--------------------------------------------------------------------------
+    """
+    Return the compiled regular expression for a pattern. Every pattern is 
+    compiled only once and shared by all services using it. A pattern which 
+    isn't a valid expression is matched literally.
+    
+    :param pattern: regular expression as string
+    :return: compiled regular expression
+    """
+    
+    matcher = _patterns.get(pattern)
+    if matcher is None:
+        try:
+            matcher = re.compile(pattern)
+        except re.error:
+            matcher = re.compile(re.escape(pattern))
+        
+        _patterns[pattern] = matcher
+    
+    return matcher
+#--------------------------------------------------------------------------
+
+def createconnection( addresses, timeout = None ):
+#--------------------------------------------------------------------------
+    """
+    Connect a TCP socket to the first reachable of the given addresses.
+    
+    :param addresses: list of tuples as returned by 'Resolver.resolve'
+    :param timeout: optional socket timeout in seconds
+    :return: connected socket
+    :raise socket.error: error of the last address tried
+    """
+    
+    error = socket.error("No address to connect to")
+    
+    for family, socktype, proto, _, address in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not None:
+                sock.settimeout(timeout)
+            sock.connect(address)
+            return sock
+        except socket.error, e:
+            error = e
+            if sock is not None:
+                sock.close()
+    
+    raise error
+#--------------------------------------------------------------------------
+
+def formatlatencies( latencies ):
+#--------------------------------------------------------------------------
+    """
+    Format latencies as members of a JSON object (without braces).
+    
+    :param latencies: dictionary of uid or host name to 'metrics.ProbeLatency'
+    :return: string of comma separated members
+    """
+    
+    return ", ".join(['"%s": %s' % (key, latency.tojson()) for key, latency in latencies.iteritems()])
+#--------------------------------------------------------------------------
+
+def formatresults( services ):
+#--------------------------------------------------------------------------
+    """
+    Format the status of services as elements of the JSON array 'results'
+    (without brackets), each an array of uid, last schedule, status and timeout.
+    
+    :param services: iterable of handler objects
+    :return: string of comma separated elements
+    """
+    
+    return ",".join(['["%s", %f, %s, %d]' % (service.uid, service.lastschedule, int(service.laststatus), 
+                                              service.timeout) for service in services])
+#--------------------------------------------------------------------------
+
+def getphase( uid ):
+#--------------------------------------------------------------------------
+    """
+    Return a deterministic phase for the given uid, which is the same on 
+    every peer and after every restart.
+    
+    :param uid: unique identifier of a service
+    :return: float between 0 (inclusive) and 1 (exclusive)
+    """
+    
+    if isinstance(uid, unicode):
+        uid = uid.encode("utf-8")
+    
+    return (zlib.crc32(uid) & 0xffffffff) / 4294967296.0
+#--------------------------------------------------------------------------
+
+def internstring( value ):
+#--------------------------------------------------------------------------
+    """
+    Return the interned version of a string, so equal host names and protocols
+    of many services share a single object. Unicode strings are converted to 
+    byte strings if they are plain ASCII, otherwise returned unchanged.
+    
+    :param value: string
+    :return: interned string
+    """
+    
+    if isinstance(value, unicode):
+        try:
+            value = value.encode("ascii")
+        except UnicodeError:
+            return value
+    
+    return intern(value)
+#--------------------------------------------------------------------------
+
+def setnonblocking( fd ):
+#--------------------------------------------------------------------------
+    """
+    Switch the given file descriptor to non-blocking mode.
+    
+    :param fd: file descriptor as integer
+    """
     
-#==============================================================================
\ No newline at end of file
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+#--------------------------------------------------------------------------
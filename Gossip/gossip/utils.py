@@ -1,6 +1,10 @@
 import couchdb
 import simplejson
 import threading
+import time
+import urllib
+
+from metrics import registry
 
 class CouchDBManager( object ):
 #==============================================================================
@@ -12,6 +16,9 @@ class CouchDBManager( object ):
     Allows you to read and write documents holding the service list for a 
     distinct peer. Furthermore enables you to receive update messages for
     any document defined.
+    
+    The duration of every call is recorded in the histogram 
+    'gossip_couchdb_seconds' of the metrics registry.
     """
     
     username = "android"
@@ -26,7 +33,11 @@ class CouchDBManager( object ):
         frequently used database will swell fastly to a large size. Compact
         deletes obsolete data, just leaving the last data. 
         """
-        self.database.compact()
+        began = time.time()
+        try:
+            self.database.compact()
+        finally:
+            self.__record("compact", began)
     #--------------------------------------------------------------------------
 
     def getdocumentlist( self ):
@@ -36,9 +47,13 @@ class CouchDBManager( object ):
     
         :return: list containing '_id' of available documents
         """
-        documents = []
-        for row in self.database.query("function(doc) {emit(doc._id, doc._rev)}"):
-            documents.append(row["id"])
+        began = time.time()
+        try:
+            documents = []
+            for row in self.database.query("function(doc) {emit(doc._id, doc._rev)}"):
+                documents.append(row["id"])
+        finally:
+            self.__record("getdocumentlist", began)
             
         return documents
     #--------------------------------------------------------------------------
@@ -77,7 +92,11 @@ class CouchDBManager( object ):
         :return: dictionary containing all services defined by the document
         """
         
-        document = self.database.get(uid)
+        began = time.time()
+        try:
+            document = self.database.get(uid)
+        finally:
+            self.__record("read", began)
         
         if document == None:
             return "{}"
@@ -94,6 +113,19 @@ class CouchDBManager( object ):
         return "{ %s }" % content[:len(content)-1].replace("'", '"')
     #--------------------------------------------------------------------------
     
+    def __record( self, call, began ):
+    #--------------------------------------------------------------------------
+        """
+        Record the duration of a call to the database.
+        
+        :param call: name of the calling method
+        :param began: unix time stamp the call began at
+        """
+        
+        registry.histogram("gossip_couchdb_seconds", "Duration of the calls to couchDB by method", 
+                           call = call).record(time.time() - began)
+    #--------------------------------------------------------------------------
+    
     def __watchdb( self, handler, documents=None, lock=None ):
     #--------------------------------------------------------------------------
         """
@@ -174,7 +206,21 @@ class CouchDBManager( object ):
         document = couchdb.Document()
         document = content
         document["_id"] = uid
-                
+        
+        began = time.time()
+        try:
+            self.__save(uid, document)
+        finally:
+            self.__record("write", began)
+    #--------------------------------------------------------------------------
+    
+    def __save( self, uid, document ):
+    #--------------------------------------------------------------------------
+        """
+        Save a document, retrying with the current '_rev' until there's no 
+        resource conflict.
+        """
+        
         while True:
             try:
                 rev = self.database.get(uid)
@@ -188,8 +234,160 @@ class CouchDBManager( object ):
             except couchdb.http.ResourceConflict:
                 continue
     #--------------------------------------------------------------------------
+    
+    def writebatch( self, documents ):
+    #--------------------------------------------------------------------------
+        """
+        Write several documents with a single bulk request. 
+        
+        Like 'write' the current '_rev' of every document is retrieved (one 
+        request for all documents) and documents failing with a resource 
+        conflict are retried. 
+        
+        ANY PREVIOUS CONTENT OF THE DOCUMENTS WILL BE DISCARDED!!!
+        
+        :param documents: dictionary of '_id' to document body as dictionary,
+                            a body of 'None' deletes the document
+        """
+        
+        pending = documents
+        
+        began = time.time()
+        try:
+            while pending:
+                revs = {}
+                for row in self.database.view("_all_docs", keys = pending.keys()):
+                    value = row.get("value")
+                    if value is not None and not value.get("deleted"):
+                        revs[row["key"]] = value["rev"]
+                
+                batch = []
+                for uid, content in pending.iteritems():
+                    if content is None:
+                        if uid not in revs:
+                            continue
+                        document = {"_id": uid, "_rev": revs[uid], "_deleted": True}
+                    else:
+                        document = dict(content)
+                        document["_id"] = uid
+                        if uid in revs:
+                            document["_rev"] = revs[uid]
+                    
+                    batch.append(document)
+                
+                retry = {}
+                for success, uid, result in self.database.update(batch):
+                    if not success and isinstance(result, couchdb.http.ResourceConflict):
+                        retry[uid] = pending[uid]
+                
+                pending = retry
+        finally:
+            self.__record("writebatch", began)
+    #--------------------------------------------------------------------------
 #==============================================================================
 
+
+
+
+
+class ResultsWriter( object ):
+#==============================================================================
+    """
+    Publishes the results of a supervisor to a couchDB database.
+    
+    >>> writer = ResultsWriter(CouchDBManager("localhost", 5984, "gossip_serviceresults"))
+    
+    Only results which changed since the last publication are passed in (see
+    'Supervisor.getchangedresults'). Each of them is stored as a document of 
+    its own in a database holding nothing else, named by the URL-quoted 
+    service uid (see 'getdocumentid'), and written in bulk batches. Thus the 
+    cost of publishing depends on the number of changes instead of the number
+    of services.
+    
+    Optionally the 'results' document holding all results at once (read by 
+    the android client) is maintained in another database. It has to be 
+    rewritten as a whole, so this is done at most once per aggregate interval
+    and only if anything changed.
+    """
+    
+    def __init__( self, database, aggregate = None, batchsize = 500, aggregateinterval = 300 ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the results writer.
+        
+        :param database: 'CouchDBManager' of the database of the per-service
+                            results, used for nothing else
+        :param aggregate: optional 'CouchDBManager' of the database holding 
+                            the 'results' document, 'None' to not write it
+        :param batchsize: maximum number of documents written per bulk request
+        :param aggregateinterval: minimum seconds between two rewrites of the 
+                                    'results' document
+        """
+        
+        self.database = database
+        self.aggregate = aggregate
+        self.batchsize = batchsize
+        self.aggregateinterval = aggregateinterval
+        
+        self.rows = {}
+        self.lastaggregate = 0
+        self.aggregatechanged = False
+    #--------------------------------------------------------------------------
+    
+    def publish( self, changes ):
+    #--------------------------------------------------------------------------
+        """
+        Write changed results to the database.
+        
+        :param changes: dictionary of uid to a tuple of uid, last schedule, 
+                        status and timeout, 'None' for removed services
+        """
+        
+        documents = {}
+        for uid, result in changes.iteritems():
+            if result is None:
+                self.rows.pop(uid, None)
+                documents[getdocumentid(uid)] = None
+            else:
+                self.rows[uid] = '["%s", %f, %s, %d]' % result
+                documents[getdocumentid(uid)] = {"uid": uid, "lastschedule": result[1], "status": result[2], 
+                                                 "timeout": result[3]}
+            
+            if len(documents) >= self.batchsize:
+                self.database.writebatch(documents)
+                documents = {}
+        
+        if documents:
+            self.database.writebatch(documents)
+        
+        if self.aggregate is None:
+            return
+        
+        if changes:
+            self.aggregatechanged = True
+        
+        if self.aggregatechanged and time.time() - self.lastaggregate >= self.aggregateinterval:
+            self.aggregate.write("results", '{"results":[ %s ]}' % ",".join(self.rows.itervalues()))
+            self.aggregate.compact()
+            
+            self.lastaggregate = time.time()
+            self.aggregatechanged = False
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+def getdocumentid( uid ):
+#--------------------------------------------------------------------------
+    """
+    :param uid: unique identifier of a service, e.g. 'peer/index'
+    :return: '_id' of the service's results document, the URL-quoted uid
+    """
+    
+    if isinstance(uid, unicode):
+        uid = uid.encode("utf-8")
+    
+    return urllib.quote(uid, safe = "")
+#--------------------------------------------------------------------------
+
 def ssldebug( msg ):
 #--------------------------------------------------------------------------
     """ Prints a messsage to the screen with the name of the current thread """
@@ -0,0 +1,381 @@
+'''
+Benchmark of the message exchange between two babblers over SSL.
+
+Generates a throwaway certificate authority and a certificate for each of
+two peers in a temporary folder, and runs two 'Babblemouth' instances on the
+loopback interface: the receiving babbler listens like in production, every
+message is read and dispatched by its 'Conversation' thread to a registered
+handler. The sending babbler opens a conversation and writes the messages
+through the regular framing of 'Conversation.senddata'.
+
+For every payload size a new conversation is established (the handshake is
+timed) and a number of messages is sent back to back. The results are the
+messages and payload bytes per second until the last message reached the
+handler and the latency between sending a message and its handler being
+called. Additionally a number of handshakes is measured on its own.
+
+The output of the babblers is suppressed while measuring. Run
+'python tlsbenchmark.py --help' for the available options.
+'''
+
+import optparse
+import os
+import platform
+import shutil
+import simplejson
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from M2Crypto import ASN1, EVP, RSA, X509
+from gossip.crackertable import Babblemouth, Contact, Conversation, getcontext
+from gossip.metrics import LatencyHistogram
+
+class Receiver( object ):
+#==============================================================================
+    """
+    Handlers of the receiving babbler. Counts the 'BNCH' messages of the
+    current round and records their latency, 'BEND' ends the conversation.
+    """
+
+    def __init__( self ):
+    #--------------------------------------------------------------------------
+        """
+        Initialize the receiver without an active round.
+        """
+
+        self.expected = 0
+        self.received = 0
+        self.latencies = LatencyHistogram(minimum = 0.00001, maximum = 600.0)
+        self.done = threading.Event()
+    #--------------------------------------------------------------------------
+
+    def onbench( self, conv, msg ):
+    #--------------------------------------------------------------------------
+        """
+        Handle a benchmark message, whose first 8 bytes hold the time it has
+        been sent at.
+        """
+
+        self.latencies.record(time.time() - struct.unpack("!d", msg[:8])[0])
+
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+    #--------------------------------------------------------------------------
+
+    def onend( self, conv, msg ):
+    #--------------------------------------------------------------------------
+        """
+        Let the conversation terminate after this message.
+        """
+
+        conv.end()
+    #--------------------------------------------------------------------------
+
+    def reset( self, expected ):
+    #--------------------------------------------------------------------------
+        """
+        Start a new round.
+
+        :param expected: number of messages to wait for
+        """
+
+        self.expected = expected
+        self.received = 0
+        self.latencies = LatencyHistogram(minimum = 0.00001, maximum = 600.0)
+        self.done.clear()
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+class Silence( object ):
+#==============================================================================
+    """
+    File-like object swallowing the output of the babblers.
+    """
+
+    def write( self, data ):
+    #--------------------------------------------------------------------------
+        pass
+    #--------------------------------------------------------------------------
+
+    def flush( self ):
+    #--------------------------------------------------------------------------
+        pass
+    #--------------------------------------------------------------------------
+#==============================================================================
+
+def connect( sender, receiver, config ):
+#--------------------------------------------------------------------------
+    """
+    Open a conversation from the sending to the receiving babbler. The
+    conversation isn't started, messages are written by the caller.
+
+    :param sender: sending 'Babblemouth'
+    :param receiver: receiving 'Babblemouth', already listening
+    :param config: configuration of the sending babbler
+    :return: tuple of the 'Conversation' and the seconds the connection and
+                SSL handshake took
+    """
+
+    contact = Contact({"host": config["receiver"], "port": [config["receiverport"]],
+                       "version": None, "c_version": None})
+
+    conv = Conversation(sender, contact)
+    conv.setcontext(getcontext(config["certificates"]))
+
+    began = time.time()
+    conv.buildssl()
+    handshake = time.time() - began
+
+    conv.status = Conversation.GOING_ON
+    waitstatus(receiver, sender, Conversation.GOING_ON)
+
+    return conv, handshake
+#--------------------------------------------------------------------------
+
+def disconnect( conv, receiver, sender ):
+#--------------------------------------------------------------------------
+    """
+    Ask the receiving babbler to end the conversation and wait until it did,
+    so the next conversation can be accepted.
+    """
+
+    send(conv, "BEND", "")
+    waitstatus(receiver, sender, Conversation.ENDED)
+
+    conv.s.close()
+#--------------------------------------------------------------------------
+
+def makecertificate( folder, name, issuer = None, issuerkey = None, serial = 1 ):
+#--------------------------------------------------------------------------
+    """
+    Generate a RSA key and a certificate valid for one day and store both as
+    PEM files.
+
+    :param folder: folder to store the files in
+    :param name: common name of the certificate (identifier of the babbler)
+    :param issuer: certificate of the authority, 'None' for a self-signed
+                    authority certificate
+    :param issuerkey: 'M2Crypto.EVP.PKey' of the authority
+    :param serial: serial number of the certificate
+    :return: tuple of the certificate, its 'M2Crypto.EVP.PKey' and the paths
+                of the certificate and key files
+    """
+
+    keyfile = os.path.join(folder, "%s.key" % name)
+    certfile = os.path.join(folder, "%s.pem" % name)
+
+    rsa = RSA.gen_key(2048, 65537, lambda *args: None)
+    rsa.save_key(keyfile, None)
+
+    key = EVP.PKey()
+    key.assign_rsa(rsa)
+
+    subject = X509.X509_Name()
+    subject.CN = name
+
+    notbefore = ASN1.ASN1_UTCTIME()
+    notbefore.set_time(int(time.time()) - 3600)
+    notafter = ASN1.ASN1_UTCTIME()
+    notafter.set_time(int(time.time()) + 86400)
+
+    certificate = X509.X509()
+    certificate.set_version(2)
+    certificate.set_serial_number(serial)
+    certificate.set_subject(subject)
+    certificate.set_pubkey(key)
+    certificate.set_not_before(notbefore)
+    certificate.set_not_after(notafter)
+
+    if issuer is None:
+        certificate.set_issuer(subject)
+        certificate.add_ext(X509.new_extension("basicConstraints", "CA:TRUE"))
+        certificate.sign(key, "sha256")
+    else:
+        certificate.set_issuer(issuer.get_subject())
+        certificate.sign(issuerkey, "sha256")
+
+    certificate.save_pem(certfile)
+
+    return certificate, key, certfile, keyfile
+#--------------------------------------------------------------------------
+
+def makeconfig( folder, name, ca, cakey, serial, port ):
+#--------------------------------------------------------------------------
+    """
+    Generate the certificate of a babbler and return its configuration.
+
+    :return: configuration as expected by 'Babblemouth'
+    """
+
+    _, _, certfile, keyfile = makecertificate(folder, name, ca, cakey, serial)
+
+    return {"host": ["127.0.0.1"],
+            "port": [port],
+            "maxconv": 0,
+            "debug": 0,
+            "verbose": 0,
+            "version": 1,
+            "certificates": {"key": keyfile, "certificate": certfile,
+                             "ca": os.path.join(folder, "ca.pem")}}
+#--------------------------------------------------------------------------
+
+def run( sender, receiver, config, handlers, size, count ):
+#--------------------------------------------------------------------------
+    """
+    Send a number of messages of given size over a new conversation.
+
+    :return: dictionary of metric name to value
+    """
+
+    conv, handshake = connect(sender, receiver, config)
+
+    handlers.reset(count)
+    padding = "x" * (max(size, 8) - 8)
+
+    began = time.time()
+    for _ in xrange(0, count):
+        send(conv, "BNCH", struct.pack("!d", time.time()) + padding)
+
+    if not handlers.done.wait(600) and not handlers.done.isSet():
+        raise RuntimeError("Only %d of %d messages arrived" % (handlers.received, count))
+    elapsed = max(time.time() - began, 1e-9)
+
+    disconnect(conv, receiver, sender)
+
+    return {"size": size,
+            "messages": count,
+            "handshake_s": handshake,
+            "messages_per_s": count / elapsed,
+            "bytes_per_s": count * size / elapsed,
+            "latency_p50_s": handlers.latencies.getpercentile(50),
+            "latency_p99_s": handlers.latencies.getpercentile(99),
+            "latency_max_s": handlers.latencies.highest}
+#--------------------------------------------------------------------------
+
+def send( conv, msgtype, msg ):
+#--------------------------------------------------------------------------
+    """
+    Queue a message like 'Conversation.senddata' and write it at once, as
+    the conversation thread of the sending babbler would do.
+    """
+
+    conv.senddata(msgtype, conv.getmessagesequence(), msg)
+    conv._Conversation__senddata()
+#--------------------------------------------------------------------------
+
+def waitstatus( receiver, sender, status, timeout = 30 ):
+#--------------------------------------------------------------------------
+    """
+    Wait until the conversation of the receiving babbler with the sending one
+    has the given status.
+
+    :raise RuntimeError: if the status isn't reached within the timeout
+    """
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        remote = receiver.getbabbler(sender.myid)
+        if remote is not None and remote.status == status:
+            return
+        time.sleep(0.001)
+
+    raise RuntimeError("Conversation of the receiving babbler didn't reach status %d" % status)
+#--------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--sizes", dest = "sizes", default = "100,1000,10000,100000,1000000,10000000",
+                      help = "comma separated list of payload sizes in bytes [default: %default]")
+    parser.add_option("-b", "--bytes", dest = "bytes", type = "int", default = 50000000,
+                      help = "payload bytes sent per size, within --min and --max messages [default: %default]")
+    parser.add_option("--min", dest = "minimum", type = "int", default = 5,
+                      help = "minimum number of messages per size [default: %default]")
+    parser.add_option("--max", dest = "maximum", type = "int", default = 10000,
+                      help = "maximum number of messages per size [default: %default]")
+    parser.add_option("-k", "--handshakes", dest = "handshakes", type = "int", default = 20,
+                      help = "number of handshakes measured on their own [default: %default]")
+    parser.add_option("-o", "--output", dest = "output", default = None,
+                      help = "write the results as JSON to given file")
+
+    options, _ = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix = "gossip-tlsbenchmark-")
+    stdout = sys.stdout
+
+    try:
+        print "Generating certificates in %s..." % folder
+
+        ca, cakey, _, _ = makecertificate(folder, "ca")
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        receiverconfig = makeconfig(folder, "receiver.benchmark", ca, cakey, 2, port)
+        senderconfig = makeconfig(folder, "sender.benchmark", ca, cakey, 3, port)
+        senderconfig["receiver"] = ["127.0.0.1"]
+        senderconfig["receiverport"] = port
+
+        receiver = Babblemouth(receiverconfig)
+        sender = Babblemouth(senderconfig)
+
+        handlers = Receiver()
+        receiver.addhandler("BNCH", handlers.onbench)
+        receiver.addhandler("BEND", handlers.onend)
+
+        listener = threading.Thread(target = receiver.listen, args = ["127.0.0.1", port])
+        listener.setDaemon(True)
+        listener.start()
+        time.sleep(0.5)
+
+        sys.stdout = Silence()
+
+        handshakes = LatencyHistogram(minimum = 0.00001, maximum = 60.0)
+        for _ in xrange(0, options.handshakes):
+            conv, handshake = connect(sender, receiver, senderconfig)
+            handshakes.record(handshake)
+            disconnect(conv, receiver, sender)
+
+        sys.stdout = stdout
+
+        print "handshakes: %d, p50 %.4f s, p99 %.4f s" % (handshakes.count, handshakes.getpercentile(50) or 0,
+                                                         handshakes.getpercentile(99) or 0)
+        print
+        print "%10s %10s %12s %12s %14s %12s %12s %12s" % ("size", "messages", "handshake", "messages/s",
+                                                          "bytes/s", "latency p50", "latency p99", "latency max")
+
+        results = []
+        for size in [int(s) for s in options.sizes.split(",")]:
+            count = min(options.maximum, max(options.minimum, options.bytes / size))
+
+            sys.stdout = Silence()
+            try:
+                result = run(sender, receiver, senderconfig, handlers, size, count)
+            finally:
+                sys.stdout = stdout
+
+            results.append(result)
+            print "%10d %10d %12.4f %12.0f %14.0f %12.4f %12.4f %12.4f" % \
+                    (size, count, result["handshake_s"], result["messages_per_s"], result["bytes_per_s"],
+                     result["latency_p50_s"], result["latency_p99_s"], result["latency_max_s"])
+
+        if options.output:
+            output = open(options.output, "w")
+            try:
+                simplejson.dump({"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                                 "python": platform.python_version(),
+                                 "platform": platform.platform(),
+                                 "handshake_p50_s": handshakes.getpercentile(50),
+                                 "handshake_p99_s": handshakes.getpercentile(99),
+                                 "results": results}, output, indent = 2, sort_keys = True)
+            finally:
+                output.close()
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(folder, True)